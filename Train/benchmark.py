@@ -0,0 +1,480 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import scipy.sparse
+from Train.get_matrix import JavaSyntaxMatrixGenerator, conversion_errors
+from Train.get_distance import DistanceCalculator
+from Train.classification import FeatureClassification
+from Train.matrix_store import MatrixStore
+from Train.predict import ClonePredictor
+from Train.model_export import CompactModel, compare_models, export_model
+
+# Relative frequency of each statement kind in synthetic method bodies
+DEFAULT_MIX = {'assign': 4, 'call': 2, 'if': 2, 'for': 1, 'while': 1, 'try': 1, 'switch': 1}
+
+
+class SyntheticCorpus:
+    """
+        Generates a reproducible corpus of Java methods of configurable size and shape, with Type-2
+        clone pairs (same structure, renamed identifiers and changed literals) and non-clone pairs
+        written in the layouts of Clone_type/*.csv.
+    """
+
+    def __init__(self, n_methods=1000, max_depth=3, length=6, mix=None, clone_ratio=0.5, seed=0):
+        """
+            Args:
+            n_methods (int): Number of methods, including the clone variants.
+            max_depth (int): Deepest nesting of control statements.
+            length (int): Most statements per block.
+            mix (dict, optional): Relative frequency of 'assign', 'call', 'if', 'for', 'while', 'try' and 'switch'.
+            clone_ratio (float): Fraction of the methods that are clone variants of another method.
+            seed (int): Seed of the generator.
+        """
+        self.n_methods = n_methods
+        self.max_depth = max_depth
+        self.length = length
+        self.mix = mix or DEFAULT_MIX
+        self.clone_ratio = clone_ratio
+        self.seed = seed
+
+    def method(self, name, structure_seed, literal_seed, names=('a', 'b', 'xs', 's')):
+        """
+            Returns the source of one method. Methods with the same structure_seed have the same
+            syntax tree shape; literal_seed and names only change literals and identifiers.
+        """
+        structure = random.Random(structure_seed)
+        literals = random.Random(literal_seed)
+        a, b, xs, s = names
+        kinds, weights = list(self.mix), list(self.mix.values())
+        counter = [0]
+
+        def local():
+            counter[0] += 1
+            return f'v{counter[0]}'
+
+        def condition():
+            return '{} {} {}'.format(structure.choice([a, b, xs + '.length']), structure.choice(['<', '>', '==', '!=']),
+                                     literals.randint(0, 99))
+
+        def block(depth):
+            statements = []
+            for _ in range(structure.randint(1, self.length)):
+                kind = structure.choices(kinds, weights)[0]
+                if depth >= self.max_depth and kind not in ('assign', 'call'):
+                    kind = 'assign'
+                if kind == 'assign':
+                    statements.append('int {} = {} {} {};'.format(local(), structure.choice([a, b]),
+                                                                  structure.choice(['+', '-', '*']),
+                                                                  literals.randint(1, 99)))
+                elif kind == 'call':
+                    statements.append(structure.choice([f'System.out.println({s} + {literals.randint(0, 99)});',
+                                                        f'{s} = {s}.trim();', f'{a} = Math.max({a}, {b});']))
+                elif kind == 'if':
+                    statements.append(f'if ({condition()}) {{ {block(depth + 1)} }} else {{ {block(depth + 1)} }}')
+                elif kind == 'for':
+                    index = local()
+                    statements.append(f'for (int {index} = 0; {index} < {xs}.length; {index}++) '
+                                      f'{{ {a} += {xs}[{index}]; {block(depth + 1)} }}')
+                elif kind == 'while':
+                    statements.append(f'while ({condition()}) {{ {block(depth + 1)} {a}--; }}')
+                elif kind == 'try':
+                    statements.append(f'try {{ {block(depth + 1)} }} catch (Exception {local()}) '
+                                      f'{{ {block(depth + 1)} }}')
+                elif kind == 'switch':
+                    statements.append(f'switch ({a}) {{ case {literals.randint(0, 9)}: {block(depth + 1)} break; '
+                                      f'default: {block(depth + 1)} }}')
+            return ' '.join(statements)
+
+        return (f'public int m{name}(int {a}, int {b}, int[] {xs}, String {s}) '
+                f'{{ {block(0)} return {a} + {b}; }}\n')
+
+    def write(self, out_dir):
+        """
+            Writes the methods as <id>.java files and the pair CSVs.
+
+            Args:
+            out_dir (str): Directory to write java/, clone.csv and nonclone.csv to.
+
+            Returns:
+            tuple: The Java directory, the clone CSV and the non-clone CSV.
+        """
+        rng = random.Random(self.seed)
+        java_path = os.path.join(out_dir, 'java', '')
+        os.makedirs(java_path, exist_ok=True)
+        n_variants = int(self.n_methods * self.clone_ratio / (1 + self.clone_ratio))
+        n_originals = self.n_methods - n_variants
+        originals = []
+        clones = []
+        for index in range(self.n_methods):
+            name = str(1000000 + index)
+            if index < n_originals:
+                structure_seed = rng.getrandbits(32)
+                originals.append((name, structure_seed))
+                source = self.method(name, structure_seed, rng.getrandbits(32))
+            else:
+                original, structure_seed = rng.choice(originals)
+                source = self.method(name, structure_seed, rng.getrandbits(32), ('p', 'q', 'ys', 't'))
+                clones.append((original, name))
+            with open(java_path + name + '.java', 'w') as file:
+                file.write(source)
+
+        clone_csv = os.path.join(out_dir, 'clone.csv')
+        nonclone_csv = os.path.join(out_dir, 'nonclone.csv')
+        with open(clone_csv, 'w', newline='') as file:
+            # Layout of Clone_type/T2.csv: id1, id2, clone type and two similarity scores
+            csv.writer(file).writerows([(f1, f2, 2, 1, 1) for f1, f2 in clones])
+        with open(nonclone_csv, 'w', newline='') as file:
+            # Layout of Clone_type/*_noclone.csv: id1, id2
+            names = [name for name, _ in originals]
+            pairs = set()
+            while len(pairs) < len(clones) and len(names) > 1:
+                f1, f2 = rng.sample(names, 2)
+                pairs.add((f1, f2))
+            csv.writer(file).writerows(sorted(pairs))
+        return java_path, clone_csv, nonclone_csv
+
+
+class RssSampler:
+    """
+        Samples the resident set size of the process in a background thread and keeps the peak
+        seen while active. Falls back to the process-wide maximum where /proc is unavailable.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def rss(self):
+        try:
+            with open('/proc/self/statm', 'r') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+        return False
+
+
+def percentiles(seconds):
+    """
+        Returns the p50, p95 and p99 of latencies given in seconds, in milliseconds.
+    """
+    if not len(seconds):
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    milliseconds = np.asarray(seconds) * 1000
+    return {'p50_ms': float(np.percentile(milliseconds, 50)), 'p95_ms': float(np.percentile(milliseconds, 95)),
+            'p99_ms': float(np.percentile(milliseconds, 99))}
+
+
+class PipelineBenchmark:
+    """
+        Drives every pipeline stage separately over a corpus and reports its throughput, peak RSS
+        and per-item latency percentiles:
+
+        startup  cold start of a fresh interpreter importing train_system and loading type.json, per run
+        parse    javalang parsing and triad extraction, per file
+        lookup   walking the parsed trees and coding their triads into matrix cells, per triad
+        matrix   transition matrix build from the triad codes, per file
+        persist  writing the matrices with the chosen backend, per file
+        distance distance features of the clone and non-clone pairs, per pair
+        train    10-fold cross-validated training on those features, per fold
+        export   batch prediction of the distance features by the model exported to .ubj, per pair;
+                 the pickle is compared with the export in size, load time and predictions/s
+        predict  in-memory scoring of source pairs by ClonePredictor, per pair
+    """
+
+    def __init__(self, java_path, clone_csv, nonclone_csv, work_dir, json_path='type.json', backend='npy',
+                 batch_size=256, train_options=None):
+        """
+            Args:
+            java_path (str): Directory of the Java files, e.g. written by SyntheticCorpus or the BCB corpus.
+            clone_csv (str): CSV of clone pairs, e.g. Clone_type/T1.csv.
+            nonclone_csv (str): CSV of non-clone pairs, e.g. Clone_type/T1_noclone.csv.
+            work_dir (str): Directory for the matrices, features and model the stages write.
+            json_path (str): The node and token dictionaries.
+            backend (str): 'npy', 'sparse' or 'store'.
+            batch_size (int): Pairs per batch of the distance and predict stages.
+            train_options (dict, optional): Training settings of FeatureClassification.
+        """
+        self.java_path = java_path
+        self.clone_csv = clone_csv
+        self.nonclone_csv = nonclone_csv
+        self.work_dir = work_dir
+        self.npy_path = os.path.join(work_dir, 'npy', '')
+        self.model_path = os.path.join(work_dir, 'best_model.pkl')
+        self.json_path = json_path
+        self.backend = backend
+        self.batch_size = batch_size
+        self.train_options = train_options or {}
+        self.generator = JavaSyntaxMatrixGenerator(java_path, self.npy_path, json_path, backend=backend)
+        self.results = {}
+        # Intermediate results handed from one stage to the next
+        self.codes = {}
+        self.matrices = {}
+        self.feature_paths = []
+        self.model_comparison = []
+
+    def measure(self, name, stage, unit):
+        """
+            Runs a stage, which returns the number of items it processed and their latencies, and
+            records its wall time, throughput, peak RSS and latency percentiles under name. A stage that
+            prepares its own input also returns the seconds spent in the measured work.
+        """
+        with RssSampler() as sampler:
+            start = time.perf_counter()
+            items, latencies, *measured = stage()
+            seconds = measured[0] if measured else time.perf_counter() - start
+        result = {'items': items, 'seconds': seconds,
+                  f'{unit}_per_s': items / seconds if seconds > 0 else None,
+                  'peak_rss_mb': sampler.peak / (1024 * 1024)}
+        result.update(percentiles(latencies))
+        self.results[name] = result
+        print(name, result)
+        return result
+
+    def startup(self, runs=5):
+        code = ('import time; start = time.perf_counter(); import train_system; '
+                'train_system.JavaSyntaxMatrixGenerator(None, json_path={!r}); '
+                'print(time.perf_counter() - start)').format(os.path.abspath(self.json_path))
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        latencies = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                    cwd=root).stdout
+            latencies.append(float(output.split()[-1]))
+        return runs, latencies
+
+    def parse(self):
+        latencies = []
+        for path in self.generator.listdir(self.java_path):
+            start = time.perf_counter()
+            try:
+                tree, tokens = self.generator.get_ast(path)
+            except conversion_errors():
+                continue
+            typedict = self.generator.get_typedict(tokens)
+            rows, cols, _ = self.generator.walk_codes(tree, typedict)
+            latencies.append(time.perf_counter() - start)
+            self.codes[self.generator.matrix_name(path)] = (rows, cols)
+        return len(latencies), latencies
+
+    def lookup(self):
+        latencies = []
+        seconds = 0.0
+        for path in self.generator.listdir(self.java_path):
+            if self.generator.matrix_name(path) not in self.codes:
+                continue
+            tree, tokens = self.generator.get_ast(path)
+            typedict = self.generator.get_typedict(tokens)
+            start = time.perf_counter()
+            rows, _, unknown = self.generator.walk_codes(tree, typedict)
+            elapsed = time.perf_counter() - start
+            seconds += elapsed
+            triads = len(rows) + sum(unknown.values())
+            if triads:
+                latencies.extend([elapsed / triads] * triads)
+        return len(latencies), latencies, seconds
+
+    def matrix(self):
+        latencies = []
+        for name, (rows, cols) in self.codes.items():
+            start = time.perf_counter()
+            self.matrices[name] = self.generator.transition_matrix(rows, cols, sparse=self.backend == 'sparse')
+            latencies.append(time.perf_counter() - start)
+        return len(latencies), latencies
+
+    def persist(self):
+        latencies = []
+        os.makedirs(self.npy_path, exist_ok=True)
+        store = MatrixStore(self.npy_path, mode='a') if self.backend == 'store' else None
+        try:
+            for name, matrix in self.matrices.items():
+                start = time.perf_counter()
+                if store is not None:
+                    store.append(name, matrix)
+                elif self.backend == 'sparse':
+                    scipy.sparse.save_npz(self.npy_path + name, matrix)
+                else:
+                    np.save(self.npy_path + name, matrix)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            if store is not None:
+                store.close()
+        return len(latencies), latencies
+
+    def distance(self):
+        latencies = []
+        pairs_done = 0
+        self.feature_paths = []
+        for pairs_csv in (self.clone_csv, self.nonclone_csv):
+            calculator = DistanceCalculator(pairs_csv, self.npy_path, self.backend, batch_size=self.batch_size)
+            calculator.out = os.path.join(self.work_dir, calculator.out)
+            calculator.open_matrices()
+            rows = []
+            for chunk in calculator.iter_chunks(self.batch_size):
+                if not chunk:
+                    continue
+                start = time.perf_counter()
+                chunk_rows, pairs = calculator.chunk_features(chunk)
+                elapsed = time.perf_counter() - start
+                # A chunk whose matrices are all missing computes no pairs and has no per-pair latency
+                if pairs:
+                    latencies.extend([elapsed / len(pairs)] * len(pairs))
+                rows.extend(chunk_rows)
+                pairs_done += len(pairs)
+            path = calculator.output_path('csv')
+            with open(path, 'w', newline='') as file:
+                csv.writer(file).writerows(rows)
+            self.feature_paths.append(path)
+        return pairs_done, latencies
+
+    def train(self):
+        classifier = FeatureClassification(*self.feature_paths, model_path=self.model_path, **self.train_options)
+        classifier.run()
+        return len(classifier.fold_reports), [report['train_seconds'] for report in classifier.fold_reports]
+
+    def export(self):
+        report = export_model(self.model_path)
+        features = np.concatenate([np.loadtxt(path, delimiter=',', dtype=np.float32, ndmin=2)
+                                   for path in self.feature_paths])
+        self.model_comparison = compare_models([self.model_path, report['path']], features, self.batch_size)
+        model = CompactModel(report['path'])
+        latencies = []
+        for start in range(0, len(features), self.batch_size):
+            batch = features[start:start + self.batch_size]
+            start_time = time.perf_counter()
+            model.predict(batch)
+            latencies.extend([(time.perf_counter() - start_time) / len(batch)] * len(batch))
+        return len(latencies), latencies, sum(latencies)
+
+    def predict(self):
+        predictor = ClonePredictor(self.model_path, self.json_path, latency_window=None)
+        calculator = DistanceCalculator(self.clone_csv)
+        files = {self.generator.matrix_name(path): path for path in self.generator.listdir(self.java_path)}
+        pairs = [(files[pair[0]], files[pair[1]]) for pair in calculator.read_pairs()
+                 if pair is not None and pair[0] in files and pair[1] in files and
+                 pair[0] in self.codes and pair[1] in self.codes]
+        for start in range(0, len(pairs), self.batch_size):
+            predictor.predict_batch(pairs[start:start + self.batch_size])
+        return len(pairs), list(predictor.pair_latencies)
+
+    def run(self, stages=('startup', 'parse', 'lookup', 'matrix', 'persist', 'distance', 'train', 'export',
+                          'predict')):
+        """
+            Runs the stages in pipeline order; a stage needs the stages before it.
+
+            Returns:
+            dict: The result of every stage.
+        """
+        units = {'startup': 'runs', 'parse': 'files', 'lookup': 'triads', 'matrix': 'files', 'persist': 'files', 'distance': 'pairs', 'train': 'folds',
+                 'export': 'pairs', 'predict': 'pairs'}
+        for name in stages:
+            self.measure(name, getattr(self, name), units[name])
+            if name == 'export':
+                self.results[name]['models'] = self.model_comparison
+                for result in self.model_comparison:
+                    print(result)
+        return self.results
+
+
+def commit_id():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def save_results(results, config, out_json):
+    """
+        Writes the results of a run, with its configuration, commit and environment, as JSON.
+    """
+    document = {'commit': commit_id(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                'platform': platform.platform(), 'cpus': os.cpu_count(), 'config': config, 'stages': results}
+    with open(out_json, 'w') as file:
+        json.dump(document, file, indent=2)
+    return document
+
+
+def compare(baseline_json, current_json):
+    """
+        Prints the throughput and p95 latency of every stage of two result files side by side.
+
+        Returns:
+        dict: The current/baseline throughput ratio of every stage both runs measured.
+    """
+    with open(baseline_json, 'r') as file:
+        baseline = json.load(file)
+    with open(current_json, 'r') as file:
+        current = json.load(file)
+    ratios = {}
+    for name, result in current['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            continue
+        key = next(key for key in result if key.endswith('_per_s'))
+        if before.get(key) and result.get(key):
+            ratios[name] = result[key] / before[key]
+            print("{:9s} {:>12.1f} -> {:>12.1f} {} ({:.2f}x), p95 {} -> {} ms".format(
+                name, before[key], result[key], key, ratios[name], before.get('p95_ms'), result.get('p95_ms')))
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage benchmark of the clone detection pipeline.')
+    parser.add_argument('--work-dir', default='./benchmark/')
+    parser.add_argument('--methods', type=int, default=1000, help='size of the synthetic corpus')
+    parser.add_argument('--depth', type=int, default=3, help='deepest nesting of synthetic control statements')
+    parser.add_argument('--length', type=int, default=6, help='most statements per synthetic block')
+    parser.add_argument('--mix', default=None, help='statement mix as JSON, e.g. \'{"assign": 4, "if": 2}\'')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--java', default=None, help='benchmark an existing corpus instead, e.g. ./BCB/')
+    parser.add_argument('--pairs', default=None, help='clone pair CSV of --java, e.g. Clone_type/T1.csv')
+    parser.add_argument('--nonclone', default=None, help='non-clone pair CSV of --java')
+    parser.add_argument('--json', default='type.json')
+    parser.add_argument('--backend', default='npy')
+    parser.add_argument('--stages', default='startup,parse,lookup,matrix,persist,distance,train,export,predict')
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help='results JSON of a baseline run to compare against')
+    args = parser.parse_args()
+
+    config = vars(args).copy()
+    os.makedirs(args.work_dir, exist_ok=True)
+    if args.java is None:
+        corpus = SyntheticCorpus(args.methods, args.depth, args.length, json.loads(args.mix) if args.mix else None,
+                                 seed=args.seed)
+        java_path, clone_csv, nonclone_csv = corpus.write(args.work_dir)
+    else:
+        java_path, clone_csv, nonclone_csv = args.java, args.pairs, args.nonclone
+    benchmark = PipelineBenchmark(java_path, clone_csv, nonclone_csv, args.work_dir, args.json, args.backend)
+    save_results(benchmark.run(args.stages.split(',')), config, args.out)
+    if args.compare is not None:
+        compare(args.compare, args.out)
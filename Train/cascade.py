@@ -0,0 +1,268 @@
+import argparse
+import os
+import time
+import numpy as np
+from Train.get_distance import DistanceCalculator
+from Train.feature_selection import N_FEATURES, model_ranking, read_weight_ranking, top_k
+from Train.model_export import load_model
+
+# 'sketch' compares the column mass profiles of two matrices, 'features' scores the top-k features with a
+# shallow classifier
+STAGES = ('sketch', 'features')
+
+
+class CascadeFilter:
+    """
+        The first stage of a two-stage cascade: a cheap score of every pair, and a threshold calibrated on
+        known clone pairs below which pairs are rejected before the full 288 features and the model.
+
+        The 'sketch' score is one minus half the L1 distance of the column mass distributions of the two
+        matrices (72 values per method, computed once per method), so a rejected pair never loads its
+        full matrices again. The 'features' score is the clone probability of a depth-3 classifier over
+        the k most important features, which are far cheaper to compute than all 288. They are ranked by
+        the importances of a classifier trained on the calibration pairs, or read from a weight.txt ranking.
+    """
+
+    def __init__(self, calculator, stage='sketch', k=8, weight_path=None, target_recall=0.99):
+        """
+            Args:
+            calculator (DistanceCalculator): Serves the matrices; open_matrices must have been called.
+            stage (str): 'sketch' or 'features'.
+            k (int): Number of features of the 'features' stage.
+            weight_path (str, optional): A feature ranking such as weight.txt for the 'features' stage, which
+                                         ranks a different feature layout; by default features are ranked on
+                                         the calibration pairs.
+            target_recall (float): Share of the calibration clone pairs the first stage has to pass.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage!r}, expected 'sketch' or 'features'")
+        self.calculator = calculator
+        self.stage = stage
+        self.k = k
+        self.target_recall = target_recall
+        self.sketches = {}
+        self.model = None
+        self.threshold = None
+        self.feature_indices = None
+        self.stage_calculator = None
+        if stage == 'features' and weight_path is not None:
+            self.use_features(top_k(read_weight_ranking(weight_path), k))
+
+    def use_features(self, feature_indices):
+        """
+            Sets the features of the 'features' stage.
+        """
+        self.feature_indices = feature_indices
+        # Shares the matrix cache and index, but only computes the selected features
+        self.stage_calculator = DistanceCalculator(**dict(self.calculator.options(), feature_indices=feature_indices))
+        self.stage_calculator.cache = self.calculator.cache
+        self.stage_calculator.store = self.calculator.store
+        self.stage_calculator.existing = self.calculator.existing
+
+    def use_calibration(self, calibrated):
+        """
+            Takes over the threshold, features and classifier of another calibrated CascadeFilter.
+        """
+        if self.stage == 'features':
+            self.use_features(calibrated.feature_indices)
+        self.model, self.threshold = calibrated.model, calibrated.threshold
+
+    def sketch(self, name):
+        sketch = self.sketches.get(name)
+        if sketch is None:
+            # Read once past the matrix cache, so that sketching every method does not evict the survivors
+            column_mass = np.asarray(self.calculator.load_matrix(name).sum(axis=0), dtype=np.float64).ravel()
+            total = column_mass.sum()
+            sketch = self.sketches[name] = (column_mass / total if total else column_mass).astype(np.float32)
+        return sketch
+
+    def scores(self, pairs):
+        """
+            Returns the first-stage score of every (id1, id2) pair; higher means more clone-like.
+        """
+        if not pairs:
+            return np.zeros(0)
+        if self.stage == 'sketch':
+            sketches1 = np.stack([self.sketch(name1) for name1, _ in pairs])
+            sketches2 = np.stack([self.sketch(name2) for _, name2 in pairs])
+            return 1 - 0.5 * np.abs(sketches1 - sketches2).sum(axis=1)
+        features = np.asarray(self.stage_calculator.features(pairs))
+        return self.model.predict_proba(features)[:, 1]
+
+    def calibrate(self, clone_pairs, nonclone_pairs):
+        """
+            Sets the threshold so that the first stage passes target_recall of the clone pairs. The
+            'features' classifier is trained on every other pair and the threshold set on the rest; without
+            a weight_path, its features are the top k by the importances of a classifier trained on all
+            the features of the same pairs.
+
+            Args:
+            clone_pairs (list): (id1, id2) clone pairs whose matrices exist.
+            nonclone_pairs (list): (id1, id2) non-clone pairs whose matrices exist.
+
+            Returns:
+            dict: The threshold and the first-stage recall and non-clone rejection on the calibration pairs.
+        """
+        if not clone_pairs:
+            raise ValueError("Calibrating the cascade needs clone pairs whose matrices exist")
+        if self.stage == 'features':
+            from xgboost import XGBClassifier
+            fit_pairs = clone_pairs[::2] + nonclone_pairs[::2]
+            labels = [1] * len(clone_pairs[::2]) + [0] * len(nonclone_pairs[::2])
+            if self.stage_calculator is None:
+                # Ranks the features the calculator computes, all 288 unless the full model uses fewer
+                ranker = XGBClassifier(random_state=0)
+                ranker.fit(np.asarray(self.calculator.features(fit_pairs)), labels)
+                columns = self.calculator.feature_indices or list(range(N_FEATURES))
+                self.use_features(top_k([columns[column] for column in model_ranking(ranker)], self.k))
+            self.model = XGBClassifier(max_depth=3, n_estimators=20, random_state=0)
+            self.model.fit(np.asarray(self.stage_calculator.features(fit_pairs)), labels)
+            clone_pairs, nonclone_pairs = clone_pairs[1::2], nonclone_pairs[1::2]
+        clone_scores = self.scores(clone_pairs)
+        nonclone_scores = self.scores(nonclone_pairs)
+        self.threshold = float(np.quantile(clone_scores, 1 - self.target_recall, method='lower'))
+        report = {'stage': self.stage, 'threshold': self.threshold,
+                  'recall': float(np.mean(clone_scores >= self.threshold)),
+                  'nonclone_rejection': float(np.mean(nonclone_scores < self.threshold))
+                  if len(nonclone_scores) else None}
+        print(report)
+        return report
+
+    def survivors(self, pairs):
+        """
+            Returns a boolean mask of the pairs the first stage passes on to the full model.
+        """
+        if self.threshold is None:
+            raise ValueError("The cascade has to be calibrated first")
+        return self.scores(pairs) >= self.threshold
+
+
+def existing_pairs(calculator, pairs_csv):
+    """
+        Reads the pairs of a CSV in the layout of Clone_type/*.csv whose two matrices exist.
+    """
+    return [pair for pair in DistanceCalculator(pairs_csv).read_pairs()
+            if pair is not None and calculator.matrix_exists(pair[0]) and calculator.matrix_exists(pair[1])]
+
+
+def score_pairs(calculator, model, pairs, cascade=None, batch_size=256):
+    """
+        Scores pairs with the full features and the model, or, given a cascade, only the pairs that
+        survive its first stage; rejected pairs score 0.
+
+        Returns:
+        tuple: The clone probability of every pair and the boolean mask of the pairs the model scored.
+    """
+    probabilities = np.zeros(len(pairs))
+    scored = np.ones(len(pairs), dtype=bool)
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        if cascade is not None:
+            scored[start:start + len(batch)] = cascade.survivors(batch)
+            batch = [pair for pair, keep in zip(batch, scored[start:start + len(batch)]) if keep]
+        if batch:
+            positions = np.flatnonzero(scored[start:start + batch_size]) + start
+            probabilities[positions] = model.predict_proba(np.asarray(calculator.features(batch)))[:, 1]
+    return probabilities, scored
+
+
+def pair_sets(clone_type_path='./Clone_type/'):
+    """
+        Lists the (clone CSV, non-clone CSV) sets of Clone_type, e.g. T1.csv and T1_noclone.csv. A
+        non-clone CSV without clone pairs, such as WT3T4_noclone.csv, comes with None.
+    """
+    sets = []
+    for file in sorted(os.listdir(clone_type_path)):
+        if file.endswith('_noclone.csv'):
+            clone_csv = os.path.join(clone_type_path, file[:-len('_noclone.csv')] + '.csv')
+            sets.append((clone_csv if os.path.exists(clone_csv) else None, os.path.join(clone_type_path, file)))
+    return sets
+
+
+def cascade_report(npy_path='./npy/', backend='npy', model_path='best_model.pkl', sets=None, stage='sketch', k=8,
+                   weight_path=None, target_recall=0.99, calibration=None, threshold=0.5):
+    """
+        Compares the cascade with scoring every pair by the full model on pair sets: the share of pairs
+        the first stage rejects, the clones the full model finds that the cascade loses, and the time of both.
+        The cascade is calibrated on every other pair of the calibration set, and that set is reported on
+        the held-out pairs only, so that no reported pair was seen by the calibration.
+
+        Args:
+        npy_path (str): The matrices of the methods the pair sets refer to.
+        backend (str): 'npy', 'sparse' or 'store', as for DistanceCalculator.
+        model_path (str): The full model, pickled or exported.
+        sets (list, optional): (clone CSV or None, non-clone CSV) tuples, by default those of Clone_type.
+        stage (str): First stage of the cascade, 'sketch' or 'features'.
+        k (int): Number of features of the 'features' stage.
+        weight_path (str, optional): A feature ranking such as weight.txt for the 'features' stage.
+        target_recall (float): Share of the calibration clone pairs the first stage has to pass.
+        calibration (tuple, optional): (clone CSV, non-clone CSV) to calibrate on, by default the first set.
+        threshold (float): Clone probability above which the full model reports a clone.
+
+        Returns:
+        list: One dict per pair set, whose 'held_out' tells whether it was the calibration set.
+    """
+    sets = sets if sets is not None else pair_sets()
+    calibration = calibration or next(pair_set for pair_set in sets if pair_set[0] is not None)
+    model, feature_indices = load_model(model_path)
+    results = []
+    calibration_calculator = DistanceCalculator(None, npy_path, backend, feature_indices=feature_indices)
+    calibration_calculator.open_matrices()
+    calibrated = CascadeFilter(calibration_calculator, stage, k, weight_path, target_recall)
+    calibrated.calibrate(*[existing_pairs(calibration_calculator, path)[::2] for path in calibration])
+    calibration_paths = [os.path.abspath(path) for path in calibration]
+    for clone_csv, nonclone_csv in sets:
+        calculator = DistanceCalculator(None, npy_path, backend, feature_indices=feature_indices)
+        calculator.open_matrices()
+        clone_pairs = existing_pairs(calculator, clone_csv) if clone_csv is not None else []
+        nonclone_pairs = existing_pairs(calculator, nonclone_csv)
+        held_out = [os.path.abspath(path) if path is not None else None
+                    for path in (clone_csv, nonclone_csv)] == calibration_paths
+        if held_out:
+            clone_pairs, nonclone_pairs = clone_pairs[1::2], nonclone_pairs[1::2]
+        pairs = clone_pairs + nonclone_pairs
+        labels = np.array([1] * len(clone_pairs) + [0] * (len(pairs) - len(clone_pairs)), dtype=bool)
+
+        # Fresh calculators, so that neither run profits from matrices the other one cached
+        start = time.perf_counter()
+        full, _ = score_pairs(calculator, model, pairs)
+        full_seconds = time.perf_counter() - start
+        calculator = DistanceCalculator(None, npy_path, backend, feature_indices=feature_indices)
+        calculator.open_matrices()
+        cascade = CascadeFilter(calculator, stage, k, weight_path, target_recall)
+        cascade.use_calibration(calibrated)
+        start = time.perf_counter()
+        cascaded, scored = score_pairs(calculator, model, pairs, cascade)
+        cascade_seconds = time.perf_counter() - start
+
+        found = full >= threshold
+        kept = cascaded >= threshold
+        result = {'clone_csv': clone_csv, 'nonclone_csv': nonclone_csv, 'held_out': held_out, 'pairs': len(pairs),
+                  'rejection_rate': float(np.mean(~scored)) if len(pairs) else None,
+                  'nonclone_rejection': float(np.mean(~scored[~labels])) if (~labels).any() else None,
+                  'recall_full': float(np.mean(found[labels])) if labels.any() else None,
+                  'recall_cascade': float(np.mean(kept[labels])) if labels.any() else None,
+                  'recall_lost': float(np.mean(~kept[found & labels])) if (found & labels).any() else None,
+                  'full_seconds': full_seconds, 'cascade_seconds': cascade_seconds,
+                  'speedup': full_seconds / cascade_seconds if cascade_seconds > 0 else None}
+        print(result)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    # Example usage: python -m Train.cascade --npy ./npy/ --stage features --k 8
+    parser = argparse.ArgumentParser(description='Rejection rate and recall lost of a cascade prefilter.')
+    parser.add_argument('--npy', default='./npy/')
+    parser.add_argument('--backend', default='npy')
+    parser.add_argument('--model', default='best_model.pkl')
+    parser.add_argument('--clone-type', default='./Clone_type/', help='directory of the pair sets')
+    parser.add_argument('--stage', default='sketch', choices=STAGES)
+    parser.add_argument('--k', type=int, default=8)
+    parser.add_argument('--weight', default=None, help='feature ranking of the features stage, e.g. weight.txt')
+    parser.add_argument('--target-recall', type=float, default=0.99)
+    parser.add_argument('--calibrate', default=None, help='clone CSV,non-clone CSV to calibrate on')
+    args = parser.parse_args()
+
+    cascade_report(args.npy, args.backend, args.model, pair_sets(args.clone_type), args.stage, args.k, args.weight,
+                   args.target_recall, tuple(args.calibrate.split(',')) if args.calibrate else None)
@@ -1,17 +1,52 @@
 import csv
+import hashlib
+import json
+import os
 import random
-import joblib
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from itertools import islice
-from sklearn.metrics import f1_score, precision_score, recall_score
-from sklearn.model_selection import KFold
-from xgboost import XGBClassifier
+from Train.feature_file import FeatureFiles, is_feature_file, load_feature_file
+from Train.feature_selection import model_ranking, save_model_features, top_k
+from Train.metrics import Metrics
 
 
 class FeatureClassification:
-    def __init__(self, clonefeature_csv, nonclonefeature_csv):
+    def __init__(self, clonefeature_csv, nonclonefeature_csv, feature_indices=None, model_path='best_model.pkl',
+                 cpu_budget=None, nthread=None, tree_method=None, early_stopping_rounds=None,
+                 validation_fraction=0.1, stratified=False, metrics=None, checkpoint_dir=None, seed=None,
+                 memory_budget=None, cache_dir=None):
         self.clonefeature_csv = clonefeature_csv
         self.nonclonefeature_csv = nonclonefeature_csv
+        # Positions in the 288-value vector to train on, None for all of them
+        self.feature_indices = sorted(feature_indices) if feature_indices is not None else None
+        self.model_path = model_path
+        self.best_model = None
+        # Training settings; the defaults train the folds one after another like before.
+        # cpu_budget: total threads for cross-validation, shared by concurrent folds of nthread threads each
+        self.cpu_budget = cpu_budget
+        self.nthread = nthread
+        # Threads of every fold when nthread is None: XGBOOST's share of the cpu_budget per concurrent fold
+        self.fold_nthread = None
+        # e.g. 'hist' for histogram-based tree construction
+        self.tree_method = tree_method
+        # Stop adding trees once the loss on a held-out validation_fraction of the training fold stalls
+        self.early_stopping_rounds = early_stopping_rounds
+        self.validation_fraction = validation_fraction
+        # Keep the clone/non-clone ratio in every fold
+        self.stratified = stratified
+        self.fold_reports = []
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Every completed fold is saved here, and an interrupted XGBOOST with the same data and settings reuses them
+        self.checkpoint_dir = checkpoint_dir
+        # Seed of the shuffle, so that a resumed run cuts the same folds
+        self.seed = seed
+        # Bytes of memory for training out of core: binary feature files are streamed in chunks into
+        # XGBoost's external memory, whose pages are cached under cache_dir (a temporary directory by default).
+        # None trains on in-memory arrays.
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
 
     def feature_extraction_order(self, feature_csv):
         """
@@ -33,8 +68,6 @@ class FeatureClassification:
                 # Convert to float type.
                 feature = [float(i) for i in line]
                 features.append(feature)
-            print(len(features))
-            print(len(features[0]))
         return features
 
     def obtain_dataset_order(self):
@@ -52,13 +85,12 @@ class FeatureClassification:
                    - Labels: A list of integers where each integer is a label (1 for 'clone', 0 for 'non-clone').
              """
 
-        clone_features = self.feature_extraction_order(self.clonefeature_csv)
-        nonclone_features = self.feature_extraction_order(self.nonclonefeature_csv)
-        print('len:')
-        print(len(clone_features))
-        print(len(nonclone_features))
-        print(len(clone_features[0]))
-        print(len(nonclone_features[0]))
+        with self.metrics.timer('train_load_seconds'):
+            clone_features = self.feature_extraction_order(self.clonefeature_csv)
+            nonclone_features = self.feature_extraction_order(self.nonclonefeature_csv)
+        self.metrics.set_gauge('train_rows', len(clone_features), label='clone')
+        self.metrics.set_gauge('train_rows', len(nonclone_features), label='nonclone')
+        self.metrics.set_gauge('train_features', len(clone_features[0]) if clone_features else 0)
 
         Vectors = []
         Labels = []
@@ -69,6 +101,74 @@ class FeatureClassification:
 
         return Vectors, Labels
 
+    def load_dataset(self):
+        """
+            Loads the clone and non-clone binary feature files into one float32 feature matrix and a label vector.
+            The memory-mapped features are copied once, by the concatenation.
+
+            Returns:
+            tuple: The feature matrix and the labels (1 for 'clone', 0 for 'non-clone').
+        """
+        with self.metrics.timer('train_load_seconds'):
+            clone = load_feature_file(self.clonefeature_csv)
+            nonclone = load_feature_file(self.nonclonefeature_csv)
+            vectors = np.concatenate([self.select_features(clone['features'], clone['feature_indices']),
+                                      self.select_features(nonclone['features'], nonclone['feature_indices'])])
+        self.metrics.set_gauge('train_rows', len(clone['features']), label='clone')
+        self.metrics.set_gauge('train_rows', len(nonclone['features']), label='nonclone')
+        self.metrics.set_gauge('train_features', vectors.shape[1])
+        labels = np.concatenate([np.ones(len(clone['features']), dtype=np.int8),
+                                 np.zeros(len(nonclone['features']), dtype=np.int8)])
+        return vectors, labels
+
+    def select_features(self, vectors, file_indices=None, feature_indices=None):
+        """
+            Keeps the columns of the selected features.
+
+            Args:
+            vectors (np.ndarray): Feature rows.
+            file_indices (list, optional): The features the columns of vectors stand for, None for all 288.
+            feature_indices (list, optional): The features to keep, by default those of the classifier.
+
+            Returns:
+            np.ndarray: The rows restricted to the selected features, in ascending feature order.
+        """
+        columns = self.feature_columns(file_indices, feature_indices)
+        return vectors if columns is None else vectors[:, columns]
+
+    def feature_columns(self, file_indices=None, feature_indices=None):
+        """
+            Returns the positions of the selected features among the columns of a feature file, None
+            when all of its columns are selected.
+        """
+        feature_indices = self.feature_indices if feature_indices is None else feature_indices
+        if feature_indices is None or list(feature_indices) == file_indices:
+            return None
+        if file_indices is None:
+            return list(feature_indices)
+        missing = sorted(set(feature_indices) - set(file_indices))
+        if missing:
+            raise ValueError(f"Features {missing} were not computed for this feature file")
+        return [file_indices.index(feature) for feature in feature_indices]
+
+    def open_dataset(self):
+        """
+            Opens the clone and non-clone binary feature files for out-of-core training, without loading them.
+
+            Returns:
+            FeatureFiles: The dataset, whose labels are 1 for 'clone' and 0 for 'non-clone'.
+        """
+        if not (is_feature_file(self.clonefeature_csv) and is_feature_file(self.nonclonefeature_csv)):
+            raise ValueError("Out-of-core training needs binary feature files")
+        files = []
+        for path, label in ((self.clonefeature_csv, 1), (self.nonclonefeature_csv, 0)):
+            files.append((path, label, self.feature_columns(load_feature_file(path)['feature_indices'])))
+        dataset = FeatureFiles(files)
+        self.metrics.set_gauge('train_rows', int(dataset.labels.sum()), label='clone')
+        self.metrics.set_gauge('train_rows', len(dataset) - int(dataset.labels.sum()), label='nonclone')
+        self.metrics.set_gauge('train_features', dataset.n_features)
+        return dataset
+
     def random_features_order(self, vectors, labels):
         """
             Combines feature vectors with their corresponding labels, shuffles the combined list randomly,
@@ -90,74 +190,359 @@ class FeatureClassification:
             vec.append(lab)
             Vec_Lab.append(vec)
 
-        random.shuffle(Vec_Lab)
+        if self.seed is not None:
+            random.Random(self.seed).shuffle(Vec_Lab)
+        else:
+            random.shuffle(Vec_Lab)
 
         return [m[:-1] for m in Vec_Lab], [m[-1] for m in Vec_Lab]
 
-    def XGBOOST(self, X, Y):
+    def make_classifier(self):
+        """
+            Creates an untrained classifier with the configured training settings.
+        """
+        from xgboost import XGBClassifier
+        params = {'max_depth': 256, 'random_state': 0}
+        if self.tree_method is not None:
+            params['tree_method'] = self.tree_method
+        # Without nthread, a cpu_budget still bounds the threads, so that concurrent folds do not oversubscribe
+        nthread = self.nthread if self.nthread is not None else self.fold_nthread or self.cpu_budget
+        if nthread is not None:
+            params['n_jobs'] = nthread
+        if self.early_stopping_rounds is not None:
+            params['early_stopping_rounds'] = self.early_stopping_rounds
+            params['eval_metric'] = 'logloss'
+        return XGBClassifier(**params)
+
+    def fit_external(self, X, train_index, eval_index=None):
+        """
+            Trains the classifier of make_classifier on rows of a FeatureFiles dataset out of core.
+
+            Returns:
+            XGBClassifier: The classifier holding the trained booster.
+        """
+        from xgboost import XGBClassifier
+        from Train.external_memory import train_external
+        clf = self.make_classifier()
+        params = {key: value for key, value in clf.get_xgb_params().items() if value is not None}
+        params['seed'] = params.pop('random_state', 0)
+        params['nthread'] = params.pop('n_jobs', self.cpu_budget)
+        booster = train_external(X, train_index, params, clf.get_num_boosting_rounds(), self.memory_budget,
+                                 eval_index, self.early_stopping_rounds, self.cache_dir)
+        if eval_index is not None:
+            # Keep the trees up to the best iteration, like XGBClassifier does for prediction
+            booster = booster[:booster.best_iteration + 1]
+        model = XGBClassifier()
+        model.load_model(booster.save_raw('ubj'))
+        return model
+
+    def fit_fold(self, fold, X, Y, train_index, test_index):
+        """
+            Trains and evaluates the model of one cross-validation fold.
+
+            Args:
+            fold (int): Number of the fold.
+            X (array-like|FeatureFiles): The feature matrix, or the feature files to train on out of core.
+            Y (array-like): The labels.
+            train_index (np.ndarray): Rows to train on; with early stopping a slice of them is held out.
+            test_index (np.ndarray): Rows to evaluate on.
+
+            Returns:
+            tuple: The trained classifier and a report of its scores, training time and size.
+        """
+        from sklearn.metrics import f1_score, precision_score, recall_score
+        from sklearn.model_selection import train_test_split
+        start = time.time()
+        fit_index, eval_index = train_index, None
+        if self.early_stopping_rounds is not None:
+            stratify = Y[train_index] if self.stratified else None
+            fit_index, eval_index = train_test_split(train_index, test_size=self.validation_fraction,
+                                                     random_state=fold, stratify=stratify)
+        if isinstance(X, FeatureFiles):
+            clf = self.fit_external(X, fit_index, eval_index)
+        else:
+            clf = self.make_classifier()
+            if eval_index is not None:
+                clf.fit(X[fit_index], Y[fit_index], eval_set=[(X[eval_index], Y[eval_index])], verbose=False)
+            else:
+                clf.fit(X[train_index], Y[train_index])
+        train_seconds = time.time() - start
+        self.metrics.observe('train_fold_seconds', train_seconds)
+
+        if isinstance(X, FeatureFiles):
+            from Train.external_memory import predict_external
+            # Out-of-core predictions come in ascending row order
+            test_index = np.sort(test_index)
+            y_pred = (predict_external(clf.get_booster(), X, test_index, self.memory_budget) > 0.5).astype(int)
+        else:
+            y_pred = clf.predict(X[test_index])
+        test_Y = Y[test_index]
+        report = {'fold': fold,
+                  'f1': f1_score(y_true=test_Y, y_pred=y_pred),
+                  'precision': precision_score(y_true=test_Y, y_pred=y_pred),
+                  'recall': recall_score(y_true=test_Y, y_pred=y_pred),
+                  'train_seconds': train_seconds,
+                  'trees': clf.get_booster().num_boosted_rounds(),
+                  'model_bytes': len(clf.get_booster().save_raw())}
+        print("Fold {fold}: F1 {f1:.4f}, {train_seconds:.2f} s, {trees} trees, {model_bytes} bytes".format(**report))
+        return clf, report
+
+    def fold_path(self, fold):
+        return os.path.join(self.checkpoint_dir, f'fold_{fold}.pkl')
+
+    def folds_fingerprint(self, X, Y, order):
+        """
+            Fingerprints what the folds of XGBOOST depend on: the shape of the features, the selected
+            features, the classifier and cross-validation settings, the seed, and the labels and row order
+            that the folds are cut from.
+        """
+        params = {key: value for key, value in self.make_classifier().get_xgb_params().items()
+                  if key not in ('n_jobs', 'nthread')}
+        shape = [len(X), X.n_features if isinstance(X, FeatureFiles) else int(np.shape(X)[1])]
+        digest = hashlib.sha256(np.ascontiguousarray(order, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(Y, dtype=np.int64).tobytes())
+        settings = {'shape': shape, 'feature_indices': self.feature_indices, 'params': params, 'seed': self.seed,
+                    'stratified': self.stratified, 'validation_fraction': self.validation_fraction,
+                    'memory_budget': self.memory_budget, 'order': digest.hexdigest()}
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def load_folds(self, fingerprint):
+        """
+            Loads the folds saved in the checkpoint directory by a run with the same fingerprint. Folds of
+            any other run, e.g. on other features, are removed instead of being mixed into this one.
+
+            Returns:
+            dict: The (classifier, report) of every completed fold by its number.
+        """
+        import joblib
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        fingerprint_path = os.path.join(self.checkpoint_dir, 'fingerprint.json')
+        saved = None
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path, 'r') as file:
+                saved = json.load(file).get('fingerprint')
+        files = [file for file in os.listdir(self.checkpoint_dir) if file.startswith('fold_')]
+        if saved != fingerprint:
+            if files:
+                print("Discarding {} checkpointed folds of a run with other data or settings".format(len(files)))
+            for file in files:
+                os.remove(os.path.join(self.checkpoint_dir, file))
+            with open(fingerprint_path + '.tmp', 'w') as file:
+                json.dump({'fingerprint': fingerprint}, file)
+            os.replace(fingerprint_path + '.tmp', fingerprint_path)
+            return {}
+        results = {}
+        for file in files:
+            if file.endswith('.pkl'):
+                clf, report = joblib.load(os.path.join(self.checkpoint_dir, file))
+                results[report['fold']] = clf, report
+        return results
+
+    def checkpointed_fold(self, fold, X, Y, train_index, test_index):
+        """
+            Trains a fold with fit_fold and saves it to the checkpoint directory, if any.
+        """
+        clf, report = self.fit_fold(fold, X, Y, train_index, test_index)
+        if self.checkpoint_dir is not None:
+            import joblib
+            path = self.fold_path(fold)
+            joblib.dump((clf, report), path + '.tmp')
+            os.replace(path + '.tmp', path)
+        return clf, report
+
+    def XGBOOST(self, X, Y, order=None):
         """
             Performs a 10-fold cross-validation on the given dataset using an XGBoost classifier,
             evaluates the model using F1 score, precision, and recall, and saves the best model based
             on the highest F1 score obtained.
 
+            With a cpu_budget, cpu_budget // nthread folds are trained concurrently in threads (XGBoost
+            releases the GIL while training, and the folds share X instead of copying it to processes).
+            Without nthread, up to cpu_budget folds run concurrently and share the cpu_budget equally.
+            The report of every fold is kept in fold_reports.
+
             Args:
-            X (array-like): Feature matrix where each row represents a sample and each column represents a feature.
+            X (array-like|FeatureFiles): Feature matrix where each row represents a sample and each column
+                                         represents a feature, or the feature files to train on out of core.
             Y (array-like): Corresponding labels for the samples in X.
+            order (np.ndarray, optional): A permutation of the rows that the folds are cut from,
+                                          so that X and Y can be shuffled without being copied.
 
             Returns:
             list: A list containing the mean F1 score, mean precision, and mean recall from the 10 folds.
         """
+        import joblib
+        from sklearn.model_selection import KFold, StratifiedKFold
         print("begin")
-        kf = KFold(n_splits=10)
-        F1s = []
-        Precisions = []
-        Recalls = []
+        Y = np.asarray(Y)
+        if order is None:
+            order = np.arange(len(Y))
+        if self.stratified:
+            splits = StratifiedKFold(n_splits=10).split(order, Y[order])
+        else:
+            splits = KFold(n_splits=10).split(order)
+        folds = [(fold, X, Y, order[train_position], order[test_position])
+                 for fold, (train_position, test_position) in enumerate(splits)]
+
+        results = {}
+        if self.checkpoint_dir is not None:
+            results = self.load_folds(self.folds_fingerprint(X, Y, order))
+            if results:
+                print("Resuming with {} completed folds".format(len(results)))
+        folds = [args for args in folds if args[0] not in results]
+
+        concurrent_folds = 1
+        # Out-of-core folds are trained one at a time, each with the whole memory budget and cpu_budget threads
+        if self.cpu_budget is not None and not isinstance(X, FeatureFiles):
+            concurrent_folds = max(1, min(len(folds), self.cpu_budget // (self.nthread or 1)))
+        if self.cpu_budget is not None and self.nthread is None:
+            self.fold_nthread = max(1, self.cpu_budget // concurrent_folds)
+        if concurrent_folds > 1:
+            with ThreadPoolExecutor(concurrent_folds) as executor:
+                for clf, report in executor.map(lambda args: self.checkpointed_fold(*args), folds):
+                    results[report['fold']] = clf, report
+        else:
+            for args in folds:
+                clf, report = self.checkpointed_fold(*args)
+                results[report['fold']] = clf, report
+        results = [results[fold] for fold in sorted(results)]
 
         best_f1 = 0  # Initialize the highest F1 score
         best_model = None  # Initialize storage variable for the best model
-
-        for train_index, test_index in kf.split(X):
-            train_X, train_Y = X[train_index], Y[train_index]
-            test_X, test_Y = X[test_index], Y[test_index]
-
-            clf = XGBClassifier(max_depth=256, random_state=0)
-            clf.fit(train_X, train_Y)
-
-            y_pred = clf.predict(test_X)
-            f1 = f1_score(y_true=test_Y, y_pred=y_pred)
-            precision = precision_score(y_true=test_Y, y_pred=y_pred)
-            recall = recall_score(y_true=test_Y, y_pred=y_pred)
-
-            F1s.append(f1)
-            Precisions.append(precision)
-            Recalls.append(recall)
-
-            # Check if it's the best model and update the highest F1 score and save the model
-            if f1 > best_f1:
-                best_f1 = f1
+        # Check fold by fold if it's the best model and update the highest F1 score
+        for clf, report in results:
+            if report['f1'] > best_f1:
+                best_f1 = report['f1']
                 best_model = clf
+        self.fold_reports = [report for _, report in results]
+        F1s = [report['f1'] for report in self.fold_reports]
+        Precisions = [report['precision'] for report in self.fold_reports]
+        Recalls = [report['recall'] for report in self.fold_reports]
 
-        # Save the best-performing model
+        # Save the best-performing model, with the features it expects
         if best_model is not None:
-            joblib.dump(best_model, 'best_model.pkl')
+            joblib.dump(best_model, self.model_path)
+            save_model_features(self.model_path, self.feature_indices)
+        self.best_model = best_model
 
         print('F1.Precision.Recalls:')
         print(np.mean(F1s), np.mean(Precisions), np.mean(Recalls))
         return [np.mean(F1s), np.mean(Precisions), np.mean(Recalls)]
 
     def run(self):
+        if self.memory_budget is not None:
+            # The folds are cut from row indices into the feature files, which stay on disk
+            dataset = self.open_dataset()
+            order = np.random.RandomState(self.seed).permutation(len(dataset))
+            target = self.XGBOOST(dataset, dataset.labels, order=order)
+            print(target)
+            return target
+
+        if is_feature_file(self.clonefeature_csv) and is_feature_file(self.nonclonefeature_csv):
+            # Binary feature files are shuffled through an index permutation instead of rebuilding lists
+            vectors, labels = self.load_dataset()
+            target = self.XGBOOST(vectors, labels, order=np.random.RandomState(self.seed).permutation(len(labels)))
+            print(target)
+            return target
+
         Vectors, Labels = self.obtain_dataset_order()
         vectors, labels = self.random_features_order(Vectors, Labels)
 
-        print('vectors:')
-        print(len(vectors))
-        print('labels:')
-        print(len(labels))
-        vectors = np.array(vectors)
+        vectors = self.select_features(np.array(vectors))
         labels = np.array(labels)
 
         target = self.XGBOOST(vectors, labels)
         print(target)
+        return target
+
+    def load_all_features(self):
+        """
+            Loads the clone and non-clone feature files with all 288 features, whatever features the
+            classifier trains on.
+
+            Returns:
+            tuple: The feature matrix and the labels (1 for 'clone', 0 for 'non-clone').
+        """
+        feature_indices, self.feature_indices = self.feature_indices, None
+        try:
+            if is_feature_file(self.clonefeature_csv) and is_feature_file(self.nonclonefeature_csv):
+                vectors, labels = self.load_dataset()
+            else:
+                Vectors, Labels = self.obtain_dataset_order()
+                vectors, labels = np.array(Vectors), np.array(Labels)
+        finally:
+            self.feature_indices = feature_indices
+        if vectors.shape[1] != 288:
+            raise ValueError("Ranking the features needs feature files with all 288 features")
+        return vectors, labels
+
+    def importance_ranking(self, vectors=None, labels=None):
+        """
+            Ranks the 288 features by the importances of a classifier trained on all of them, once and
+            without cross-validation.
+
+            Args:
+            vectors (np.ndarray, optional): Rows of all 288 features, by default those of the feature files.
+            labels (np.ndarray, optional): The label of every row.
+
+            Returns:
+            list: Feature indices from most to least important.
+        """
+        if vectors is None:
+            vectors, labels = self.load_all_features()
+        clf = self.make_classifier()
+        clf.set_params(early_stopping_rounds=None)
+        with self.metrics.timer('train_ranking_seconds'):
+            clf.fit(vectors, labels)
+        return model_ranking(clf)
+
+    def top_k_report(self, ks, ranking=None):
+        """
+            Trains on the top k features of a ranking for every k and reports accuracy and speed, so that
+            the feature count can be traded against throughput. The feature files must hold all 288 features.
+
+            Args:
+            ks (iterable): The feature counts to evaluate.
+            ranking (list, optional): Feature indices from most to least important, e.g. model_ranking().
+                                      By default the importances of a model trained on all features are used.
+
+            Returns:
+            list: One dict per k with its features, F1, precision, recall, training time and prediction throughput,
+                  which is None when no fold scored an F1 above 0.
+        """
+        vectors, labels = self.load_all_features()
+        if ranking is None:
+            ranking = self.importance_ranking(vectors, labels)
+
+        order = np.random.permutation(len(labels))
+        model_path, selected = self.model_path, self.feature_indices
+        stem, extension = os.path.splitext(model_path)
+        results = []
+        try:
+            for k in ks:
+                feature_indices = top_k(ranking, k)
+                self.feature_indices = feature_indices
+                # Every k keeps its own model, e.g. best_model_top32.pkl
+                self.model_path = f'{stem}_top{k}{extension}'
+                subset = np.ascontiguousarray(vectors[:, feature_indices])
+                start = time.time()
+                f1, precision, recall = self.XGBOOST(subset, labels, order=order)
+                train_seconds = time.time() - start
+                # No model is kept when no fold scored an F1 above 0, e.g. at a small k
+                rows_per_s = None
+                if self.best_model is not None:
+                    start = time.perf_counter()
+                    self.best_model.predict_proba(subset)
+                    predict_seconds = time.perf_counter() - start
+                    rows_per_s = len(labels) / predict_seconds if predict_seconds > 0 else float('inf')
+                results.append({'k': len(feature_indices), 'feature_indices': feature_indices, 'f1': f1,
+                                'precision': precision, 'recall': recall, 'train_seconds': train_seconds,
+                                'predict_rows_per_s': rows_per_s})
+                print({key: value for key, value in results[-1].items() if key != 'feature_indices'})
+        finally:
+            # Later runs of this classifier train on the selection it was created with
+            self.model_path, self.feature_indices = model_path, selected
+        return results
 
 
 if __name__ == '__main__':
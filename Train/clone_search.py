@@ -0,0 +1,234 @@
+import argparse
+import csv
+import time
+from collections import defaultdict
+from itertools import combinations
+import numpy as np
+from Train.get_distance import DistanceCalculator
+from Train.vocabulary import MATRIX_COLS
+from Train.model_export import load_model
+from Train.cascade import CascadeFilter, existing_pairs, score_pairs
+
+
+class CloneSearch:
+    """
+        Finds clones among all methods of a corpus without scoring all N^2 pairs. Every method's
+        transition matrix is summarized by a profile (how much transition mass each of the 72 columns
+        receives and which of the 493 rows are used), the profile is hashed into a random-hyperplane
+        (SimHash) signature, and only methods that share a signature band become candidate pairs.
+        Candidates are then scored with the usual distance features and classifier.
+    """
+
+    def __init__(self, npy_path='./npy/', backend='npy', model_path='best_model.pkl', bands=8, band_bits=8,
+                 max_bucket=1000, seed=0):
+        """
+            Args:
+            npy_path (str): The matrices of the corpus, as written by JavaSyntaxMatrixGenerator.
+            backend (str): 'npy', 'sparse' or 'store', as for DistanceCalculator.
+            model_path (str): The classifier saved by FeatureClassification.XGBOOST or its export by model_export,
+                              None to only generate candidates.
+            bands (int): Number of signature bands; methods sharing any band are candidates. More bands raise recall.
+            band_bits (int): Hyperplanes per band; more bits make a band more selective.
+            max_bucket (int): Buckets with more methods than this are skipped as uninformative.
+            seed (int): Seed of the random hyperplanes.
+        """
+        self.model, feature_indices = load_model(model_path) if model_path is not None else (None, None)
+        self.calculator = DistanceCalculator(None, npy_path, backend, feature_indices=feature_indices)
+        self.bands = bands
+        self.band_bits = band_bits
+        self.max_bucket = max_bucket
+        self.seed = seed
+        self.ids = []
+        self.profiles = None
+        self.signatures = None
+        # Prefilter of the candidates set by calibrate_cascade, None to score all of them
+        self.cascade = None
+        self.rejected = 0
+
+    def profile(self, matrix):
+        column_mass = np.asarray(matrix.sum(axis=0)).ravel()
+        used_rows = np.asarray(matrix.sum(axis=1)).ravel() > 0
+        total = column_mass.sum()
+        return np.concatenate([column_mass / total if total else column_mass, used_rows / max(used_rows.sum(), 1)])
+
+    def index(self):
+        """
+            Loads every matrix once, computes its profile and its signature bits.
+
+            Returns:
+            int: The number of indexed methods.
+        """
+        self.calculator.open_matrices()
+        self.ids = sorted(self.calculator.matrix_ids())
+        self.profiles = np.array([self.profile(self.calculator.load_matrix(name)) for name in self.ids])
+        self.signatures = self.sign(self.bands, self.band_bits)
+        return len(self.ids)
+
+    def sign(self, bands, band_bits):
+        """
+            Hashes the centered profiles with bands * band_bits random hyperplanes.
+        """
+        if not len(self.ids):
+            return np.zeros((0, bands * band_bits), dtype=bool)
+        rng = np.random.default_rng(self.seed)
+        centered = self.profiles - self.profiles.mean(axis=0)
+        hyperplanes = rng.standard_normal((centered.shape[1], bands * band_bits))
+        return centered @ hyperplanes > 0
+
+    def candidates(self, signatures=None, bands=None, band_bits=None):
+        """
+            Returns the candidate pairs: methods whose signatures agree on all bits of at least one band.
+
+            Returns:
+            set: (id1, id2) tuples with id1 < id2.
+        """
+        signatures = self.signatures if signatures is None else signatures
+        bands = self.bands if bands is None else bands
+        band_bits = self.band_bits if band_bits is None else band_bits
+        pairs = set()
+        for band in range(bands):
+            buckets = defaultdict(list)
+            keys = np.packbits(signatures[:, band * band_bits:(band + 1) * band_bits], axis=1)
+            for position, key in enumerate(keys):
+                buckets[key.tobytes()].append(position)
+            for members in buckets.values():
+                if len(members) > self.max_bucket:
+                    continue
+                for first, second in combinations(members, 2):
+                    pairs.add((self.ids[first], self.ids[second]))
+        return pairs
+
+    def score(self, pairs, batch_size=256):
+        """
+            Computes the distance features of pairs and returns their clone probabilities. With a
+            cascade, pairs its first stage rejects score 0 and are counted in rejected.
+
+            Returns:
+            np.ndarray: The probability of every pair, in the given order.
+        """
+        if self.model is None:
+            raise ValueError("Scoring pairs needs a model, this CloneSearch was created with model_path=None")
+        probabilities, scored = score_pairs(self.calculator, self.model, list(pairs), self.cascade, batch_size)
+        self.rejected = int(np.sum(~scored))
+        return probabilities
+
+    def calibrate_cascade(self, clone_csv, nonclone_csv, stage='sketch', k=8, weight_path=None,
+                          target_recall=0.99):
+        """
+            Puts a CascadeFilter in front of the model: candidates it rejects score 0 without their full
+            features being computed. The sketches are taken from the profiles of the index.
+
+            Args:
+            clone_csv (str): Known clone pairs to calibrate the threshold on, e.g. Clone_type/T1.csv.
+            nonclone_csv (str): Known non-clone pairs, e.g. Clone_type/T1_noclone.csv.
+            stage (str): 'sketch' or 'features', as for CascadeFilter.
+
+            Returns:
+            dict: The calibration report of CascadeFilter.calibrate.
+        """
+        if self.profiles is None:
+            self.index()
+        self.cascade = CascadeFilter(self.calculator, stage, k, weight_path, target_recall)
+        self.cascade.sketches = {name: profile[:MATRIX_COLS].astype(np.float32)
+                                 for name, profile in zip(self.ids, self.profiles)}
+        return self.cascade.calibrate(existing_pairs(self.calculator, clone_csv),
+                                      existing_pairs(self.calculator, nonclone_csv))
+
+    def search(self, threshold=0.5, out_csv=None):
+        """
+            Generates candidates, scores them and keeps the pairs classified as clones. Without a model,
+            every candidate is returned unscored, with None as its probability.
+
+            Args:
+            threshold (float): Minimum clone probability of a reported pair.
+            out_csv (str, optional): Writes id1, id2, probability of every reported clone.
+
+            Returns:
+            tuple: The list of (id1, id2, probability) clones and a report of the pairs evaluated.
+        """
+        if self.signatures is None:
+            self.index()
+        start = time.time()
+        pairs = sorted(self.candidates())
+        if self.model is None:
+            clones = [(id1, id2, None) for id1, id2 in pairs]
+        else:
+            probabilities = self.score(pairs)
+            clones = [(id1, id2, float(p)) for (id1, id2), p in zip(pairs, probabilities) if p >= threshold]
+        if out_csv is not None:
+            with open(out_csv, 'w', newline='') as file:
+                csv.writer(file).writerows(clones)
+        n = len(self.ids)
+        report = {'methods': n, 'all_pairs': n * (n - 1) // 2, 'pairs_evaluated': len(pairs),
+                  'clones': len(clones) if self.model is not None else None, 'seconds': time.time() - start}
+        if self.cascade is not None:
+            report['cascade_rejected'] = self.rejected
+        print(report)
+        return clones, report
+
+    def read_truth(self, truth_csv):
+        """
+            Reads known clone pairs whose two methods are both indexed, e.g. from Clone_type/T1.csv.
+        """
+        indexed = set(self.ids)
+        truth = set()
+        with open(truth_csv, 'r') as file:
+            for r in csv.reader(file):
+                if len(r) < 2:
+                    continue
+                f1, f2 = r[0].split('.java')[0], r[1].split('.java')[0]
+                if f1 in indexed and f2 in indexed and f1 != f2:
+                    truth.add((min(f1, f2), max(f1, f2)))
+        return truth
+
+    def recall_tradeoff(self, truth_csv, settings=((4, 16), (8, 8), (16, 8), (16, 4), (32, 4))):
+        """
+            Reports candidate recall against known clone pairs and the number of pairs evaluated for
+            several (bands, band_bits) settings, so that the trade-off can be tuned.
+
+            Args:
+            truth_csv (str): A CSV of known clone pairs.
+            settings (iterable): (bands, band_bits) tuples to evaluate.
+
+            Returns:
+            list: One dict per setting with its recall, pairs evaluated and fraction of all pairs.
+        """
+        if self.profiles is None:
+            self.index()
+        truth = self.read_truth(truth_csv)
+        n = len(self.ids)
+        all_pairs = max(n * (n - 1) // 2, 1)
+        results = []
+        for bands, band_bits in settings:
+            pairs = self.candidates(self.sign(bands, band_bits), bands, band_bits)
+            found = sum(1 for pair in truth if pair in pairs)
+            results.append({'bands': bands, 'band_bits': band_bits, 'pairs_evaluated': len(pairs),
+                            'fraction_of_all_pairs': len(pairs) / all_pairs,
+                            'recall': found / len(truth) if truth else float('nan')})
+            print(results[-1])
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find clones among all methods of a corpus via candidate indexing.')
+    parser.add_argument('--npy', default='./npy/')
+    parser.add_argument('--backend', default='npy')
+    parser.add_argument('--model', default='best_model.pkl')
+    parser.add_argument('--bands', type=int, default=8)
+    parser.add_argument('--band-bits', type=int, default=8)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--out', default='clone_search_results.csv')
+    parser.add_argument('--truth', default=None, help='CSV of known clone pairs to report the recall trade-off on')
+    parser.add_argument('--cascade', default=None, choices=('sketch', 'features'),
+                        help='prefilter the candidates before the full features and model')
+    parser.add_argument('--calibrate', default='Clone_type/T1.csv,Clone_type/T1_noclone.csv',
+                        help='clone CSV,non-clone CSV the cascade threshold is calibrated on')
+    args = parser.parse_args()
+
+    searcher = CloneSearch(args.npy, args.backend, args.model, args.bands, args.band_bits)
+    searcher.index()
+    if args.cascade is not None:
+        searcher.calibrate_cascade(*args.calibrate.split(','), stage=args.cascade)
+    if args.truth is not None:
+        searcher.recall_tradeoff(args.truth)
+    searcher.search(args.threshold, args.out)
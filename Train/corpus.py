@@ -0,0 +1,208 @@
+import fnmatch
+import os
+import tarfile
+import zipfile
+from collections import OrderedDict
+
+# Archives whose members are read in place of extracting them to disk
+ARCHIVE_SUFFIXES = ('.zip', '.jar', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+# Separates an archive from the path of a member in it, e.g. BCB.tar.gz!/default/10601019.java
+MEMBER_SEPARATOR = '!/'
+# Archives kept open by read_bytes for random access to their members
+MAX_OPEN_ARCHIVES = 4
+
+_open_archives = OrderedDict()
+_open_archives_pid = None
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def split_member(path):
+    """
+        Splits the path of an archive member into the archive path and the member name, or returns
+        (path, None) for a plain file.
+    """
+    archive, separator, member = path.partition(MEMBER_SEPARATOR)
+    return (archive, member) if separator else (path, None)
+
+
+def open_archive(archive):
+    """
+        Returns an open ZipFile or TarFile of an archive, shared by the calls of this process.
+    """
+    global _open_archives_pid
+    if _open_archives_pid != os.getpid():
+        # Handles inherited from a parent process share its file offsets, so every process opens its own
+        _open_archives.clear()
+        _open_archives_pid = os.getpid()
+    handle = _open_archives.get(archive)
+    if handle is None:
+        handle = zipfile.ZipFile(archive) if zipfile.is_zipfile(archive) else tarfile.open(archive, 'r:*')
+        _open_archives[archive] = handle
+        if len(_open_archives) > MAX_OPEN_ARCHIVES:
+            _open_archives.popitem(last=False)[1].close()
+    _open_archives.move_to_end(archive)
+    return handle
+
+
+def read_bytes(path):
+    """
+        Reads a plain file, or a member of an archive given as archive!/member.
+    """
+    archive, member = split_member(path)
+    if member is None:
+        with open(path, 'rb') as file:
+            return file.read()
+    handle = open_archive(archive)
+    if isinstance(handle, zipfile.ZipFile):
+        return handle.read(member)
+    return handle.extractfile(member).read()
+
+
+def decode_source(data):
+    """
+        Decodes Java source bytes like open(path, encoding='utf-8').read() does, newlines included.
+    """
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def read_source(path):
+    """
+        Reads the Java source of a plain file or of an archive member.
+    """
+    if split_member(path)[1] is None:
+        with open(path, encoding='utf-8') as file:
+            return file.read()
+    return decode_source(read_bytes(path))
+
+
+class CorpusReader:
+    """
+        Lazily lists the files of a corpus: a directory tree walked with os.scandir, whose directory
+        entries tell files from directories without a stat call each, or a single zip or tar(.gz)
+        archive, whose members are read without extracting them. Archives inside a directory are listed
+        as files unless archives is set. Members are named archive!/member wherever a file path is expected.
+
+        Include and exclude filters are fnmatch patterns. A pattern with a '/' is matched against the path
+        relative to the corpus. Otherwise an include pattern is matched against the file name and an exclude
+        pattern against every directory and file name, and excluded directories are not descended into.
+    """
+
+    def __init__(self, path, include=None, exclude=None, archives=False):
+        """
+            Args:
+            path (str): A directory, an archive or a single file.
+            include (list, optional): Patterns of the files to list, e.g. ['*.java']; None lists every file.
+            exclude (list, optional): Patterns of the files and directories to skip, e.g. ['test', '*Test.java'].
+            archives (bool): Also list the members of the archives inside a directory instead of the
+                             archives themselves. A corpus path that is an archive is always expanded.
+        """
+        self.path = path
+        self.include = list(include) if include else None
+        self.exclude = list(exclude) if exclude else []
+        self.archives = archives
+
+    @staticmethod
+    def matches(patterns, relative, any_component=False):
+        names = relative.split('/') if any_component else [relative.rsplit('/', 1)[-1]]
+        return any(fnmatch.fnmatchcase(relative, pattern) if '/' in pattern else
+                   any(fnmatch.fnmatchcase(name, pattern) for name in names) for pattern in patterns)
+
+    def selected(self, relative):
+        return ((self.include is None or self.matches(self.include, relative)) and
+                not self.matches(self.exclude, relative, any_component=True))
+
+    def entries(self):
+        """
+            Walks the directory tree depth-first and yields every file that is not excluded, with its
+            path relative to the corpus and its directory entry, which caches the type of the file.
+
+            Yields:
+            tuple: (path, relative path, os.DirEntry or None for a corpus that is a single file).
+        """
+        if not os.path.isdir(self.path):
+            yield self.path, os.path.basename(self.path), None
+            return
+        stack = [(self.path, '')]
+        while stack:
+            directory, prefix = stack.pop()
+            with os.scandir(directory) as scanner:
+                subdirectories = []
+                for entry in scanner:
+                    relative = prefix + entry.name
+                    if self.matches(self.exclude, relative):
+                        continue
+                    if entry.is_dir():
+                        subdirectories.append((entry.path, relative + '/'))
+                    else:
+                        yield entry.path, relative, entry
+            # Visit the subdirectories in listing order, like a recursive walk would
+            stack.extend(reversed(subdirectories))
+
+    def members(self, archive, prefix):
+        """
+            Yields the selected members of an archive, reading a tar archive as one stream so that a
+            compressed archive is decompressed once. A member can only be read until the next one is yielded.
+
+            Yields:
+            tuple: (archive!/member, a function returning its bytes, its size, its modification time).
+        """
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as handle:
+                for info in handle.infolist():
+                    if not info.is_dir() and self.selected(prefix + info.filename):
+                        yield (archive + MEMBER_SEPARATOR + info.filename, lambda info=info: handle.read(info),
+                               info.file_size, info.date_time)
+        else:
+            with tarfile.open(archive, 'r|*') as handle:
+                for info in handle:
+                    if info.isfile() and self.selected(prefix + info.name):
+                        yield (archive + MEMBER_SEPARATOR + info.name,
+                               lambda info=info: handle.extractfile(info).read(), info.size, info.mtime)
+
+    def files(self):
+        """
+            Yields every selected file and archive member as soon as it is found.
+
+            Yields:
+            tuple: (path, None, os.DirEntry or None) for a plain file and
+                   (archive!/member, a function returning its bytes, (size, modification time)) for a member.
+        """
+        for path, relative, entry in self.entries():
+            if is_archive(path) and (self.archives or entry is None):
+                # Members of a corpus that is itself an archive are matched by their path in the archive
+                prefix = relative + '/' if entry is not None else ''
+                for member, read, size, mtime in self.members(path, prefix):
+                    yield member, read, (size, mtime)
+            elif self.selected(relative):
+                yield path, None, entry
+
+    def sources(self):
+        """
+            Yields the files of the corpus as soon as they are found, for a consumer such as
+            JavaSyntaxMatrixGenerator.allmain to start converting before the listing is complete.
+
+            Yields:
+            tuple: (path, None) for a plain file, which the consumer reads itself, and
+                   (archive!/member, bytes) for an archive member, which is only readable while listing.
+        """
+        for path, read, _ in self.files():
+            yield path, read() if read is not None else None
+
+    def stats(self):
+        """
+            Yields the path, size and modification time of every file, from the directory entries and
+            archive headers without reading any content, e.g. to fingerprint the corpus.
+        """
+        for path, read, entry in self.files():
+            if read is not None:
+                yield (path,) + entry
+            else:
+                stat = entry.stat() if entry is not None else os.stat(path)
+                yield path, stat.st_size, stat.st_mtime_ns
+
+    def __iter__(self):
+        for path, _, _ in self.files():
+            yield path
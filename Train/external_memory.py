@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import xgboost
+
+# Share of the memory budget a chunk of float32 rows may take. The rest covers the copy with the selected
+# columns, the quantized page XGBoost builds from the chunk and the page it reads back from its cache.
+CHUNK_SHARE = 4
+
+
+def chunk_rows(memory_budget, n_features):
+    """
+        Returns the number of rows per chunk that keeps the data handed to XGBoost within memory_budget
+        bytes. XGBoost's own working memory, its quantile sketch and histogram buffers, comes on top but
+        does not grow with the number of rows.
+    """
+    rows = memory_budget // (CHUNK_SHARE * 4 * max(n_features, 1))
+    if rows < 1:
+        raise ValueError(f"A memory budget of {memory_budget} bytes cannot hold a chunk of {n_features} features")
+    return int(rows)
+
+
+class FeatureChunks(xgboost.DataIter):
+    """
+        Feeds the rows of a FeatureFiles dataset at the given indices to XGBoost a chunk at a time.
+        The indices are visited in ascending order, so the memory-mapped files are read front to back.
+    """
+
+    def __init__(self, dataset, indices, rows_per_chunk, cache_prefix):
+        self.dataset = dataset
+        self.indices = np.sort(indices)
+        self.rows_per_chunk = rows_per_chunk
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix, release_data=True)
+
+    def next(self, input_data):
+        if self.position >= len(self.indices):
+            return False
+        indices = self.indices[self.position:self.position + self.rows_per_chunk]
+        self.position += self.rows_per_chunk
+        input_data(data=self.dataset.rows(indices), label=self.dataset.labels[indices])
+        return True
+
+    def reset(self):
+        self.position = 0
+
+
+def train_external(dataset, train_index, params, num_boost_round, memory_budget, eval_index=None,
+                   early_stopping_rounds=None, cache_dir=None):
+    """
+        Trains a booster on the rows of dataset at train_index through XGBoost's external memory:
+        the quantile sketch and the quantized pages are built from chunks, and the pages are cached
+        on disk instead of in memory.
+
+        Args:
+        dataset (FeatureFiles): The feature files.
+        train_index (np.ndarray): Global indices of the training rows.
+        params (dict): Booster parameters; the tree method is always 'hist'.
+        num_boost_round (int): Number of trees.
+        memory_budget (int): Bytes that chunks and cached pages may take.
+        eval_index (np.ndarray, optional): Rows to stop early on.
+        early_stopping_rounds (int, optional): Stop once the loss on eval_index stalls for this many rounds.
+        cache_dir (str, optional): Directory for the page cache, by default a temporary directory.
+
+        Returns:
+        xgboost.Booster: The trained booster.
+    """
+    rows_per_chunk = chunk_rows(memory_budget, dataset.n_features)
+    directory = tempfile.mkdtemp(prefix='amainplus_extmem_', dir=cache_dir)
+    matrices = []
+    try:
+        matrices.append(xgboost.ExtMemQuantileDMatrix(
+            FeatureChunks(dataset, train_index, rows_per_chunk, os.path.join(directory, 'train')),
+            nthread=params.get('nthread')))
+        if eval_index is not None:
+            matrices.append(xgboost.ExtMemQuantileDMatrix(
+                FeatureChunks(dataset, eval_index, rows_per_chunk, os.path.join(directory, 'eval')), ref=matrices[0],
+                nthread=params.get('nthread')))
+        evals = [(matrices[1], 'validation')] if eval_index is not None else []
+        return xgboost.train(dict(params, tree_method='hist'), matrices[0], num_boost_round=num_boost_round,
+                             evals=evals, early_stopping_rounds=early_stopping_rounds if evals else None,
+                             verbose_eval=False)
+    finally:
+        # The matrices remove their cache pages when they are freed, before the directory goes
+        evals = None
+        matrices.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def predict_external(booster, dataset, index, memory_budget):
+    """
+        Predicts the clone probability of the rows of dataset at index, a chunk at a time.
+
+        Returns:
+        np.ndarray: The probabilities, in the ascending order of index.
+    """
+    rows_per_chunk = chunk_rows(memory_budget, dataset.n_features)
+    index = np.sort(index)
+    probabilities = np.empty(len(index), dtype=np.float32)
+    for start in range(0, len(index), rows_per_chunk):
+        rows = dataset.rows(index[start:start + rows_per_chunk])
+        probabilities[start:start + len(rows)] = booster.inplace_predict(rows)
+    return probabilities
@@ -0,0 +1,236 @@
+import numpy as np
+import csv
+import json
+import os
+
+
+class CsvFeatureWriter:
+    """
+        Writes distance features as CSV text, optionally with a CSV of the (f1, f2) ids of every row.
+    """
+
+    def __init__(self, path, ids_path=None, position=None):
+        """
+            Args:
+            path (str): Path of the feature CSV.
+            ids_path (str, optional): Path of the CSV of pair ids.
+            position (dict, optional): A position returned by position() to resume from; later output is dropped.
+        """
+        mode = 'r+' if position else 'w'
+        position = position or {'bytes': 0, 'ids_bytes': 0}
+        self.file = open(path, mode, newline='')
+        self.file.truncate(position['bytes'])
+        self.file.seek(position['bytes'])
+        self.writer = csv.writer(self.file)
+        self.ids_file = None
+        if ids_path is not None:
+            self.ids_file = open(ids_path, mode, newline='')
+            self.ids_file.truncate(position['ids_bytes'])
+            self.ids_file.seek(position['ids_bytes'])
+            self.ids_writer = csv.writer(self.ids_file)
+
+    def append(self, rows, pairs):
+        self.writer.writerows(rows)
+        if self.ids_file is not None:
+            self.ids_writer.writerows(pairs)
+
+    def flush(self):
+        self.file.flush()
+        if self.ids_file is not None:
+            self.ids_file.flush()
+
+    def position(self):
+        return {'bytes': self.file.tell(), 'ids_bytes': self.ids_file.tell() if self.ids_file is not None else 0}
+
+    def close(self):
+        self.file.close()
+        if self.ids_file is not None:
+            self.ids_file.close()
+
+
+class FeatureFileWriter:
+    """
+        Writes distance features to a binary feature file: a directory of .npy arrays that can be
+        memory-mapped by FeatureClassification instead of parsing CSV text.
+
+        features.npy  float32 array of shape (rows, features)
+        pairs.npy     int32 array of shape (rows, 2), indices into names.txt
+        labels.npy    int8 array of shape (rows,), -1 when the label is unknown
+        names.txt     one matrix id per line
+        meta.json     row count and feature layout
+
+        Rows are appended to the arrays and their headers are rewritten with the final row count on flush.
+    """
+
+    def __init__(self, path, n_features=288, label=-1, rows=0, feature_indices=None):
+        """
+            Args:
+            path (str): Directory of the feature file.
+            n_features (int): Number of features per row.
+            label (int): Label stored for every row, e.g. 1 for clones and 0 for non-clones.
+            rows (int): Number of rows of an existing file to keep; later rows are dropped. 0 starts a new file.
+            feature_indices (list, optional): Positions of the features in the full 288-value vector.
+        """
+        self.path = path
+        self.n_features = n_features
+        self.label = label
+        self.rows = rows
+        self.feature_indices = feature_indices
+        os.makedirs(path, exist_ok=True)
+        mode = 'r+b' if rows else 'w+b'
+        self.arrays = {
+            'features': (open(os.path.join(path, 'features.npy'), mode), np.dtype('<f4'), (n_features,)),
+            'pairs': (open(os.path.join(path, 'pairs.npy'), mode), np.dtype('<i4'), (2,)),
+            'labels': (open(os.path.join(path, 'labels.npy'), mode), np.dtype('i1'), ()),
+        }
+        self.header_size = {}
+        for name, (file, dtype, row_shape) in self.arrays.items():
+            self.header_size[name] = self.write_header(file, dtype, row_shape)
+            # Drop any rows written after the last completed flush
+            row_bytes = dtype.itemsize * int(np.prod(row_shape))
+            file.truncate(self.header_size[name] + rows * row_bytes)
+            file.seek(0, os.SEEK_END)
+
+        names_path = os.path.join(path, 'names.txt')
+        self.names = {}
+        if rows and os.path.exists(names_path):
+            with open(names_path, 'r') as file:
+                for name in file.read().splitlines():
+                    self.names[name] = len(self.names)
+        self.names_file = open(names_path, 'a' if rows else 'w')
+
+    def write_header(self, file, dtype, row_shape):
+        file.seek(0)
+        header = {'descr': dtype.str, 'fortran_order': False, 'shape': (self.rows,) + row_shape}
+        np.lib.format.write_array_header_1_0(file, header)
+        return file.tell()
+
+    def name_index(self, name):
+        index = self.names.get(name)
+        if index is None:
+            index = self.names[name] = len(self.names)
+            self.names_file.write(name + '\n')
+        return index
+
+    def append(self, rows, pairs):
+        """
+            Appends feature rows and the (f1, f2) ids they were computed from.
+
+            Args:
+            rows (list|np.ndarray): Feature rows.
+            pairs (list): (f1, f2) tuples, one per row.
+        """
+        if not len(pairs):
+            return
+        features = np.asarray(rows, dtype='<f4').reshape(len(pairs), self.n_features)
+        indices = np.array([[self.name_index(f1), self.name_index(f2)] for f1, f2 in pairs], dtype='<i4')
+        labels = np.full(len(pairs), self.label, dtype='i1')
+        for name, data in (('features', features), ('pairs', indices), ('labels', labels)):
+            self.arrays[name][0].write(data.tobytes())
+        self.rows += len(pairs)
+
+    def flush(self):
+        """
+            Rewrites the array headers with the current row count and the metadata, making the file loadable.
+        """
+        self.names_file.flush()
+        for name, (file, dtype, row_shape) in self.arrays.items():
+            end = file.tell()
+            if self.write_header(file, dtype, row_shape) != self.header_size[name]:
+                raise IOError(f"The header of {name}.npy changed size")
+            file.seek(end)
+            file.flush()
+        meta = {'rows': self.rows, 'n_features': self.n_features, 'feature_indices': self.feature_indices}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+    def position(self):
+        return {'rows': self.rows}
+
+    def close(self):
+        self.flush()
+        for file, _, _ in self.arrays.values():
+            file.close()
+        self.names_file.close()
+
+
+def is_feature_file(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def load_feature_file(path, mmap_mode='r'):
+    """
+        Loads a binary feature file written by FeatureFileWriter.
+
+        Args:
+        path (str): Directory of the feature file.
+        mmap_mode (str|None): Memory-map mode of the arrays, None to read them into memory.
+
+        Returns:
+        dict: 'features', 'pairs' and 'labels' arrays, the 'names' list and the 'feature_indices' of the columns.
+    """
+    with open(os.path.join(path, 'meta.json'), 'r') as file:
+        meta = json.load(file)
+    with open(os.path.join(path, 'names.txt'), 'r') as file:
+        names = file.read().splitlines()
+    if not meta['rows']:
+        # Empty arrays cannot be memory-mapped
+        mmap_mode = None
+    data = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in ('features', 'pairs', 'labels')}
+    data['names'] = names
+    data['feature_indices'] = meta['feature_indices']
+    return data
+
+
+class FeatureFiles:
+    """
+        Several binary feature files read as one dataset without loading their features: rows are
+        addressed by a global index running through the files in order, and only the rows asked for
+        are copied out of the files. The files are memory-mapped per call and unmapped again, so the
+        pages read do not accumulate in the resident memory of the process.
+    """
+
+    def __init__(self, files):
+        """
+            Args:
+            files (list): (path, label, columns) tuples, where columns are the positions of the features
+                          to read from the file, None for all of them.
+        """
+        self.files = []
+        labels = []
+        lengths = [0]
+        widths = set()
+        for path, label, columns in files:
+            data = load_feature_file(path)
+            self.files.append((os.path.join(path, 'features.npy'), columns))
+            labels.append(np.full(len(data['features']), label, dtype=np.int8))
+            lengths.append(len(data['features']))
+            widths.add(len(columns) if columns is not None else data['features'].shape[1])
+        if len(widths) > 1:
+            raise ValueError("The feature files do not provide the same number of features")
+        self.labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int8)
+        self.offsets = np.cumsum(lengths)
+        self.n_features = widths.pop() if widths else 0
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def rows(self, indices):
+        """
+            Copies rows out of the feature files.
+
+            Args:
+            indices (np.ndarray): Sorted global row indices.
+
+            Returns:
+            np.ndarray: A float32 array with one row per index.
+        """
+        chunk = np.empty((len(indices), self.n_features), dtype=np.float32)
+        bounds = np.searchsorted(indices, self.offsets)
+        for (path, columns), offset, start, end in zip(self.files, self.offsets, bounds, bounds[1:]):
+            if start == end:
+                continue
+            block = np.load(path, mmap_mode='r')[indices[start:end] - offset]
+            chunk[start:end] = block if columns is None else block[:, columns]
+        return chunk
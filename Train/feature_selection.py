@@ -0,0 +1,90 @@
+import json
+import os
+import warnings
+import numpy as np
+
+# Distance metrics of the feature vector, in order; each contributes one feature per matrix column
+METRICS = ('cosine', 'euclidean', 'manhattan', 'chebyshev')
+N_FEATURES = 288
+
+
+def read_weight_ranking(weight_path='weight.txt', n_features=N_FEATURES):
+    """
+        Reads a feature importance ranking in the format of weight.txt ("rank) feature importance" per line).
+
+        weight.txt ranks a wider feature layout than the current 288-value vector (ids up to 1746), so
+        its ids do not denote the same features: features outside the current vector are dropped and the
+        rest keep their relative order. Prefer model_ranking of a model trained on all 288 features.
+
+        Args:
+        weight_path (str): Path of the ranking file.
+        n_features (int): Length of the current feature vector.
+
+        Returns:
+        list: Feature indices from most to least important.
+    """
+    warnings.warn(f"{weight_path} ranks a different feature layout than the 288-value vector; "
+                  "model_ranking of a model trained on all features is the reliable ranking", stacklevel=2)
+    ranking = []
+    with open(weight_path, 'r') as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            feature = int(fields[1])
+            if feature < n_features:
+                ranking.append(feature)
+    return ranking
+
+
+def model_ranking(model):
+    """
+        Ranks features by the importance a trained XGBoost model assigned to them.
+
+        Returns:
+        list: Feature indices from most to least important.
+    """
+    return np.argsort(-np.asarray(model.feature_importances_), kind='stable').tolist()
+
+
+def top_k(ranking, k):
+    """
+        Returns the k most important features in ascending index order, the order they are computed and stored in.
+    """
+    return sorted(ranking[:k])
+
+
+def describe(feature):
+    """
+        Returns the metric and matrix column a feature index stands for, e.g. ('cosine', 12).
+    """
+    return METRICS[feature // (N_FEATURES // len(METRICS))], feature % (N_FEATURES // len(METRICS))
+
+
+def features_path(model_path):
+    return os.path.splitext(model_path)[0] + '.features.json'
+
+
+def save_model_features(model_path, feature_indices):
+    """
+        Records next to a saved model which features it was trained on, or removes a stale record
+        when it was trained on all 288.
+    """
+    path = features_path(model_path)
+    if feature_indices is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as file:
+        json.dump({'feature_indices': list(feature_indices)}, file)
+
+
+def load_model_features(model_path):
+    """
+        Returns the features a saved model was trained on, None when it uses all 288.
+    """
+    path = features_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return json.load(file)['feature_indices']
@@ -1,14 +1,137 @@
 import numpy as np
 import csv
 import os
-from sklearn.metrics.pairwise import cosine_similarity, pairwise_distances
+import json
+import time
+from collections import deque
+from multiprocessing import Pool
+from Train.vocabulary import MATRIX_COLS
+from Train.corpus import CorpusReader
+from Train.matrix_store import MatrixStore
+from Train.matrix_cache import MatrixCache
+from Train.feature_file import CsvFeatureWriter, FeatureFileWriter
+from Train.metrics import Metrics, Progress
+
+
+def column_features(cos, dot, xx, yy, l1, linf):
+    """
+        Assembles the distance features of matching columns from per-column statistics, using the same
+        formulas as sklearn's cosine_similarity and euclidean_distances so that results agree with the
+        diagonals of the full pairwise matrices. The exception is a column identical in both matrices:
+        its Euclidean distance comes out as exactly 0 here, while sklearn's expansion over X @ Y.T leaves
+        rounding noise of up to about 1e-7.
+
+        Args:
+        cos (np.ndarray): Dot products of the L2-normalized columns.
+        dot (np.ndarray): Dot products of the raw columns.
+        xx (np.ndarray): Squared L2 norms of the columns of the first matrix.
+        yy (np.ndarray): Squared L2 norms of the columns of the second matrix.
+        l1 (np.ndarray): Sum of absolute differences of the columns.
+        linf (np.ndarray): Maximum absolute difference of the columns.
+
+        Returns:
+        np.ndarray: The cosine distances, then the Euclidean, Manhattan and Chebyshev distances, along the last axis.
+    """
+    squared = -2 * dot
+    squared += xx
+    squared += yy
+    euclidean = np.sqrt(np.maximum(squared, 0))
+    return np.concatenate([1 - cos, euclidean, l1, linf], axis=-1)
+
+
+def paired_column_distances(matrices1, matrices2, feature_indices=None):
+    """
+        Computes only the distances between matching columns of two matrices, i.e. the diagonals of the
+        full column-by-column cosine, Euclidean, Manhattan and Chebyshev distance matrices, vectorized
+        over a batch of pairs.
+
+        Args:
+        matrices1 (np.ndarray): The (untransposed) matrices of the first files, of shape (493, 72) or (pairs, 493, 72).
+        matrices2 (np.ndarray): The matrices of the second files, of the same shape.
+        feature_indices (list, optional): Positions in the 288-value vector to compute, e.g. a top-k
+                                          selection. Feature f is metric f // 72 of column f % 72, and
+                                          only the metrics and columns the selection uses are computed.
+
+        Returns:
+        np.ndarray: The 288 (or selected) features of every pair, of shape (features,) or (pairs, features).
+    """
+    matrices1 = np.asarray(matrices1, dtype=np.float64)
+    matrices2 = np.asarray(matrices2, dtype=np.float64)
+    metrics = {0, 1, 2, 3}
+    if feature_indices is not None:
+        feature_indices = np.asarray(feature_indices)
+        columns = np.unique(feature_indices % MATRIX_COLS)
+        metrics = set((feature_indices // MATRIX_COLS).tolist())
+        matrices1 = matrices1[..., columns]
+        matrices2 = matrices2[..., columns]
+
+    zeros = np.zeros(matrices1.shape[:-2] + matrices1.shape[-1:])
+    cos = dot = l1 = linf = zeros
+    xx = yy = zeros
+    if metrics & {0, 1}:
+        xx = np.einsum('...ij,...ij->...j', matrices1, matrices1)
+        yy = np.einsum('...ij,...ij->...j', matrices2, matrices2)
+    if 0 in metrics:
+        # Normalize the columns like sklearn does, leaving all-zero columns untouched
+        norm1, norm2 = np.sqrt(xx), np.sqrt(yy)
+        norm1[norm1 == 0] = 1
+        norm2[norm2 == 0] = 1
+        cos = np.einsum('...ij,...ij->...j', matrices1 / norm1[..., None, :], matrices2 / norm2[..., None, :])
+    if 1 in metrics:
+        dot = np.einsum('...ij,...ij->...j', matrices1, matrices2)
+    if metrics & {2, 3}:
+        difference = np.abs(matrices1 - matrices2)
+        l1 = difference.sum(axis=-2)
+        linf = difference.max(axis=-2)
+    features = column_features(cos, dot, xx, yy, l1, linf)
+    if feature_indices is None:
+        return features
+    # Map every selected feature to its metric block and its position among the computed columns
+    n_columns = len(columns)
+    positions = feature_indices // MATRIX_COLS * n_columns + np.searchsorted(columns, feature_indices % MATRIX_COLS)
+    return features[..., positions]
+
+
+# Calculator instance owned by each worker process of the parallel mode
+_worker_calculator = None
+
+
+def _init_worker(options):
+    global _worker_calculator
+    _worker_calculator = DistanceCalculator(**options)
+    _worker_calculator.open_matrices()
+
+
+def _chunk_features_in_worker(chunk):
+    return _worker_calculator.chunk_features(chunk)
 
 
 class DistanceCalculator:
-    def __init__(self, ori, npy_path='./npy/'):
+    def __init__(self, ori, npy_path='./npy/', backend='npy', cache_bytes=256 * 1024 * 1024,
+                 kernel='batched', batch_size=256, feature_indices=None, metrics=None):
+        if backend not in ('npy', 'sparse', 'store'):
+            raise ValueError(f"Unknown backend {backend!r}, expected 'npy', 'sparse' or 'store'")
+        if kernel not in ('batched', 'sklearn'):
+            raise ValueError(f"Unknown kernel {kernel!r}, expected 'batched' or 'sklearn'")
+        # The CSV of pairs; None when the calculator only serves matrices and features of given pairs
         self.ori = ori
-        self.out = os.path.splitext(os.path.basename(ori))[0]
+        self.out = os.path.splitext(os.path.basename(ori))[0] if ori is not None else None
+        # A directory of per-file .npy matrices, of per-file sparse .npz matrices for the 'sparse'
+        # backend, or of a MatrixStore for the 'store' backend
         self.npy_path = npy_path
+        self.backend = backend
+        self.suffix = '.npz' if backend == 'sparse' else '.npy'
+        # Matrices of ids that recur across many pairs are loaded once
+        self.cache = MatrixCache(cache_bytes)
+        self.store = None
+        self.existing = None
+        # 'batched' computes only the matching-column distances for batch_size pairs at a time,
+        # 'sklearn' the full pairwise matrices of every pair (dense backends only)
+        self.kernel = kernel
+        self.batch_size = batch_size
+        # Positions in the 288-value vector to compute and write, None for all of them
+        self.feature_indices = sorted(feature_indices) if feature_indices is not None else None
+        self.metrics = metrics if metrics is not None else Metrics()
 
     def listdir(self, path):
         """
@@ -20,98 +143,311 @@ class DistanceCalculator:
         Returns:
         list: A list of all file paths accumulated.
            """
-        javalist = []
-        for file in os.listdir(path):
-            file_path = os.path.join(path, file)
-            if os.path.isdir(file_path):
-                javalist.extend(self.listdir(file_path))
+        return list(CorpusReader(path))
+
+    def open_matrices(self):
+        """
+            Builds the hashed index of existing matrices, or opens the MatrixStore for the 'store' backend.
+        """
+        if self.backend == 'store':
+            # The store index answers existence checks and matrices are read as memory-mapped views
+            self.store = MatrixStore(self.npy_path)
+        else:
+            # Recursively list all .npy (or sparse .npz) files in the given directory and subdirectories
+            self.existing = set(self.listdir(self.npy_path))
+
+    def matrix_ids(self):
+        """
+            Lists the ids of all matrices that open_matrices found.
+        """
+        if self.store is not None:
+            return list(self.store.ids)
+        prefix = os.path.join(self.npy_path, '')
+        return [path[len(prefix):-len(self.suffix)] for path in self.existing
+                if path.startswith(prefix) and path.endswith(self.suffix)]
+
+    def matrix_exists(self, name):
+        if self.store is not None:
+            return name in self.store
+        return os.path.join(self.npy_path, name + self.suffix) in self.existing
+
+    def load_matrix(self, name):
+        """
+            Loads the matrix of an id from disk, bypassing the cache.
+
+            Args:
+            name (str): The file name of the Java file without its extension.
+
+            Returns:
+            np.ndarray|scipy.sparse.csc_matrix: The dense matrix, or the sparse matrix in CSC form.
+        """
+        if self.store is not None:
+            return self.store.get(name)
+        path = os.path.join(self.npy_path, name + self.suffix)
+        if self.backend == 'sparse':
+            import scipy.sparse
+            return scipy.sparse.load_npz(path).tocsc()
+        return np.load(path)
+
+    def features(self, pairs):
+        """
+            Computes the distance features of a batch of id pairs through the matrix cache.
+
+            Args:
+            pairs (list): (name1, name2) tuples whose matrices exist.
+
+            Returns:
+            list: One list of 288 features (or of the selected features) per pair.
+        """
+        if self.backend != 'sparse' and self.kernel == 'batched':
+            matrices1 = np.stack([self.cache.get(name1, self.load_matrix) for name1, _ in pairs])
+            matrices2 = np.stack([self.cache.get(name2, self.load_matrix) for _, name2 in pairs])
+            return paired_column_distances(matrices1, matrices2, self.feature_indices).tolist()
+        rows = []
+        for name1, name2 in pairs:
+            matrix1 = self.cache.get(name1, self.load_matrix)
+            matrix2 = self.cache.get(name2, self.load_matrix)
+            if self.backend == 'sparse':
+                rows.append(self.sparse_pair_features(matrix1, matrix2))
             else:
-                javalist.append(file_path)
-        return javalist
+                rows.append(self.pair_features(matrix1.T, matrix2.T))
+        if self.feature_indices is not None:
+            rows = [[row[feature] for feature in self.feature_indices] for row in rows]
+        return rows
+
+    def pair_features(self, matrix1, matrix2):
+        """
+            Computes the column-wise distance features of two transposed state transition matrices.
+
+            Args:
+            matrix1 (np.ndarray): The transposed matrix of the first file, one row per matrix column.
+            matrix2 (np.ndarray): The transposed matrix of the second file.
+
+            Returns:
+            list: The cosine distances, then the Euclidean, Manhattan and Chebyshev distances of every column.
+        """
+        from sklearn.metrics.pairwise import cosine_similarity, pairwise_distances
+        # Calculate cosine similarity, Euclidean, Manhattan, and Chebyshev distances
+        cos = cosine_similarity(matrix1, matrix2)
+        euc = pairwise_distances(matrix1, matrix2)
+        man = pairwise_distances(matrix1, matrix2, metric='manhattan')
+        che = pairwise_distances(matrix1, matrix2, metric='chebyshev')
+
+        cosine = []
+        euclidean = []
+        manhattan = []
+        chebyshev = []
+
+        # Extract diagonal elements which represent the distances between identical indices
+        for i in range(len(che[0])):
+            cosine.append(1 - cos[i][i])
+            euclidean.append(euc[i][i])
+            manhattan.append(man[i][i])
+            chebyshev.append(che[i][i])
+
+        return cosine + euclidean + manhattan + chebyshev
+
+    def sparse_pair_features(self, matrix1, matrix2):
+        """
+            Computes the same column-wise distance features as pair_features directly on sparse matrices.
+
+            Args:
+            matrix1 (scipy.sparse.spmatrix): The (untransposed) matrix of the first file.
+            matrix2 (scipy.sparse.spmatrix): The (untransposed) matrix of the second file.
 
-    def get_distance(self):
+            Returns:
+            list: The cosine distances, then the Euclidean, Manhattan and Chebyshev distances of every column.
+        """
+        matrix1, matrix2 = matrix1.tocsc(copy=False), matrix2.tocsc(copy=False)
+        xx = np.asarray(matrix1.multiply(matrix1).sum(axis=0)).ravel()
+        yy = np.asarray(matrix2.multiply(matrix2).sum(axis=0)).ravel()
+        dot = np.asarray(matrix1.multiply(matrix2).sum(axis=0)).ravel()
+
+        # Normalize the columns like sklearn does, leaving all-zero columns untouched
+        norm1, norm2 = np.sqrt(xx), np.sqrt(yy)
+        norm1[norm1 == 0] = 1
+        norm2[norm2 == 0] = 1
+        normalized1, normalized2 = matrix1.copy(), matrix2.copy()
+        normalized1.data /= np.repeat(norm1, np.diff(matrix1.indptr))
+        normalized2.data /= np.repeat(norm2, np.diff(matrix2.indptr))
+        cos = np.asarray(normalized1.multiply(normalized2).sum(axis=0)).ravel()
+
+        difference = abs(matrix1 - matrix2)
+        l1 = np.asarray(difference.sum(axis=0)).ravel()
+        linf = difference.max(axis=0).toarray().ravel()
+        return column_features(cos, dot, xx, yy, l1, linf).tolist()
+
+    def options(self):
+        """
+            Returns the constructor arguments needed to rebuild this calculator in a worker process.
+        """
+        return {'ori': self.ori, 'npy_path': self.npy_path, 'backend': self.backend,
+                'cache_bytes': self.cache.max_bytes, 'kernel': self.kernel, 'batch_size': self.batch_size,
+                'feature_indices': self.feature_indices}
+
+    def read_pairs(self):
+        """
+            Reads the CSV of pairs and yields the file names of every row, without the '.java' suffix.
+
+            Yields:
+            tuple: (f1, f2), or None for a row that does not name two files, so that row positions are kept.
+        """
+        with open(self.ori, 'r') as file:
+            for r in csv.reader(file):
+                try:
+                    # Ensure there are at least two columns per row
+                    if len(r) < 2:
+                        yield None  # Skip rows that do not have at least two filenames
+                        continue
+
+                    # Extract filenames from the first two columns of the CSV and strip the '.java' suffix safely
+                    f1 = r[0].split('.java')[0]
+                    f2 = r[1].split('.java')[0]
+                except IndexError:
+                    print("Error processing row:", r)  # Log an error message if the row is not as expected
+                    yield None
+                    continue  # Skip to the next row
+                yield f1, f2
+
+    def chunk_features(self, chunk):
+        """
+            Computes the features of the pairs of a chunk whose matrices both exist.
+
+            Args:
+            chunk (list): (f1, f2) tuples or None, as yielded by read_pairs.
+
+            Returns:
+            tuple: The list of feature rows and the list of their (f1, f2) pairs, in chunk order.
+        """
+        start = time.perf_counter()
+        pairs = [pair for pair in chunk
+                 if pair is not None and self.matrix_exists(pair[0]) and self.matrix_exists(pair[1])]
+        rows = []
+        for position in range(0, len(pairs), self.batch_size):
+            rows.extend(self.features(pairs[position:position + self.batch_size]))
+        # Only recorded in the calling process; parallel runs record the time spent waiting for workers
+        self.metrics.observe('distance_features_seconds', time.perf_counter() - start)
+        return rows, pairs
+
+    def iter_chunks(self, chunk_size, skip=0):
+        chunk = []
+        index = 0
+        for pair in self.read_pairs():
+            chunk.append(pair)
+            if len(chunk) == chunk_size:
+                if index >= skip:
+                    self.metrics.inc('distance_pairs_read_total', len(chunk))
+                    yield chunk
+                index += 1
+                chunk = []
+        if chunk and index >= skip:
+            self.metrics.inc('distance_pairs_read_total', len(chunk))
+            yield chunk
+
+    def get_distance(self, workers=1, chunk_size=10000, resume=False, with_ids=False, output='csv', label=-1):
         """
             Calculates and stores multiple distance metrics between pairs of files specified in a CSV file.
             This function processes each pair of file names in the CSV, checks if their corresponding .npy
             matrix files exist, and if so, calculates cosine similarity, Euclidean distance, Manhattan distance,
             and Chebyshev distance between these matrices.
 
+            The CSV is processed in chunks of rows that are appended to the output in input order as soon
+            as they are done, together with a progress file that allows an interrupted run to resume.
+
             Args:
-            ori (str): The path to the CSV file containing pairs of filenames to compare.
-            out (str): The base name for the output CSV file where the distances will be stored.
-            path (str): The directory path where the .npy files are located.
+            workers (int|None): Number of worker processes. 1 computes in this process, None uses every CPU.
+            chunk_size (int): Number of CSV rows per chunk.
+            resume (bool): Continue after the last completed chunk of an interrupted run with the same settings.
+            with_ids (bool): Also write the (f1, f2) pair of every feature row to '<out>_4_dis_pairs.csv'.
+                             Binary feature files always hold the pair ids.
+            output (str): 'csv' writes '<out>_4_dis.csv', 'binary' the float32 feature file '<out>_4_dis.feat'.
+            label (int): Label stored with every row of a binary feature file, -1 when unknown.
 
             Returns:
-            None: This function writes results to a CSV file and does not return any value.
+            int: The number of feature rows in the output.
             """
-        # Recursively list all .npy files in the given directory and subdirectories
-        existnpy = self.listdir(self.npy_path)
-        j = 0
-
-        exc = []
-        reader = csv.reader(open(self.ori, 'r'))
-
-        for r in reader:
-            try:
-                # Ensure there are at least two columns per row
-                if len(r) < 2:
-                    continue  # Skip rows that do not have at least two filenames
-
-                # Extract filenames from the first two columns of the CSV and strip the '.java' suffix safely
-                f1 = r[0].split('.java')[0]
-                f2 = r[1].split('.java')[0]
-
-                # Construct the paths to the corresponding .npy files using os.path.join for better path handling
-                file1 = os.path.join(self.npy_path, f1 + '.npy')
-                file2 = os.path.join(self.npy_path, f2 + '.npy')
-            except IndexError:
-                print("Error processing row:", r)  # Log an error message if the row is not as expected
-                continue  # Skip to the next row
-
-            if file1 in existnpy and file2 in existnpy:
-
-                # Load the .npy files if they exist
-                matrix1 = np.load(file1).T
-                matrix2 = np.load(file2).T
-
-                # Calculate cosine similarity, Euclidean, Manhattan, and Chebyshev distances
-                cos = cosine_similarity(matrix1, matrix2)
-                euc = pairwise_distances(matrix1, matrix2)
-                man = pairwise_distances(matrix1, matrix2, metric='manhattan')
-                che = pairwise_distances(matrix1, matrix2, metric='chebyshev')
-
-                cosine = []
-                euclidean = []
-                manhattan = []
-                chebyshev = []
-
-                # Extract diagonal elements which represent the distances between identical indices
-                for i in range(len(che[0])):
-                    cosine.append(1 - cos[i][i])
-                    euclidean.append(euc[i][i])
-                    manhattan.append(man[i][i])
-                    chebyshev.append(che[i][i])
-
-                data = cosine + euclidean + manhattan + chebyshev
-                exc.append(data)  # Append the computed data to the list
-
-                print(j)  # Print the current count
-                j += 1
-        # Write all computed distances to a new CSV file named based on the 'out' parameter
-        with open(self.out + '_4_dis.csv', 'w', newline='') as csvfile0:
-            writer = csv.writer(csvfile0)
-            for row in exc:
-                writer.writerow(row)
-
-
-if __name__ == '__main__':
-    calc = DistanceCalculator('./Clone_type/BCB_nonclone.csv')
-    calc.get_distance()
-
+        if output not in ('csv', 'binary'):
+            raise ValueError(f"Unknown output {output!r}, expected 'csv' or 'binary'")
+        if workers is None:
+            workers = os.cpu_count() or 1
+        out_path = self.output_path(output)
+        progress_path = self.out + '_4_dis.progress'
+        state = {'ori': os.path.abspath(self.ori), 'chunk_size': chunk_size, 'with_ids': with_ids,
+                 'output': output, 'feature_indices': self.feature_indices, 'chunks': 0, 'rows': 0}
+        if resume and os.path.exists(progress_path) and os.path.exists(out_path):
+            with open(progress_path, 'r') as file:
+                saved = json.load(file)
+            if all(saved.get(key) == state[key] for key in ('ori', 'chunk_size', 'with_ids', 'output', 'feature_indices')):
+                state = saved
+                print("Resuming after {} chunks ({} rows)".format(state['chunks'], state['rows']))
 
+        # Resuming drops whatever an interrupted run wrote after its last completed chunk
+        if output == 'binary':
+            n_features = len(self.feature_indices) if self.feature_indices is not None else 288
+            writer = FeatureFileWriter(out_path, n_features, label, state['rows'], self.feature_indices)
+        else:
+            ids_path = self.out + '_4_dis_pairs.csv' if with_ids else None
+            writer = CsvFeatureWriter(out_path, ids_path, state.get('position'))
 
+        chunks = self.iter_chunks(chunk_size, skip=state['chunks'])
+        try:
+            if workers <= 1:
+                self.open_matrices()
+                self.write_chunks(map(self.chunk_features, chunks), state, writer, progress_path)
+                stats = self.cache.stats()
+                for name in ('hits', 'misses', 'evictions', 'hit_rate'):
+                    self.metrics.set_gauge(f'distance_cache_{name}', stats[name])
+                print("Matrix cache: {} hits, {} misses, {} evictions".format(stats['hits'], stats['misses'],
+                                                                              stats['evictions']))
+            else:
+                with Pool(workers, initializer=_init_worker, initargs=(self.options(),)) as pool:
+                    self.write_chunks(self.ordered_results(pool, chunks, workers), state, writer, progress_path)
+        finally:
+            writer.close()
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        return state['rows']
 
+    def output_path(self, output='csv'):
+        return self.out + ('_4_dis.feat' if output == 'binary' else '_4_dis.csv')
 
+    def ordered_results(self, pool, chunks, workers):
+        """
+            Feeds chunks to the pool while keeping at most two per worker in flight, and yields
+            their results in input order.
+        """
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.apply_async(_chunk_features_in_worker, (chunk,)))
+            if len(in_flight) >= 2 * workers:
+                with self.metrics.timer('distance_wait_seconds'):
+                    result = in_flight.popleft().get()
+                yield result
+        while in_flight:
+            with self.metrics.timer('distance_wait_seconds'):
+                result = in_flight.popleft().get()
+            yield result
 
+    def write_chunks(self, results, state, writer, progress_path):
+        """
+            Appends the results of completed chunks to the output and records the progress after each one.
+        """
+        progress = Progress('Feature rows written')
+        for rows, pairs in results:
+            with self.metrics.timer('distance_write_seconds'):
+                writer.append(rows, pairs)
+                writer.flush()
+                state['position'] = writer.position()
+                state['chunks'] += 1
+                state['rows'] += len(rows)
+                with open(progress_path + '.tmp', 'w') as file:
+                    json.dump(state, file)
+                os.replace(progress_path + '.tmp', progress_path)
+            self.metrics.inc('distance_pairs_total', len(rows))
+            progress.update(len(rows))
+        self.metrics.set_gauge('distance_pairs_per_second', progress.close(), pairs=self.out)
 
 
+if __name__ == '__main__':
+    calc = DistanceCalculator('./Clone_type/BCB_nonclone.csv')
+    calc.get_distance()
@@ -1,17 +1,107 @@
 import numpy as np
-import javalang
-from javalang.ast import Node
-from anytree import AnyNode
+from collections import Counter
+from multiprocessing import Pool
 import os
 import time
 import json
+import hashlib
+from Train.corpus import CorpusReader, decode_source, read_bytes, read_source, split_member
+from Train.matrix_store import MatrixStore
+from Train.metrics import Metrics, Progress
+from Train.vocabulary import MATRIX_COLS, MATRIX_ROWS, NULL_COLUMN, Vocabulary
+
+
+# javalang and its AST base class, bound by load_javalang on first use
+javalang = None
+Node = None
+
+# Manifest of the incremental mode, kept next to the generated matrices
+MANIFEST_NAME = 'manifest.json'
+
+# Generator instance owned by each worker process of the parallel mode
+_worker_generator = None
+
+
+def load_javalang():
+    """
+        Imports javalang when a source is first parsed instead of when this module is imported, so that
+        modules which only convert matrices do not load the parser.
+    """
+    global javalang, Node
+    if javalang is None:
+        import javalang as module
+        from javalang.ast import Node as node_class
+        javalang, Node = module, node_class
+    return javalang
+
+
+def conversion_errors():
+    """
+        Returns the errors that mark a single Java file as unconvertible without aborting the whole run.
+    """
+    load_javalang()
+    return UnicodeDecodeError, javalang.parser.JavaSyntaxError, javalang.tokenizer.LexerError
+
+
+def parse_tokens(parse):
+    """
+        Runs a javalang parse method. javalang raises StopIteration on input that ends too early and
+        JavaParserError on some malformed input, which are reported as a JavaSyntaxError like any other
+        syntax error of the file.
+    """
+    try:
+        return parse()
+    except javalang.parser.JavaSyntaxError:
+        raise
+    except (StopIteration, javalang.parser.JavaParserBaseException) as e:
+        raise javalang.parser.JavaSyntaxError(str(e) or 'Unexpected end of input') from e
+
+
+def _init_worker(options):
+    global _worker_generator
+    _worker_generator = JavaSyntaxMatrixGenerator(**options)
+
+
+def _convert_in_worker(source):
+    return _worker_generator.convert_file(*source)
 
 
 class JavaSyntaxMatrixGenerator:
-    def __init__(self, java_path, npy_path='./npy/', json_path='type.json'):
+    def __init__(self, java_path, npy_path='./npy/', json_path='type.json', walker='iterative',
+                 backend='npy', dtype='float64', metrics=None, unit='method', include=None, exclude=None):
+        if walker not in ('iterative', 'anytree'):
+            raise ValueError(f"Unknown walker {walker!r}, expected 'iterative' or 'anytree'")
+        if unit not in ('method', 'file'):
+            raise ValueError(f"Unknown unit {unit!r}, expected 'method' or 'file'")
+        if backend not in ('npy', 'sparse', 'store'):
+            raise ValueError(f"Unknown backend {backend!r}, expected 'npy', 'sparse' or 'store'")
         self.java_path = java_path
+        # A directory of per-file .npy matrices, of per-file sparse .npz matrices for the 'sparse'
+        # backend, or of a MatrixStore for the 'store' backend
         self.npy_path = npy_path
-        self.nodetypedict, self.tokendict, self.node2groups = self.load_dictionaries_from_json(json_path)
+        self.json_path = json_path
+        self.walker = walker
+        self.backend = backend
+        # Element type of the MatrixStore shards
+        self.dtype = dtype
+        # 'method' expects one method or constructor per file; 'file' parses whole compilation units and
+        # emits one matrix per method and constructor, under the id file#class#method#line
+        self.unit = unit
+        # fnmatch patterns of the corpus files to convert and to skip, e.g. ['*.java'] and ['test'];
+        # a java_path that is a zip or tar(.gz) archive is read member by member without extracting it
+        self.include = include
+        self.exclude = exclude
+        # type.json compiled into integer-coded tables, cached next to it
+        self.vocabulary = Vocabulary.load(json_path)
+        self.nodetypedict = self.vocabulary.nodetypedict
+        self.tokendict = self.vocabulary.tokendict
+        self.node2groups = self.vocabulary.node2groups
+        # node2groups pairs missing from type.json in the last converted file
+        self.unknown_pairs = Counter()
+        # Seconds spent in each substep of the last converted file, and its tokens mapped to NULL_COLUMN
+        self.timings = {}
+        self.null_tokens = 0
+        self.metrics = metrics if metrics is not None else Metrics()
 
     def load_dictionaries_from_json(self, json_path):
         with open(json_path, 'r') as file:
@@ -20,7 +110,8 @@ class JavaSyntaxMatrixGenerator:
 
     def listdir(self, path):
         """
-        Recursively lists all files in the specified directory and subdirectories.
+        Recursively lists all files in the specified directory and subdirectories, or the members of
+        an archive as archive!/member, that pass the include and exclude filters.
 
         Args:
         path (str): The directory path to list files from.
@@ -28,39 +119,133 @@ class JavaSyntaxMatrixGenerator:
         Returns:
         list: A list of all file paths accumulated.
            """
-        javalist = []
-        for file in os.listdir(path):
-            file_path = os.path.join(path, file)
-            if os.path.isdir(file_path):
-                javalist.extend(self.listdir(file_path))
-            else:
-                javalist.append(file_path)
-        return javalist
+        return list(CorpusReader(path, self.include, self.exclude))
+
+    def read_source(self, path, data=None):
+        """
+            Returns the Java source of a file or archive member, or of its bytes when they were already read.
+        """
+        return decode_source(data) if data is not None else read_source(path)
 
-    def get_ast(self, path):
+    def get_ast(self, path, data=None):
         """
             Read a Java source code file, tokenize it, parse it to create an AST, and print the AST.
 
             Args:
             path (str): The path to the Java file to be parsed.
+            data (bytes, optional): The content of the file, when it was already read, e.g. from an archive.
 
             Returns:
             programast: The AST of the parsed Java member declaration.
             """
-        programfile = open(path, encoding='utf-8')
-        programtext = programfile.read()
-        programfile.close()
+        return self.parse_source(self.read_source(path, data))
+
+    def parse_source(self, programtext):
+        """
+            Tokenizes Java source text and parses it as a single member declaration.
+
+            Args:
+            programtext (str): The Java source of one method or constructor.
 
+            Returns:
+            tuple: The AST of the parsed Java member declaration and the list of its tokens.
+            """
         # Perform lexical analysis on the read text
+        load_javalang()
+        start = time.perf_counter()
         programtokens = javalang.tokenizer.tokenize(programtext)
         token_list = list(programtokens)
+        self.timings['tokenize'] = time.perf_counter() - start
 
         # Parse tokens to generate AST
+        start = time.perf_counter()
         parser = javalang.parse.Parser(token_list)
-        programast = parser.parse_member_declaration()
+        programast = parse_tokens(parser.parse_member_declaration)
+        self.timings['parse'] = time.perf_counter() - start
 
         return programast, token_list
 
+    def parse_compilation_unit(self, programtext):
+        """
+            Tokenizes Java source text and parses it as a whole compilation unit.
+
+            Args:
+            programtext (str): The Java source of a file.
+
+            Returns:
+            tuple: The AST of the compilation unit and the list of its tokens.
+            """
+        load_javalang()
+        start = time.perf_counter()
+        token_list = list(javalang.tokenizer.tokenize(programtext))
+        self.timings['tokenize'] = self.timings.get('tokenize', 0) + time.perf_counter() - start
+
+        start = time.perf_counter()
+        programast = parse_tokens(javalang.parse.Parser(token_list).parse)
+        self.timings['parse'] = self.timings.get('parse', 0) + time.perf_counter() - start
+
+        return programast, token_list
+
+    def method_declarations(self, tree, file_id):
+        """
+            Enumerates the methods and constructors with a body in a compilation unit.
+
+            Args:
+            tree (CompilationUnit): The parsed compilation unit.
+            file_id (str): The file name without its extension.
+
+            Yields:
+            tuple: A stable id 'file#class#method#line', where class is the dotted path of the enclosing
+                   types (anonymous classes appear as '$' and the type they instantiate), and the declaration node.
+            """
+        load_javalang()
+        seen = set()
+        declarations = list(tree.filter(javalang.tree.MethodDeclaration))
+        declarations += list(tree.filter(javalang.tree.ConstructorDeclaration))
+        for path, node in sorted(declarations, key=lambda item: (item[1].position.line, item[1].position.column)
+                                 if item[1].position else (0, 0)):
+            if node.body is None:
+                continue
+            owner = ''
+            for parent in path:
+                if isinstance(parent, javalang.tree.TypeDeclaration):
+                    owner += ('.' if owner else '') + parent.name
+                elif isinstance(parent, javalang.tree.ClassCreator):
+                    owner += '$' + parent.type.name
+            line = node.position.line if node.position else 0
+            name = f'{file_id}#{owner}#{node.name}#{line}'
+            if name in seen:
+                name += f':{node.position.column if node.position else len(seen)}'
+            seen.add(name)
+            yield name, node
+
+    def file_matrices(self, path, sparse=False, data=None):
+        """
+            Parses a whole Java file once and generates the matrix of every method and constructor in it.
+            Each matrix equals the one the method would get in a file of its own.
+
+            Args:
+            path (str): The file path to the Java source file.
+            sparse (bool): Whether to return the matrices in scipy CSR form.
+            data (bytes, optional): The content of the file, when it was already read.
+
+            Returns:
+            list: (id, matrix) tuples, in source order.
+            """
+        tree, tokens = self.parse_compilation_unit(self.read_source(path, data))
+        # Token values map to the same token type wherever they occur, so one dictionary serves every method
+        typedict = self.get_typedict(tokens)
+        unknown_pairs = Counter()
+        null_tokens = 0
+        matrices = []
+        for name, node in self.method_declarations(tree, self.matrix_name(path)):
+            matrices.append((name, self.ast_matrix(node, tokens, sparse, typedict)))
+            unknown_pairs.update(self.unknown_pairs)
+            null_tokens += self.null_tokens
+        self.unknown_pairs = unknown_pairs
+        self.null_tokens = null_tokens
+        return matrices
+
     def get_token(self, node):
         """
             Extracts a token from a given AST node, which represents the type or characteristic of the node.
@@ -133,6 +318,7 @@ class JavaSyntaxMatrixGenerator:
             Returns:
             None: The function modifies the tree structure in place and does not return a value.
             """
+        from anytree import AnyNode
         id = len(nodelist)
         # print(id)
         # Retrieve the token and list of child nodes for the current node pair
@@ -187,31 +373,47 @@ class JavaSyntaxMatrixGenerator:
                 yield from self.traverse(child, typedict, triads, path)
             path.pop()
 
-    # Generate a second-order Markov matrix.
-    def second_order_matrix(self, path, npy_path):
+    def iter_triads(self, root, typedict):
         """
-           Generates a matrix representation of the syntactic and structural patterns in a Java source file.
+           Walks the AST once, without recursion or an intermediate AnyNode tree, and yields the
+           triads of tokens that traverse would collect for the same tree.
 
            Args:
-           path (str): The file path to the Java source file.
+           root (Node): The root of the javalang AST.
+           typedict (dict): A dictionary mapping original tokens to desired token strings.
 
-           Returns:
-           np.ndarray: A matrix where each entry represents normalized counts of specific syntactic patterns.
+           Yields:
+           tuple: A triad (three consecutive tokens) from a root-to-node path, in pre-order.
+           """
+        path = []
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            del path[depth:]
+            token, children = self.get_token(node), self.get_child(node)
+            # Leaves are remapped exactly like traverse does
+            if not children:
+                if token in typedict:
+                    token = typedict[token]
+                elif token != 'ReturnStatement':
+                    token = 'Null'
+            path.append(token)
+            if depth >= 2:
+                yield path[-3], path[-2], path[-1]
+            # Push in reverse so that children are visited left to right
+            for child in reversed(children):
+                stack.append((child, depth + 1))
+
+    def get_typedict(self, tokens):
         """
-        if not os.path.exists(npy_path):
-            os.makedirs(npy_path)
-            print(f"Created directory {npy_path}")
-
-        # ast generation
-        tree, tokens = self.get_ast(path)
+           Creates a dictionary mapping token values to their token types.
 
-        # create tree
-        nodelist = []
-        newtree = AnyNode(id=0, token=None, data=None)
-        self.create_tree(newtree, tree, nodelist)
+           Args:
+           tokens (list): The javalang tokens of the parsed source.
 
-        # token type dictionary
-        # Create a dictionary mapping token values to their types
+           Returns:
+           dict: The token type of the first occurrence of every token value.
+           """
         typedict = {}
         for token in tokens:
             token_type = str(type(token))[:-2].split(".")[-1]
@@ -221,59 +423,512 @@ class JavaSyntaxMatrixGenerator:
             else:
                 if typedict[token_value] != token_type:
                     print('!!!!!!!!')
+        return typedict
 
-        # # Traverse the tree to collect triads
-        triads = []
-        list(self.traverse(newtree, typedict, triads, path=None))
+    def triad_codes(self, triads, typedict):
+        """
+           Turns triads into integer (row, column) codes of the state transition matrix.
 
-        # Initialize a matrix of zeros with dimensions 493x72
-        matrix = [[0 for _ in range(72)] for row in range(493)]
+           Args:
+           triads (iterable): Triads of tokens as produced by traverse or iter_triads.
+           typedict (dict): A dictionary mapping token values to their token types.
 
-        # Obtain the state transition matrix
-        for i in range(len(triads)):
-            m = self.node2groups[triads[i][0] + '2' + triads[i][1]]
-            name = triads[i][2]
-            try:
-                n = self.nodetypedict[name]
-            except KeyError:
-                try:
-                    n = self.tokendict[typedict[name]]
-                except KeyError:
-                    n = 62
-            matrix[m][n] += 1
+           Returns:
+           tuple: Row codes and column codes as integer arrays, and a Counter of the node2groups
+                  pairs that are not in type.json (those triads are skipped).
+           """
+        node2groups = self.node2groups
+        columns = {}
+        unknown = Counter()
+        rows, cols = [], []
+        for first, second, name in triads:
+            pair = first + '2' + second
+            m = node2groups.get(pair)
+            if m is None:
+                unknown[pair] += 1
+                continue
+            n = columns.get(name)
+            if n is None:
+                n = self.nodetypedict.get(name)
+                if n is None:
+                    n = self.tokendict.get(typedict.get(name), NULL_COLUMN)
+                columns[name] = n
+            rows.append(m)
+            cols.append(n)
+        return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp), unknown
+
+    def walk_codes(self, root, typedict):
+        """
+           Walks the AST like iter_triads, but codes every node once into its vocabulary id and
+           column, so that triads are collected as integers and their rows are looked up together.
 
-        # Obtain the state transition probability matrix
-        for k in range(493):
-            total = 0
-            for l in range(72):
-                total += matrix[k][l]
-            if total != 0:
-                for p in range(72):
-                    matrix[k][p] = (matrix[k][p]) / total
+           Args:
+           root (Node): The root of the javalang AST.
+           typedict (dict): A dictionary mapping token values to their token types.
+
+           Returns:
+           tuple: The same row codes, column codes and Counter of unknown pairs as triad_codes
+                  returns for iter_triads(root, typedict).
+           """
+        ids = self.vocabulary.ids
+        nodetypedict, tokendict = self.nodetypedict, self.tokendict
+        codes = {}
+        extra = {}
+        firsts, seconds, cols = [], [], []
+        path = []
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            del path[depth:]
+            token, children = self.get_token(node), self.get_child(node)
+            if not children:
+                if token in typedict:
+                    token = typedict[token]
+                elif token != 'ReturnStatement':
+                    token = 'Null'
+            code = codes.get(token)
+            if code is None:
+                index = ids.get(token)
+                if index is None:
+                    index = extra.setdefault(token, len(ids) + len(extra))
+                column = nodetypedict.get(token)
+                if column is None:
+                    column = tokendict.get(typedict.get(token), NULL_COLUMN)
+                code = codes[token] = (index, column)
+            path.append(code[0])
+            if depth >= 2:
+                firsts.append(path[-3])
+                seconds.append(path[-2])
+                cols.append(code[1])
+            for child in reversed(children):
+                stack.append((child, depth + 1))
+        return self.lookup_rows(firsts, seconds, cols, extra)
+
+    def lookup_rows(self, firsts, seconds, cols, extra):
+        """
+           Looks up the rows of coded triads and drops the triads whose pair is not in type.json.
+
+           Args:
+           firsts (list): Vocabulary ids of the first tokens.
+           seconds (list): Vocabulary ids of the second tokens.
+           cols (list): Column codes of the third tokens.
+           extra (dict): Ids given to tokens missing from the vocabulary, in the order they were given.
+
+           Returns:
+           tuple: Row codes and column codes as integer arrays, and a Counter of the unknown pairs.
+           """
+        firsts = np.array(firsts, dtype=np.intp)
+        seconds = np.array(seconds, dtype=np.intp)
+        cols = np.array(cols, dtype=np.intp)
+        rows = self.vocabulary.rows(firsts, seconds)
+        unknown = Counter()
+        missing = rows < 0
+        if missing.any():
+            names = self.vocabulary.names + list(extra)
+            for first, second in zip(firsts[missing].tolist(), seconds[missing].tolist()):
+                unknown[names[first] + '2' + names[second]] += 1
+            rows, cols = rows[~missing], cols[~missing]
+        return rows, cols, unknown
+
+    def transition_matrix(self, rows, cols, sparse=False):
+        """
+           Counts (row, column) codes and normalizes every non-empty row into transition probabilities.
+
+           Args:
+           rows (np.ndarray): Row codes of the triads.
+           cols (np.ndarray): Column codes of the triads.
+           sparse (bool): Whether to return a scipy CSR matrix holding only the non-zero transitions.
+
+           Returns:
+           np.ndarray|scipy.sparse.csr_matrix: A 493x72 float matrix whose non-empty rows sum to one.
+           """
+        if sparse:
+            import scipy.sparse
+            counts = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(MATRIX_ROWS, MATRIX_COLS))
+            counts.sum_duplicates()
+            totals = np.asarray(counts.sum(axis=1)).ravel()
+            counts.data /= np.repeat(totals, np.diff(counts.indptr))
+            return counts
+        counts = np.bincount(rows * MATRIX_COLS + cols, minlength=MATRIX_ROWS * MATRIX_COLS)
+        counts = counts.reshape(MATRIX_ROWS, MATRIX_COLS).astype(np.float64)
+        totals = counts.sum(axis=1, keepdims=True)
+        return np.divide(counts, totals, out=counts, where=totals != 0)
+
+    def options(self):
+        """
+            Returns the constructor arguments needed to rebuild this generator in a worker process.
+        """
+        return {'java_path': self.java_path, 'npy_path': self.npy_path, 'json_path': self.json_path,
+                'walker': self.walker, 'backend': self.backend, 'dtype': self.dtype, 'unit': self.unit,
+                'include': self.include, 'exclude': self.exclude}
+
+    def matrix_name(self, path):
+        """
+            Returns the id a matrix is saved under: the file name without its .java extension.
+            In the 'file' unit mode this is the prefix of the ids of the file's methods.
+        """
+        return os.path.splitext(os.path.basename(path))[0]
+
+    # Generate a second-order Markov matrix.
+    def second_order_matrix(self, path, npy_path, data=None):
+        """
+           Generates a matrix representation of the syntactic and structural patterns in a Java source file.
+
+           Args:
+           path (str): The file path to the Java source file.
+
+           Returns:
+           np.ndarray: A matrix where each entry represents normalized counts of specific syntactic patterns.
+        """
+        if not os.path.exists(npy_path):
+            os.makedirs(npy_path)
+            print(f"Created directory {npy_path}")
+
+        matrix = self.build_matrix(path, sparse=self.backend == 'sparse', data=data)
 
         # Serialize and save the matrix to a file
-        matrix = np.array(matrix)
         # Extract the filename from the file path, remove the .java extension, and obtain the filename.
-        filename = os.path.splitext(os.path.basename(path))[0]
-        npypath = npy_path + filename
-        # print(npypath)
-        np.save(npypath, matrix)
+        self.save_matrix(self.matrix_name(path), matrix, npy_path)
         return matrix
 
-    def allmain(self):
+    def save_matrix(self, name, matrix, npy_path):
+        npypath = npy_path + name
+        start = time.perf_counter()
+        if self.backend == 'sparse':
+            import scipy.sparse
+            scipy.sparse.save_npz(npypath, matrix)
+        else:
+            np.save(npypath, matrix)
+        self.timings['save'] = self.timings.get('save', 0) + time.perf_counter() - start
+
+    def build_matrix(self, path, sparse=False, data=None):
+        """
+           Generates the second-order state transition matrix of a Java source file without saving it.
+
+           Args:
+           path (str): The file path to the Java source file.
+           sparse (bool): Whether to return the matrix in scipy CSR form.
+
+           Returns:
+           np.ndarray|scipy.sparse.csr_matrix: A matrix where each entry represents normalized counts of specific syntactic patterns.
+        """
+        # ast generation
+        tree, tokens = self.get_ast(path, data)
+        return self.ast_matrix(tree, tokens, sparse)
+
+    def source_matrix(self, programtext, sparse=False):
+        """
+           Generates the second-order state transition matrix of Java source text held in memory.
+
+           Args:
+           programtext (str): The Java source of one method or constructor.
+           sparse (bool): Whether to return the matrix in scipy CSR form.
+
+           Returns:
+           np.ndarray|scipy.sparse.csr_matrix: A matrix where each entry represents normalized counts of specific syntactic patterns.
+        """
+        tree, tokens = self.parse_source(programtext)
+        return self.ast_matrix(tree, tokens, sparse)
+
+    def ast_matrix(self, tree, tokens, sparse=False, typedict=None):
+        """
+           Generates the second-order state transition matrix of a parsed AST.
+
+           Args:
+           tree (Node): The javalang AST.
+           tokens (list): The javalang tokens the AST was parsed from.
+           sparse (bool): Whether to return the matrix in scipy CSR form.
+           typedict (dict, optional): The token type dictionary of tokens, when it was already built.
+
+           Returns:
+           np.ndarray|scipy.sparse.csr_matrix: A matrix where each entry represents normalized counts of specific syntactic patterns.
+        """
+        # The walkers tell nodes apart by javalang's Node, also for a tree parsed outside this class
+        load_javalang()
+        # token type dictionary
+        if typedict is None:
+            typedict = self.get_typedict(tokens)
+
+        start = time.perf_counter()
+        if self.walker == 'anytree':
+            from anytree import AnyNode
+            # create tree
+            nodelist = []
+            newtree = AnyNode(id=0, token=None, data=None)
+            self.create_tree(newtree, tree, nodelist)
+            self.timings['tree'] = self.timings.get('tree', 0) + time.perf_counter() - start
+
+            # # Traverse the tree to collect triads
+            start = time.perf_counter()
+            triads = []
+            list(self.traverse(newtree, typedict, triads, path=None))
+            rows, cols, self.unknown_pairs = self.triad_codes(triads, typedict)
+        else:
+            # Single iterative pass over the javalang AST, coding the triads as it goes
+            rows, cols, self.unknown_pairs = self.walk_codes(tree, typedict)
+
+        # Obtain the state transition probability matrix
+        self.null_tokens = int(np.count_nonzero(cols == NULL_COLUMN))
+        self.timings['traverse'] = self.timings.get('traverse', 0) + time.perf_counter() - start
+        start = time.perf_counter()
+        matrix = self.transition_matrix(rows, cols, sparse)
+        self.timings['fill'] = self.timings.get('fill', 0) + time.perf_counter() - start
+        return matrix
+
+    def convert_file(self, javafile, data=None):
+        """
+            Converts a single Java file into its matrix, or into the matrices of all of its methods in the
+            'file' unit mode, and reports a failure instead of raising one.
+
+            Args:
+            javafile (str): The path to the Java file to be converted.
+            data (bytes, optional): The content of the file, when it was already read, e.g. from an archive.
+
+            Returns:
+            tuple: None on success, otherwise a record with the file path, error type and message,
+                   the Counter of node2groups pairs missing from type.json, for the 'store'
+                   backend the (id, matrix) tuples to append to the store, the seconds spent in each
+                   substep together with the number of tokens mapped to NULL_COLUMN, and the ids of
+                   the matrices.
+            """
+        self.timings = {}
+        self.null_tokens = 0
+        try:
+            if self.unit == 'file':
+                matrices = self.file_matrices(javafile, sparse=self.backend == 'sparse', data=data)
+            elif self.backend == 'store':
+                matrices = [(self.matrix_name(javafile), self.build_matrix(javafile, data=data))]
+            else:
+                matrices = [(self.matrix_name(javafile), self.second_order_matrix(javafile, self.npy_path, data))]
+            names = [name for name, _ in matrices]
+            if self.backend == 'store':
+                # The parent process owns the store, so the matrices travel back with the result
+                stored = matrices
+            else:
+                if self.unit == 'file':
+                    for name, matrix in matrices:
+                        self.save_matrix(name, matrix, self.npy_path)
+                stored = []
+        except conversion_errors() as e:
+            message = getattr(e, 'description', None) or str(e)
+            failure = {'path': javafile, 'error': type(e).__name__, 'message': message}
+            return failure, Counter(), [], self.timings, []
+        self.timings['null_tokens'] = self.null_tokens
+        return None, self.unknown_pairs, stored, self.timings, names
+
+    def file_hash(self, path, data=None):
+        """
+            Returns the SHA-256 hex digest of a file's content, or of an archive member's.
+        """
+        if data is not None or split_member(path)[1] is not None:
+            return hashlib.sha256(data if data is not None else read_bytes(path)).hexdigest()
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def fingerprint(self):
+        """
+            Fingerprints everything besides the Java sources that the saved matrices depend on:
+            the content of type.json, the output format and the unit a matrix is built for.
+        """
+        return {'type_json': self.file_hash(self.json_path), 'backend': self.backend,
+                'dtype': self.dtype if self.backend == 'store' else None, 'unit': self.unit}
+
+    def load_manifest(self):
+        """
+            Loads the manifest of the incremental mode, or an empty one when it is missing or was
+            written for a different type.json or output format.
+
+            Returns:
+            dict: Maps every converted Java file path to its content hash and matrix id, or the ids
+                  of its method matrices in the 'file' unit mode.
+        """
+        manifest_path = os.path.join(self.npy_path, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('fingerprint') == self.fingerprint():
+                return manifest['files']
+            print("type.json or the output format changed, regenerating all matrices")
+        return {}
+
+    def save_manifest(self, files):
+        manifest_path = os.path.join(self.npy_path, MANIFEST_NAME)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump({'fingerprint': self.fingerprint(), 'files': files}, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    @staticmethod
+    def manifest_names(entry):
+        return entry['names'] if 'names' in entry else [entry['name']]
+
+    def matrix_exists(self, name, store=None):
+        if store is not None:
+            return name in store
+        suffix = '.npz' if self.backend == 'sparse' else '.npy'
+        return os.path.exists(self.npy_path + name + suffix)
+
+    def remove_matrix(self, name, store=None):
+        if store is not None:
+            store.remove(name)
+            return
+        suffix = '.npz' if self.backend == 'sparse' else '.npy'
+        if os.path.exists(self.npy_path + name + suffix):
+            os.remove(self.npy_path + name + suffix)
+
+    def allmain(self, workers=1, chunksize=16, incremental=False, checkpoint_every=1000):
         """
             Main method to read all Java files from a folder and generate matrices for each file.
+
+            Args:
+            workers (int|None): Number of worker processes. 1 keeps the serial path, None uses every CPU.
+            chunksize (int): Number of files handed to a worker at a time in the parallel mode.
+            incremental (bool): Skip files whose content hash is unchanged since the last incremental run,
+                                and prune the matrices of files that were deleted since.
+            checkpoint_every (int): In the incremental mode, save the manifest after every this many files,
+                                    so that an interrupted run resumes with the files that are left.
+
+            Returns:
+            dict: A report with the number of files converted, the list of per-file failures and
+                  the node2groups pairs missing from type.json. The incremental mode adds the number of
+                  cache hits, rebuilt files and pruned matrices.
+        """
+        # Files are listed lazily, so that conversion starts with the first one found; archive members come
+        # with their content, which is read while listing
+        sources = CorpusReader(self.java_path, self.include, self.exclude).sources()
+        total = None
+        if workers is None:
+            workers = os.cpu_count() or 1
+        store = None
+        if self.backend == 'store':
+            store = MatrixStore(self.npy_path, mode='a', dtype=self.dtype)
+        # Create the output directory up front so that workers do not race on it
+        elif not os.path.exists(self.npy_path):
+            os.makedirs(self.npy_path)
+            print(f"Created directory {self.npy_path}")
+
+        try:
+            if incremental:
+                manifest = self.load_manifest()
+                hashes = {}
+                changed = []
+                for javafile, data in sources:
+                    hashes[javafile] = self.file_hash(javafile, data)
+                    # Only new or changed files, or files whose matrix went missing, are converted again
+                    if (javafile not in manifest or manifest[javafile]['hash'] != hashes[javafile]
+                            or not all(self.matrix_exists(name, store)
+                                       for name in self.manifest_names(manifest[javafile]))):
+                        changed.append((javafile, data))
+                sources = changed
+                javalist = [javafile for javafile, _ in changed]
+                total = len(changed)
+                current = {self.matrix_name(javafile) for javafile in hashes}
+                current.update(name for javafile, entry in manifest.items() if javafile in hashes
+                               for name in self.manifest_names(entry))
+                deleted = [javafile for javafile in manifest if javafile not in hashes]
+                for javafile in deleted:
+                    # Another file may still produce a matrix under the same id
+                    for name in self.manifest_names(manifest[javafile]):
+                        if name not in current:
+                            self.remove_matrix(name, store)
+                    del manifest[javafile]
+
+            def checkpointed(results):
+                # Results come back in input order; by the time the next one is requested the previous
+                # matrix has been stored, so the saved manifest only lists matrices that exist
+                for count, (javafile, result) in enumerate(zip(javalist, results)):
+                    if count and count % checkpoint_every == 0:
+                        if store is not None:
+                            store.flush()
+                        self.save_manifest(manifest)
+                    if result[0] is not None:
+                        # Failed files are retried on the next run
+                        manifest.pop(javafile, None)
+                    elif self.unit == 'file':
+                        names = result[4]
+                        # Methods that were removed from a changed file lose their matrices
+                        if javafile in manifest:
+                            for name in set(self.manifest_names(manifest[javafile])) - set(names):
+                                self.remove_matrix(name, store)
+                        manifest[javafile] = {'hash': hashes[javafile], 'names': names}
+                    else:
+                        manifest[javafile] = {'hash': hashes[javafile], 'name': self.matrix_name(javafile)}
+                    yield result
+
+            if workers <= 1:
+                results = (self.convert_file(javafile, data) for javafile, data in sources)
+                if incremental:
+                    results = checkpointed(results)
+                report = self.collect_report(results, store, total)
+            else:
+                with Pool(workers, initializer=_init_worker, initargs=(self.options(),)) as pool:
+                    results = pool.imap(_convert_in_worker, sources, chunksize=chunksize)
+                    if incremental:
+                        results = checkpointed(results)
+                    report = self.collect_report(results, store, total)
+
+            if incremental:
+                if store is not None:
+                    store.flush()
+                self.save_manifest(manifest)
+                report['cache_hits'] = len(hashes) - total
+                report['rebuilt'] = report['converted']
+                report['pruned'] = len(deleted)
+                print(f"Incremental run: {report['cache_hits']} unchanged, {report['rebuilt']} rebuilt, "
+                      f"{report['pruned']} deleted files pruned")
+        finally:
+            if store is not None:
+                store.close()
+        self.metrics.set_gauge('matrix_files_per_second', report['files_per_second'])
+        print(f"Failed to convert {len(report['failed'])} of {report['total']} Java files")
+        if report['unknown_pairs']:
+            print(f"Skipped triads of {len(report['unknown_pairs'])} node2groups pairs missing from type.json")
+        return report
+
+    def collect_report(self, results, store=None, total=None):
+        """
+            Consumes per-file conversion results and gathers them into a structured report.
+
+            Args:
+            results (iterable): The values returned by convert_file, in input order.
+            store (MatrixStore, optional): The store that matrices of the 'store' backend are appended to.
+            total (int, optional): Number of results, for the progress report.
+
+            Returns:
+            dict: 'total' files seen, 'converted' files, 'matrices' generated, 'failed' records,
+                  'unknown_pairs' counts and the 'files_per_second' throughput.
         """
-        # Read all java files from a folder
         j = 0
-        javalist = self.listdir(self.java_path)
-        for javafile in javalist:
-            try:
-                self.second_order_matrix(javafile, self.npy_path)
-            except (UnicodeDecodeError, javalang.parser.JavaSyntaxError, javalang.tokenizer.LexerError):
-                print(javafile)
+        n_matrices = 0
+        failed = []
+        unknown_pairs = Counter()
+        metrics = self.metrics
+        progress = Progress('Java files converted to a matrix', total)
+        for failure, unknown, stored, timings, names in results:
+            unknown_pairs.update(unknown)
+            n_matrices += len(names)
+            if stored:
+                start = time.perf_counter()
+                for name, matrix in stored:
+                    store.append(name, matrix)
+                timings['save'] = time.perf_counter() - start
+            metrics.inc('matrix_null_tokens_total', timings.pop('null_tokens', 0))
+            for substep, seconds in timings.items():
+                metrics.observe(f'matrix_{substep}_seconds', seconds)
+            if failure is not None:
+                metrics.inc('matrix_parse_failures_total', error=failure['error'])
+                failed.append(failure)
+            metrics.inc('matrix_unknown_pairs_total', sum(unknown.values()))
             j += 1
-            print(f"Number of Java files converted to a matrix: {j}")
+            progress.update()
+        files_per_second = progress.close()
+        metrics.inc('matrix_files_total', j - len(failed), status='converted')
+        metrics.inc('matrix_files_total', len(failed), status='failed')
+        metrics.inc('matrix_matrices_total', n_matrices)
+        return {'total': j, 'converted': j - len(failed), 'matrices': n_matrices, 'failed': failed,
+                'unknown_pairs': dict(unknown_pairs), 'files_per_second': files_per_second}
 
 
 if __name__ == '__main__':
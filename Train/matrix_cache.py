@@ -0,0 +1,80 @@
+from collections import OrderedDict
+
+
+class MatrixCache:
+    """
+        A least-recently-used cache of loaded matrices bounded by a memory budget in bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """
+            Args:
+            max_bytes (int): Memory budget of the cached matrices. 0 disables caching.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def size_of(matrix):
+        """
+            Returns the number of bytes a dense or scipy sparse matrix holds.
+        """
+        if hasattr(matrix, 'indptr'):
+            return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+        return matrix.nbytes
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name, loader):
+        """
+            Returns the cached matrix of a name, loading and caching it on a miss.
+
+            Args:
+            name (str): The id of the matrix.
+            loader (callable): Called with the name to load the matrix on a miss.
+
+            Returns:
+            The cached or freshly loaded matrix.
+        """
+        if name in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return self.entries[name]
+        self.misses += 1
+        matrix = loader(name)
+        self.put(name, matrix)
+        return matrix
+
+    def put(self, name, matrix):
+        """
+            Caches a matrix, evicting the least recently used ones until the budget is met.
+            Matrices larger than the whole budget are not cached.
+        """
+        size = self.size_of(matrix)
+        if size > self.max_bytes:
+            return
+        if name in self.entries:
+            self.bytes -= self.size_of(self.entries.pop(name))
+        self.entries[name] = matrix
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self.size_of(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        """
+            Returns hit/miss statistics and the current memory use of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes}
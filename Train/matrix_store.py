@@ -0,0 +1,145 @@
+import numpy as np
+import json
+import os
+
+
+class MatrixStore:
+    """
+        Stores many same-shaped matrices in a few large shard files plus one id -> (shard, row) index,
+        instead of one .npy file per matrix. Shards are raw arrays that are appended to and read back
+        through np.memmap, so reads are zero-copy views into the page cache.
+    """
+    index_name = 'index.json'
+
+    def __init__(self, path, mode='r', dtype='float64', shape=(493, 72), shard_size=4096):
+        """
+            Args:
+            path (str): Directory holding the shards and the index.
+            mode (str): 'r' to read an existing store, 'a' to create or append to one.
+            dtype (str): Element type of new stores, e.g. 'float64' or 'float32'. Existing stores keep theirs.
+            shape (tuple): Shape of every matrix of a new store.
+            shard_size (int): Number of matrices per shard file of a new store.
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError(f"Unknown mode {mode!r}, expected 'r' or 'a'")
+        self.path = path
+        self.mode = mode
+        index_path = os.path.join(path, self.index_name)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as file:
+                index = json.load(file)
+        elif mode == 'a':
+            os.makedirs(path, exist_ok=True)
+            index = {'dtype': np.dtype(dtype).name, 'shape': list(shape), 'shard_size': shard_size,
+                     'counts': [], 'ids': {}}
+        else:
+            raise FileNotFoundError(f"No matrix store index at {index_path}")
+        self.dtype = np.dtype(index['dtype'])
+        self.shape = tuple(index['shape'])
+        self.shard_size = index['shard_size']
+        self.counts = index['counts']
+        self.ids = index['ids']
+        self.matrix_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shards = {}
+        self.writer = None
+        self.dirty = False
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, MatrixStore.index_name))
+
+    def shard_path(self, shard):
+        return os.path.join(self.path, 'shard_{:05d}.bin'.format(shard))
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, name):
+        """
+            Returns the matrix stored under a name as a read-only view into its shard.
+
+            Args:
+            name (str): The id the matrix was appended under.
+
+            Returns:
+            np.ndarray: A memory-mapped matrix of the store's shape and dtype.
+        """
+        shard, row = self.ids[name]
+        if shard not in self.shards:
+            if self.writer is not None:
+                self.writer.flush()
+            self.shards[shard] = np.memmap(self.shard_path(shard), dtype=self.dtype, mode='r',
+                                           shape=(self.counts[shard],) + self.shape)
+        return self.shards[shard][row]
+
+    def append(self, name, matrix):
+        """
+            Appends a matrix to the last shard, starting a new shard when it is full. Appending an
+            existing name again points the index at the new copy.
+
+            Args:
+            name (str): The id to store the matrix under.
+            matrix (np.ndarray): A matrix of the store's shape; it is cast to the store's dtype.
+        """
+        if self.mode != 'a':
+            raise IOError("Matrix store is opened read-only")
+        matrix = np.asarray(matrix, dtype=self.dtype)
+        if matrix.shape != self.shape:
+            raise ValueError(f"Expected a matrix of shape {self.shape}, got {matrix.shape}")
+        if not self.counts or self.counts[-1] >= self.shard_size:
+            self.counts.append(0)
+            self.close_writer()
+        shard = len(self.counts) - 1
+        if self.writer is None:
+            self.writer = open(self.shard_path(shard), 'ab')
+            # Drop any partially written matrix left behind by an interrupted run
+            self.writer.truncate(self.counts[shard] * self.matrix_bytes)
+            self.writer.seek(0, os.SEEK_END)
+        self.writer.write(matrix.tobytes())
+        self.ids[name] = [shard, self.counts[shard]]
+        self.counts[shard] += 1
+        # Cached read maps of a shard that grew no longer cover all of it
+        self.shards.pop(shard, None)
+        self.dirty = True
+
+    def remove(self, name):
+        """
+            Drops a name from the index; its row stays in the shard until the store is rebuilt.
+        """
+        if self.ids.pop(name, None) is not None:
+            self.dirty = True
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def flush(self):
+        """
+            Flushes appended matrices and atomically rewrites the index.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        if not self.dirty:
+            return
+        index = {'dtype': self.dtype.name, 'shape': list(self.shape), 'shard_size': self.shard_size,
+                 'counts': self.counts, 'ids': self.ids}
+        tmp_path = os.path.join(self.path, self.index_name + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, os.path.join(self.path, self.index_name))
+        self.dirty = False
+
+    def close(self):
+        self.flush()
+        self.close_writer()
+        self.shards = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,150 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+        A registry of timers, counters and gauges shared by the pipeline stages.
+
+        Timers accumulate the count, total and maximum of observed durations; counters and gauges
+        may carry labels, e.g. metrics.inc('matrix_parse_failures_total', error='JavaSyntaxError').
+        The registry can be exported as JSON or in the Prometheus text format, and snapshots taken
+        in worker processes can be merged into it.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @staticmethod
+    def key(labels):
+        return tuple(sorted(labels.items()))
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds, count=1):
+        timer = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        timer['count'] += count
+        timer['seconds'] += seconds
+        timer['max_seconds'] = max(timer['max_seconds'], seconds if count == 1 else 0.0)
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = self.key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges.setdefault(name, {})[self.key(labels)] = value
+
+    def snapshot(self):
+        """
+            Returns the current values as a JSON-serializable dict.
+        """
+        def series(metrics):
+            return {name: [{'labels': dict(key), 'value': value} for key, value in values.items()]
+                    for name, values in metrics.items()}
+        return {'timers': {name: dict(timer) for name, timer in self.timers.items()},
+                'counters': series(self.counters), 'gauges': series(self.gauges)}
+
+    def merge(self, snapshot):
+        """
+            Adds the timers and counters of a snapshot, e.g. from a worker process; its gauges replace ours.
+        """
+        for name, timer in snapshot['timers'].items():
+            current = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            current['count'] += timer['count']
+            current['seconds'] += timer['seconds']
+            current['max_seconds'] = max(current['max_seconds'], timer['max_seconds'])
+        for name, values in snapshot['counters'].items():
+            for sample in values:
+                self.inc(name, sample['value'], **sample['labels'])
+        for name, values in snapshot['gauges'].items():
+            for sample in values:
+                self.set_gauge(name, sample['value'], **sample['labels'])
+
+    def to_json(self, path=None):
+        """
+            Returns the snapshot as JSON text, and writes it to path when given.
+        """
+        text = json.dumps(self.snapshot(), indent=2)
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def to_prometheus(self, path=None, prefix='amainplus_'):
+        """
+            Returns the metrics in the Prometheus text exposition format, and writes them to path when given.
+            Timers are exported as summaries with _sum and _count samples.
+        """
+        def sample(name, labels, value):
+            if labels:
+                name += '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+            return f'{name} {value}'
+
+        lines = []
+        for name, timer in sorted(self.timers.items()):
+            lines.append(f'# TYPE {prefix}{name} summary')
+            lines.append(sample(f'{prefix}{name}_sum', (), timer['seconds']))
+            lines.append(sample(f'{prefix}{name}_count', (), timer['count']))
+        for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+            for name, values in sorted(metrics.items()):
+                lines.append(f'# TYPE {prefix}{name} {kind}')
+                lines.extend(sample(prefix + name, key, value) for key, value in sorted(values.items()))
+        text = '\n'.join(lines) + '\n'
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def summary(self):
+        """
+            Returns one line per timer with its total time, count and mean, slowest first.
+        """
+        lines = []
+        for name, timer in sorted(self.timers.items(), key=lambda item: -item[1]['seconds']):
+            mean = timer['seconds'] / timer['count'] if timer['count'] else 0.0
+            lines.append('{:32s} {:10.3f} s {:10d} x {:10.3f} ms'.format(name, timer['seconds'], timer['count'],
+                                                                         mean * 1000))
+        return '\n'.join(lines)
+
+
+class Progress:
+    """
+        Reports the progress of a long loop at most once per interval seconds, instead of once per item.
+    """
+
+    def __init__(self, label, total=None, interval=5.0, stream=None):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.count = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def update(self, n=1):
+        self.count += n
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        done = f'{self.count}/{self.total}' if self.total is not None else str(self.count)
+        print(f'{self.label}: {done} ({rate:.1f}/s)', file=self.stream, flush=True)
+
+    def close(self):
+        self.report()
+        return self.count / (time.perf_counter() - self.start or float('inf'))
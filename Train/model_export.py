@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from Train.feature_selection import load_model_features
+
+# Extensions of XGBoost's native model formats; any other model path is read as a joblib pickle
+EXPORT_FORMATS = ('ubj', 'json')
+
+
+def export_path(model_path, format='ubj'):
+    return os.path.splitext(model_path)[0] + '.' + format
+
+
+def is_exported(model_path):
+    return os.path.splitext(model_path)[1].lstrip('.') in EXPORT_FORMATS
+
+
+def prune_tree(tree, min_hessian=0.0, tolerance=0.0):
+    """
+        Collapses the splits at the bottom of a tree of an XGBoost JSON model into leaves, in place.
+        A split of two leaves is collapsed when either leaf holds less than min_hessian of the training
+        hessian, i.e. was grown for a handful of samples, or when the two leaf values differ by at most
+        tolerance. The new leaf takes the hessian-weighted mean of the two values, and collapsing repeats
+        upwards until no split qualifies. The remaining nodes are renumbered breadth-first.
+
+        Returns:
+        int: The number of nodes left in the tree.
+    """
+    left, right = tree['left_children'], tree['right_children']
+    values, hessians = tree['split_conditions'], tree['sum_hessian']
+    if tree['categories_nodes']:
+        raise ValueError("Trees with categorical splits cannot be pruned")
+    is_leaf = [child == -1 for child in left]
+    order = [0]
+    for node in order:
+        if not is_leaf[node]:
+            order.extend((left[node], right[node]))
+    # Children come after their parents breadth-first, so the reversed order collapses bottom-up
+    for node in reversed(order):
+        if is_leaf[node] or not (is_leaf[left[node]] and is_leaf[right[node]]):
+            continue
+        left_hessian, right_hessian = hessians[left[node]], hessians[right[node]]
+        if (min(left_hessian, right_hessian) >= min_hessian and
+                abs(values[left[node]] - values[right[node]]) > tolerance):
+            continue
+        total = left_hessian + right_hessian
+        values[node] = ((left_hessian * values[left[node]] + right_hessian * values[right[node]]) / total
+                        if total > 0 else (values[left[node]] + values[right[node]]) / 2)
+        is_leaf[node] = True
+
+    order = [0]
+    for node in order:
+        if not is_leaf[node]:
+            order.extend((left[node], right[node]))
+    ids = {node: index for index, node in enumerate(order)}
+    for key in ('base_weights', 'default_left', 'loss_changes', 'split_conditions', 'split_indices',
+                'split_type', 'sum_hessian'):
+        tree[key] = [tree[key][node] for node in order]
+    tree['left_children'] = [-1 if is_leaf[node] else ids[left[node]] for node in order]
+    tree['right_children'] = [-1 if is_leaf[node] else ids[right[node]] for node in order]
+    parents = [2147483647] * len(order)
+    for node, index in ids.items():
+        if not is_leaf[node]:
+            parents[ids[left[node]]] = parents[ids[right[node]]] = index
+    tree['parents'] = parents
+    for node in range(len(order)):
+        if tree['left_children'][node] == -1:
+            tree['split_indices'][node] = 0
+            tree['loss_changes'][node] = 0.0
+    tree['tree_param']['num_nodes'] = str(len(order))
+    tree['tree_param']['num_deleted'] = '0'
+    return len(order)
+
+
+def export_model(model_path='best_model.pkl', out_path=None, format='ubj', prune=False, min_hessian=1.0,
+                 tolerance=0.0):
+    """
+        Saves the classifier pickled by FeatureClassification.XGBOOST in XGBoost's native format, which
+        loads without sklearn or joblib and does not depend on the Python library versions. The feature
+        order the model expects is recorded in the model file, and trees past the best early stopping
+        iteration are dropped. Without pruning, the export predicts exactly what the pickle predicts.
+
+        Args:
+        model_path (str): The pickled classifier.
+        out_path (str, optional): Path of the exported model, by default the model path with the format's extension.
+        format (str): 'ubj' (binary) or 'json'.
+        prune (bool): Collapse small and near-equal leaves with prune_tree for a smaller, faster model. Off by
+                      default, since pruning changes the predictions: compare them with compare_models first.
+        min_hessian (float): When pruning, collapse leaves holding less training hessian than this.
+        tolerance (float): When pruning, also merge sibling leaves whose values differ by at most this.
+
+        Returns:
+        dict: The export path, the number of trees and of nodes before and after pruning, and the file size.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {format!r}, expected one of {EXPORT_FORMATS}")
+    import joblib
+    import xgboost
+    out_path = out_path or export_path(model_path, format)
+    booster = joblib.load(model_path).get_booster()
+    best_iteration = booster.attr('best_iteration')
+    if best_iteration is not None:
+        booster = booster[:int(best_iteration) + 1]
+
+    model = json.loads(booster.save_raw('json'))
+    trees = model['learner']['gradient_booster']['model']['trees']
+    nodes = sum(int(tree['tree_param']['num_nodes']) for tree in trees)
+    if prune and (min_hessian > 0 or tolerance > 0):
+        pruned_nodes = sum(prune_tree(tree, min_hessian, tolerance) for tree in trees)
+        booster = xgboost.Booster()
+        booster.load_model(bytearray(json.dumps(model).encode('utf-8')))
+    else:
+        pruned_nodes = nodes
+
+    feature_indices = load_model_features(model_path)
+    booster.set_attr(feature_indices=json.dumps(feature_indices))
+    booster.save_model(out_path)
+    return {'path': out_path, 'trees': len(trees), 'nodes': nodes, 'pruned_nodes': pruned_nodes,
+            'bytes': os.path.getsize(out_path)}
+
+
+class CompactModel:
+    """
+        A model exported by export_model, scoring whole NumPy batches of distance features with
+        XGBoost's in-place prediction, without sklearn or an intermediate DMatrix.
+    """
+
+    def __init__(self, model_path='best_model.ubj', nthread=None):
+        """
+            Args:
+            model_path (str): The exported model.
+            nthread (int, optional): Threads of a prediction, by default all cores.
+        """
+        import xgboost
+        self.booster = xgboost.Booster(model_file=model_path)
+        if nthread is not None:
+            self.booster.set_param({'nthread': nthread})
+        # The top-k features the model was trained on, None for all 288
+        self.feature_indices = json.loads(self.booster.attr('feature_indices') or 'null')
+
+    def predict(self, features):
+        """
+            Returns the clone probability of every row of a (rows, features) array.
+        """
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if not len(features):
+            return np.zeros(0, dtype=np.float32)
+        return self.booster.inplace_predict(features)
+
+    def predict_proba(self, features):
+        """
+            Returns the probabilities of both classes, like XGBClassifier.predict_proba.
+        """
+        probabilities = self.predict(features)
+        return np.column_stack([1 - probabilities, probabilities])
+
+
+def load_model(model_path, nthread=None):
+    """
+        Loads a model saved by FeatureClassification.XGBOOST or export_model, chosen by the extension.
+
+        Returns:
+        tuple: The model, which has predict_proba, and the features it was trained on, None for all 288.
+    """
+    if is_exported(model_path):
+        model = CompactModel(model_path, nthread)
+        return model, model.feature_indices
+    import joblib
+    model = joblib.load(model_path)
+    if nthread is not None:
+        model.set_params(n_jobs=nthread)
+    return model, load_model_features(model_path)
+
+
+def load_seconds(model_path, runs=5):
+    """
+        Returns the fastest load of a model by load_model in a fresh interpreter, after its imports.
+    """
+    code = ('import time, sys; from Train.model_export import load_model; import joblib, xgboost; '
+            'start = time.perf_counter(); load_model(sys.argv[1]); print(time.perf_counter() - start)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return min(float(subprocess.run([sys.executable, '-c', code, os.path.abspath(model_path)], capture_output=True,
+                                    text=True, check=True, cwd=root).stdout.split()[-1]) for _ in range(runs))
+
+
+def compare_models(model_paths, features, batch_size=4096, nthread=None, runs=3):
+    """
+        Compares the pickled model with its exports: file size, load time and batch prediction throughput,
+        and how far the predictions of every model are from those of the first.
+
+        Args:
+        model_paths (list): The pickle followed by the exported models.
+        features (np.ndarray): Feature rows to predict, in the layout of the models.
+        batch_size (int): Rows per prediction call.
+        nthread (int, optional): Threads of a prediction.
+        runs (int): Repetitions of the load and prediction timings; the fastest counts.
+
+        Returns:
+        list: One dict per model.
+    """
+    results = []
+    reference = None
+    for model_path in model_paths:
+        model, _ = load_model(model_path, nthread)
+        probabilities = np.concatenate([model.predict_proba(features[start:start + batch_size])[:, 1]
+                                        for start in range(0, len(features), batch_size)])
+        seconds = []
+        for _ in range(runs):
+            start_time = time.perf_counter()
+            for start in range(0, len(features), batch_size):
+                model.predict_proba(features[start:start + batch_size])
+            seconds.append(time.perf_counter() - start_time)
+        if reference is None:
+            reference = probabilities
+        results.append({'model': model_path, 'bytes': os.path.getsize(model_path),
+                        'load_ms': load_seconds(model_path, runs) * 1000,
+                        'predictions_per_s': len(features) / min(seconds) if min(seconds) > 0 else None,
+                        'max_abs_diff': float(np.abs(probabilities - reference).max()) if len(features) else 0.0,
+                        'label_agreement': float(np.mean((probabilities > 0.5) == (reference > 0.5)))
+                        if len(features) else 1.0})
+    return results
+
+
+if __name__ == '__main__':
+    # Example usage: python -m Train.model_export best_model.pkl --prune --min-hessian 2 --features T1_4_dis.csv
+    parser = argparse.ArgumentParser(description='Export a pickled model to the native XGBoost format.')
+    parser.add_argument('model', nargs='?', default='best_model.pkl')
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--format', default='ubj', choices=EXPORT_FORMATS)
+    parser.add_argument('--prune', action='store_true', help='prune the trees, which changes the predictions')
+    parser.add_argument('--min-hessian', type=float, default=1.0, help='prune leaves of less training hessian')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='also merge sibling leaves this close in value')
+    parser.add_argument('--features', default=None,
+                        help='feature CSV or binary feature file to compare the pickle and the export on')
+    parser.add_argument('--rows', type=int, default=100000, help='most feature rows to compare on')
+    parser.add_argument('--nthread', type=int, default=None)
+    args = parser.parse_args()
+
+    report = export_model(args.model, args.out, args.format, args.prune, args.min_hessian, args.tolerance)
+    print(report)
+    if args.features is not None:
+        from Train.feature_file import is_feature_file, load_feature_file
+        if is_feature_file(args.features):
+            features = np.asarray(load_feature_file(args.features)['features'][:args.rows])
+        else:
+            features = np.loadtxt(args.features, delimiter=',', dtype=np.float32, max_rows=args.rows, ndmin=2)
+        feature_indices = load_model_features(args.model)
+        if feature_indices is not None and features.shape[1] != len(feature_indices):
+            features = features[:, feature_indices]
+        for result in compare_models([args.model, report['path']], features, nthread=args.nthread):
+            print(result)
@@ -0,0 +1,113 @@
+import numpy as np
+import hashlib
+import os
+import sys
+import time
+from collections import deque
+from Train.get_matrix import JavaSyntaxMatrixGenerator
+from Train.get_distance import paired_column_distances
+from Train.matrix_cache import MatrixCache
+from Train.model_export import load_model
+
+
+class ClonePredictor:
+    """
+        Scores pairs of Java methods with a trained model. The model and the type.json dictionaries are
+        loaded once, and matrices and features are computed in memory without writing .npy or CSV files.
+    """
+
+    def __init__(self, model_path='best_model.pkl', json_path='type.json', cache_bytes=64 * 1024 * 1024, nthread=None,
+                 latency_window=10000):
+        """
+            Args:
+            model_path (str): The classifier saved by FeatureClassification.XGBOOST, or its export by
+                              model_export.export_model (.ubj or .json), which loads without sklearn.
+            json_path (str): The node and token dictionaries the model was trained with.
+            cache_bytes (int): Memory budget of the matrices cached by source content.
+            nthread (int, optional): Threads of a model call, by default all cores.
+            latency_window (int|None): Number of recent pair latencies and batch throughputs kept for stats,
+                                       0 to record none and None to keep all of them.
+        """
+        # The model and the top-k features it was trained on, None for all 288
+        self.model, self.feature_indices = load_model(model_path, nthread)
+        self.generator = JavaSyntaxMatrixGenerator(None, json_path=json_path)
+        self.cache = MatrixCache(cache_bytes)
+        self.pair_latencies = deque(maxlen=latency_window)
+        self.batch_throughputs = deque(maxlen=latency_window)
+
+    def read_source(self, source):
+        """
+            Returns the Java source of a path, or the argument itself when it already is source text.
+        """
+        if '{' not in source and os.path.isfile(source):
+            with open(source, encoding='utf-8') as file:
+                return file.read()
+        return source
+
+    def matrix(self, source):
+        """
+            Returns the state transition matrix of a Java method given as a path or as source text.
+            Matrices are cached by the SHA-256 of the source, so a method that recurs is parsed once.
+        """
+        programtext = self.read_source(source)
+        key = hashlib.sha256(programtext.encode('utf-8')).hexdigest()
+        return self.cache.get(key, lambda _: self.generator.source_matrix(programtext))
+
+    def features(self, pairs):
+        """
+            Computes the distance features the model expects of (source1, source2) pairs.
+
+            Returns:
+            np.ndarray: The features of every pair, of shape (pairs, 288) or (pairs, k) for a top-k model.
+        """
+        matrices1 = np.stack([self.matrix(source1) for source1, _ in pairs])
+        matrices2 = np.stack([self.matrix(source2) for _, source2 in pairs])
+        return paired_column_distances(matrices1, matrices2, self.feature_indices)
+
+    def predict_batch(self, pairs):
+        """
+            Returns the clone probability of every (source1, source2) pair, where each source is a path
+            to a Java file holding one method or the method's source text.
+
+            Args:
+            pairs (list): (source1, source2) tuples.
+
+            Returns:
+            np.ndarray: The probability that each pair is a clone.
+        """
+        if not pairs:
+            return np.zeros(0)
+        start = time.perf_counter()
+        probabilities = self.model.predict_proba(self.features(pairs))[:, 1]
+        elapsed = time.perf_counter() - start
+        self.pair_latencies.extend([elapsed / len(pairs)] * len(pairs))
+        self.batch_throughputs.append(len(pairs) / elapsed if elapsed > 0 else float('inf'))
+        return probabilities
+
+    def predict(self, source1, source2):
+        """
+            Returns the clone probability of a single pair of Java methods.
+        """
+        return float(self.predict_batch([(source1, source2)])[0])
+
+    def stats(self):
+        """
+            Reports the per-pair latency percentiles in milliseconds and the mean batch throughput in pairs/s,
+            over the latency window.
+        """
+        if not self.pair_latencies:
+            return {'pairs': 0}
+        latencies = np.array(self.pair_latencies) * 1000
+        return {'pairs': len(latencies),
+                'latency_ms_p50': float(np.percentile(latencies, 50)),
+                'latency_ms_p95': float(np.percentile(latencies, 95)),
+                'latency_ms_p99': float(np.percentile(latencies, 99)),
+                'throughput_pairs_per_s': float(np.mean(self.batch_throughputs)),
+                'cache': self.cache.stats()}
+
+
+if __name__ == '__main__':
+    # Example usage: python -m Train.predict First.java Second.java
+    predictor = ClonePredictor()
+    print(predictor.predict(sys.argv[1], sys.argv[2]))
+    print(predictor.stats())
@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+import numpy as np
+from Train.predict import ClonePredictor
+
+
+class CloneDetectionServer:
+    """
+        A long-running local HTTP server (over TCP or a Unix socket) in front of a ClonePredictor.
+        Pairs from concurrent requests are queued and coalesced into micro-batches, so that each
+        model call scores a whole batch, and method matrices are cached by source content hash.
+
+        POST /predict  {"pairs": [[source1, source2], ...]} -> {"probabilities": [...]}
+                       Sources are method source text or paths to Java files; an unparsable pair gets null.
+        GET  /stats    queue depth, batch sizes, latency percentiles and matrix cache statistics.
+    """
+
+    def __init__(self, predictor, max_batch=256, max_wait_ms=5.0, latency_window=10000):
+        """
+            Args:
+            predictor (ClonePredictor): The loaded model and dictionaries, best with latency_window=0 since
+                                        the server records the latencies itself.
+            max_batch (int): Largest number of pairs scored by one model call.
+            max_wait_ms (float): How long a batch waits for more pairs after its first one.
+            latency_window (int): Number of recent request latencies kept for the percentiles.
+        """
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.latencies = deque(maxlen=latency_window)
+        self.batch_sizes = deque(maxlen=latency_window)
+        self.requests = 0
+        self.pairs = 0
+
+    async def score(self, pairs):
+        """
+            Queues pairs for the batcher and waits for their probabilities.
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for pair in pairs:
+            future = loop.create_future()
+            await self.queue.put((pair, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def batcher(self):
+        """
+            Collects queued pairs into batches of up to max_batch, waiting at most max_wait after the
+            first pair, and scores each batch in a worker thread so the event loop keeps accepting requests.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.append(len(batch))
+            try:
+                probabilities, error = await loop.run_in_executor(None, self.run_batch, [pair for pair, _ in batch])
+            except Exception as e:
+                probabilities, error = None, e
+            # Every waiting request is answered, with an error when the batch failed
+            for index, (_, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(RuntimeError(f"Scoring the batch failed: {error!r}"))
+                else:
+                    future.set_result(probabilities[index])
+
+    def run_batch(self, pairs):
+        """
+            Runs score_batch in a worker thread and returns its probabilities and error instead of raising
+            it: an exception such as StopIteration cannot be set on the future of run_in_executor, which
+            would then never complete.
+        """
+        try:
+            return self.score_batch(pairs), None
+        except Exception as e:
+            return None, e
+
+    def score_batch(self, pairs):
+        """
+            Scores a batch with one model call; pairs whose sources cannot be read or parsed score None.
+        """
+        valid = []
+        for index, (source1, source2) in enumerate(pairs):
+            try:
+                # Warms the matrix cache, so the batch call below does not parse again
+                self.predictor.matrix(source1)
+                self.predictor.matrix(source2)
+                valid.append(index)
+            except Exception:
+                # Besides conversion_errors(), a source may fail to read or hit another parser error
+                pass
+        probabilities = [None] * len(pairs)
+        if valid:
+            scores = self.predictor.predict_batch([pairs[index] for index in valid])
+            for index, score in zip(valid, scores):
+                probabilities[index] = float(score)
+        return probabilities
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {'requests': self.requests, 'pairs': self.pairs,
+                'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+                'batch_size_mean': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                'latency_ms_p50': float(np.percentile(latencies, 50)),
+                'latency_ms_p95': float(np.percentile(latencies, 95)),
+                'latency_ms_p99': float(np.percentile(latencies, 99)),
+                'cache': self.predictor.cache.stats()}
+
+    async def handle(self, method, path, body):
+        """
+            Dispatches one HTTP request and returns the status code and the JSON response.
+        """
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        if method == 'POST' and path == '/predict':
+            try:
+                pairs = [tuple(pair) for pair in json.loads(body)['pairs']]
+                if any(len(pair) != 2 or not all(isinstance(source, str) for source in pair) for pair in pairs):
+                    raise ValueError
+            except (ValueError, KeyError, TypeError):
+                return 400, {'error': 'expected {"pairs": [[source1, source2], ...]}'}
+            start = time.perf_counter()
+            probabilities = await self.score(pairs)
+            self.latencies.append(time.perf_counter() - start)
+            self.requests += 1
+            self.pairs += len(pairs)
+            return 200, {'probabilities': probabilities}
+        return 404, {'error': 'not found'}
+
+    async def connection(self, reader, writer):
+        """
+            Serves the requests of one keep-alive HTTP/1.1 connection.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, response = await self.handle(method, path, body)
+                except Exception as e:
+                    status, response = 500, {'error': str(e)}
+                payload = json.dumps(response).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                             'Connection: {}\r\n\r\n'.format(status, 'OK' if status == 200 else 'Error', len(payload),
+                                                             'keep-alive' if keep_alive else 'close')
+                             .encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_path=None):
+        """
+            Starts the batcher and serves forever on a TCP port or, when unix_path is given, a Unix socket.
+        """
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.connection, path=unix_path)
+            print(f"Serving clone detection on unix:{unix_path}")
+        else:
+            server = await asyncio.start_server(self.connection, host, port)
+            print(f"Serving clone detection on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local clone detection server with request micro-batching.')
+    parser.add_argument('--model', default='best_model.pkl', help='pickled model, or its .ubj / .json export')
+    parser.add_argument('--json', default='type.json')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='serve on this Unix socket path instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--cache-mb', type=int, default=256)
+    parser.add_argument('--nthread', type=int, default=None, help='threads of a model call')
+    args = parser.parse_args()
+
+    # The server keeps its own latency window, so the predictor records none
+    predictor = ClonePredictor(args.model, args.json, cache_bytes=args.cache_mb * 1024 * 1024, nthread=args.nthread,
+                               latency_window=0)
+    server = CloneDetectionServer(predictor, args.max_batch, args.max_wait_ms)
+    asyncio.run(server.serve(args.host, args.port, args.unix))
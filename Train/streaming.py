@@ -0,0 +1,269 @@
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from multiprocessing import Pool
+import numpy as np
+from Train.get_matrix import JavaSyntaxMatrixGenerator, conversion_errors
+from Train.get_distance import DistanceCalculator, paired_column_distances
+from Train.feature_file import FeatureFileWriter
+from Train.matrix_store import MatrixStore
+from Train.metrics import Metrics, Progress
+
+# Generator instance owned by each worker process, and whether it saves the matrices it builds
+_worker_generator = None
+_worker_persist = False
+
+
+def _init_worker(options, persist):
+    global _worker_generator, _worker_persist
+    _worker_generator = JavaSyntaxMatrixGenerator(**options)
+    _worker_persist = persist
+
+
+def _matrix_in_worker(javafile):
+    return build_matrix(_worker_generator, javafile, _worker_persist)
+
+
+def build_matrix(generator, javafile, persist=False):
+    """
+        Builds the matrix of a Java file, saving it as well for the per-file backends when persist is set.
+
+        Returns:
+        tuple: The matrix id, the matrix (None when the file cannot be converted) and the error type.
+    """
+    name = generator.matrix_name(javafile)
+    try:
+        if persist and generator.backend != 'store':
+            matrix = generator.second_order_matrix(javafile, generator.npy_path)
+        else:
+            matrix = generator.build_matrix(javafile)
+    except conversion_errors() as e:
+        return name, None, type(e).__name__
+    return name, matrix, None
+
+
+class StreamingPipeline:
+    """
+        Fuses matrix generation and distance features: worker processes build matrices while this
+        process computes the features of every pair as soon as both of its matrices exist, writing
+        them straight into the training arrays. A matrix is dropped once all of its pairs are done,
+        and held matrices beyond a memory budget are spilled to a temporary directory, so that memory
+        stays bounded without writing the matrices or the feature CSVs.
+    """
+
+    def __init__(self, java_path, pair_paths, npy_path='./npy/', json_path='type.json', workers=1, backend='npy',
+                 feature_indices=None, cache_bytes=512 * 1024 * 1024, batch_size=256, persist=False, metrics=None,
+                 include=None, exclude=None):
+        """
+            Args:
+            java_path (str): Directory of the Java files, or an archive of them.
+            pair_paths (list): (CSV of pairs, label) tuples, e.g. [(clone_path, 1), (nonclone_path, 0)].
+            npy_path (str): Where matrices are written when persist is set.
+            json_path (str): The node and token dictionaries.
+            workers (int|None): Number of matrix worker processes. 1 builds them in this process, None uses every CPU.
+            backend (str): Backend of the persisted matrices: 'npy', 'sparse' or 'store'.
+            feature_indices (list, optional): Positions in the 288-value vector to compute, None for all of them.
+            cache_bytes (int): Memory budget of the matrices waiting for the other member of a pair.
+            batch_size (int): Number of ready pairs whose features are computed together.
+            persist (bool): Also save every matrix with the backend and the features as binary feature files.
+            metrics (Metrics, optional): Registry the pipeline records its timers and counters in.
+            include (list, optional): fnmatch patterns of the Java files to read, as for CorpusReader.
+            exclude (list, optional): fnmatch patterns of the files and directories to skip.
+        """
+        self.java_path = java_path
+        self.pair_paths = pair_paths
+        self.npy_path = npy_path
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.feature_indices = sorted(feature_indices) if feature_indices is not None else None
+        self.n_features = len(self.feature_indices) if self.feature_indices is not None else 288
+        self.cache_bytes = cache_bytes
+        self.batch_size = batch_size
+        self.persist = persist
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.generator = JavaSyntaxMatrixGenerator(java_path, npy_path, json_path, backend=backend,
+                                                   metrics=self.metrics, include=include, exclude=exclude)
+        # Matrices waiting for pairs, in arrival order, and where the spilled ones were written
+        self.held = OrderedDict()
+        self.held_bytes = 0
+        self.peak_bytes = 0
+        self.spilled = {}
+        self.spill_dir = None
+        self.spill_count = 0
+
+    def read_pairs(self):
+        """
+            Reads the pairs of every CSV with their label.
+
+            Returns:
+            list: (f1, f2, label) tuples.
+        """
+        pairs = []
+        for path, label in self.pair_paths:
+            calculator = DistanceCalculator(path)
+            pairs.extend((pair[0], pair[1], label) for pair in calculator.read_pairs() if pair is not None)
+        return pairs
+
+    def ordered_files(self, pairs, files):
+        """
+            Orders the Java files by the first pair that needs them, so that pairs complete early and
+            few matrices wait in memory. Files no pair needs are only converted when persisting.
+        """
+        ordered = []
+        seen = set()
+        for f1, f2, _ in pairs:
+            for name in (f1, f2):
+                if name not in seen and name in files:
+                    seen.add(name)
+                    ordered.append(files[name])
+        if self.persist:
+            ordered.extend(path for name, path in files.items() if name not in seen)
+        return ordered
+
+    def matrices(self, javafiles):
+        """
+            Yields (id, matrix, error) for every Java file, built by the worker pool while the caller
+            consumes earlier results.
+        """
+        persist = self.persist
+        if self.workers <= 1:
+            for javafile in javafiles:
+                yield build_matrix(self.generator, javafile, persist)
+            return
+        with Pool(self.workers, initializer=_init_worker, initargs=(self.generator.options(), persist)) as pool:
+            yield from pool.imap(_matrix_in_worker, javafiles, chunksize=16)
+
+    def hold(self, name, matrix):
+        self.held[name] = matrix
+        self.held_bytes += matrix.nbytes
+        while self.held_bytes > self.cache_bytes and len(self.held) > 1:
+            # Spill the matrix that has waited longest
+            spilled_name, spilled = self.held.popitem(last=False)
+            self.held_bytes -= spilled.nbytes
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix='amainplus_spill_')
+            path = os.path.join(self.spill_dir, f'{self.spill_count}.npy')
+            self.spill_count += 1
+            np.save(path, spilled)
+            self.spilled[spilled_name] = path
+            self.metrics.inc('stream_matrices_spilled_total')
+        self.peak_bytes = max(self.peak_bytes, self.held_bytes)
+
+    def get(self, name):
+        if name in self.held:
+            return self.held[name]
+        return np.load(self.spilled[name])
+
+    def release(self, name):
+        if name in self.held:
+            self.held_bytes -= self.held.pop(name).nbytes
+        elif name in self.spilled:
+            os.remove(self.spilled.pop(name))
+
+    def run(self):
+        """
+            Streams the pairs through matrix generation and distance features.
+
+            Returns:
+            tuple: The float32 feature matrix, the int8 labels and the (f1, f2) ids of every row, for the
+                   pairs whose two matrices could be built, in the order they were completed.
+        """
+        self.peak_bytes = 0
+        files = {self.generator.matrix_name(path): path for path in self.generator.listdir(self.java_path)}
+        # Like get_distance, pairs naming a file that does not exist are skipped
+        pairs = [pair for pair in self.read_pairs() if pair[0] in files and pair[1] in files]
+        waiting = defaultdict(list)
+        remaining = defaultdict(int)
+        for index, (f1, f2, _) in enumerate(pairs):
+            waiting[f1].append(index)
+            remaining[f1] += 1
+            if f2 != f1:
+                waiting[f2].append(index)
+            remaining[f2] += 1
+
+        features = np.empty((len(pairs), self.n_features), dtype=np.float32)
+        labels = np.empty(len(pairs), dtype=np.int8)
+        ids = []
+        writers = None
+        store = None
+        if self.persist:
+            writers = {label: FeatureFileWriter(os.path.splitext(os.path.basename(path))[0] + '_4_dis.feat',
+                                                self.n_features, label, feature_indices=self.feature_indices)
+                       for path, label in self.pair_paths}
+            os.makedirs(self.npy_path, exist_ok=True)
+            if self.generator.backend == 'store':
+                store = MatrixStore(self.npy_path, mode='a', dtype=self.generator.dtype)
+
+        available = set()
+        ready = []
+        progress = Progress('Pairs streamed', len(pairs))
+
+        def done(name):
+            remaining[name] -= 1
+            if not remaining[name]:
+                self.release(name)
+
+        def flush():
+            start = time.perf_counter()
+            matrices1 = np.stack([self.get(pairs[index][0]) for index in ready])
+            matrices2 = np.stack([self.get(pairs[index][1]) for index in ready])
+            rows = paired_column_distances(matrices1, matrices2, self.feature_indices)
+            position = len(ids)
+            features[position:position + len(ready)] = rows
+            for offset, index in enumerate(ready):
+                f1, f2, label = pairs[index]
+                labels[position + offset] = label
+                ids.append((f1, f2))
+                if writers is not None:
+                    writers[label].append(rows[offset:offset + 1], [(f1, f2)])
+                done(f1)
+                done(f2)
+            self.metrics.observe('stream_features_seconds', time.perf_counter() - start)
+            progress.update(len(ready))
+            ready.clear()
+
+        try:
+            for name, matrix, error in self.matrices(self.ordered_files(pairs, files)):
+                if error is not None:
+                    self.metrics.inc('matrix_parse_failures_total', error=error)
+                    # The pairs of an unconvertible file are dropped and stop holding their other member
+                    for index in waiting.pop(name, []):
+                        f1, f2, _ = pairs[index]
+                        done(f1)
+                        done(f2)
+                    continue
+                if store is not None:
+                    store.append(name, matrix)
+                if not remaining.get(name) or name in available:
+                    continue
+                if self.generator.backend == 'sparse' and self.persist:
+                    # Persisted matrices of the sparse backend come back in CSR form
+                    matrix = matrix.toarray()
+                available.add(name)
+                self.hold(name, matrix)
+                for index in waiting.pop(name):
+                    f1, f2, _ = pairs[index]
+                    if f1 in available and f2 in available:
+                        ready.append(index)
+                        if len(ready) >= self.batch_size:
+                            flush()
+            if ready:
+                flush()
+        finally:
+            if writers is not None:
+                for writer in writers.values():
+                    writer.close()
+            if store is not None:
+                store.close()
+            if self.spill_dir is not None:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+                self.spill_dir = None
+            self.held.clear()
+            self.spilled.clear()
+            self.held_bytes = 0
+
+        self.metrics.inc('stream_pairs_total', len(ids))
+        self.metrics.set_gauge('stream_held_bytes_peak', self.peak_bytes)
+        self.metrics.set_gauge('stream_pairs_per_second', progress.close())
+        return features[:len(ids)], labels[:len(ids)], ids
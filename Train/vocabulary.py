@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+
+# Layout of the compiled cache; bump it when the fields written by save change
+CACHE_VERSION = 1
+# Shape of the second-order state transition matrix: node2groups rows x (node types + token types) columns
+MATRIX_ROWS = 493
+MATRIX_COLS = 72
+# Column used for tokens that are neither a node type nor a known token type
+NULL_COLUMN = 62
+
+
+class Vocabulary:
+    """
+        type.json compiled into integer-coded lookup tables. Every node type name gets an id, and the
+        row of a triad is read from a 2-D table indexed by the ids of its first two tokens, instead of
+        looking up the string first + '2' + second in node2groups for every triad.
+
+        The compiled tables are cached next to type.json and rebuilt when its content changes.
+    """
+
+    def __init__(self, nodetypedict, tokendict, node2groups, source_hash=None):
+        self.nodetypedict = nodetypedict
+        self.tokendict = tokendict
+        self.node2groups = node2groups
+        self.source_hash = source_hash
+        names = list(nodetypedict)
+        pairs = [(self.split_pair(pair, nodetypedict), row) for pair, row in node2groups.items()]
+        for (first, second), _ in pairs:
+            names.extend(name for name in (first, second) if name not in nodetypedict)
+        self.names = list(dict.fromkeys(names))
+        self.ids = {name: index for index, name in enumerate(self.names)}
+        # pair_rows[first id, second id] is the matrix row of the pair, -1 when type.json has no such pair
+        self.pair_rows = np.full((len(self.names), len(self.names)), -1, dtype=np.int16)
+        for (first, second), row in pairs:
+            self.pair_rows[self.ids[first], self.ids[second]] = row
+
+    @staticmethod
+    def split_pair(pair, nodetypedict):
+        """
+            Splits a node2groups key such as 'ForStatement2BlockStatement' into its two node types.
+        """
+        splits = [(pair[:i], pair[i + 1:]) for i, char in enumerate(pair) if char == '2']
+        known = [split for split in splits if split[0] in nodetypedict and split[1] in nodetypedict]
+        if len(known) == 1:
+            return known[0]
+        if len(splits) == 1:
+            return splits[0]
+        raise ValueError(f"Cannot split the node2groups key {pair!r} into two node types")
+
+    @staticmethod
+    def cache_path(json_path):
+        return os.path.splitext(json_path)[0] + '.vocab.pkl'
+
+    @classmethod
+    def load(cls, json_path, cache_path=None):
+        """
+            Loads the compiled vocabulary of a type.json, compiling and caching it when there is no
+            cache yet or type.json changed since. The cache is trusted while the size and modification
+            time of type.json are unchanged, and otherwise checked against its content hash.
+
+            Args:
+            json_path (str): The node and token dictionaries.
+            cache_path (str, optional): Where the compiled tables are cached, by default <json stem>.vocab.pkl.
+
+            Returns:
+            Vocabulary: The compiled vocabulary.
+        """
+        cache_path = cache_path or cls.cache_path(json_path)
+        stat = os.stat(json_path)
+        source_stat = (stat.st_size, stat.st_mtime_ns)
+        cached = None
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as file:
+                    cached = pickle.load(file)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                cached = None
+            if not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION:
+                cached = None
+            elif cached['source_stat'] == source_stat:
+                return cached['vocabulary']
+
+        with open(json_path, 'rb') as file:
+            content = file.read()
+        source_hash = hashlib.sha256(content).hexdigest()
+        if cached is not None and cached['source_hash'] == source_hash:
+            vocabulary = cached['vocabulary']
+        else:
+            data = json.loads(content)
+            vocabulary = cls(data['nodetypedict'], data['tokendict'], data['node2groups'], source_hash)
+        vocabulary.save(cache_path, source_stat)
+        return vocabulary
+
+    def save(self, cache_path, source_stat):
+        try:
+            with open(cache_path + '.tmp', 'wb') as file:
+                pickle.dump({'version': CACHE_VERSION, 'source_hash': self.source_hash, 'source_stat': source_stat,
+                             'vocabulary': self}, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            # A read-only checkout still works, it just compiles type.json on every start
+            pass
+
+    def rows(self, firsts, seconds):
+        """
+            Looks up the rows of many triads at once.
+
+            Args:
+            firsts (np.ndarray): Ids of the first tokens. Ids past the vocabulary stand for names type.json lacks.
+            seconds (np.ndarray): Ids of the second tokens.
+
+            Returns:
+            np.ndarray: The row of every triad, -1 where type.json has no such pair.
+        """
+        size = len(self.names)
+        known = (firsts < size) & (seconds < size)
+        if known.all():
+            return self.pair_rows[firsts, seconds].astype(np.intp)
+        rows = np.full(len(firsts), -1, dtype=np.intp)
+        rows[known] = self.pair_rows[firsts[known], seconds[known]]
+        return rows
@@ -1,51 +1,348 @@
+import hashlib
+import json
 import os
+import random
+import shutil
 import time
+import numpy as np
 from Train.get_matrix import JavaSyntaxMatrixGenerator
 from Train.get_distance import DistanceCalculator
 from Train.classification import FeatureClassification
+from Train.feature_selection import read_weight_ranking, top_k as select_top_k
+from Train.corpus import CorpusReader
+from Train.metrics import Metrics
+from Train.model_export import export_model
+from Train.streaming import StreamingPipeline
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tree_fingerprint(path, include=None, exclude=None):
+    """
+        Fingerprints a directory tree or archive by the path, size and modification time of every file
+        the filters select, without reading them; the incremental matrix manifest checks the content of
+        the files that changed.
+    """
+    entries = [(os.path.relpath(file, path), size, mtime)
+               for file, size, mtime in CorpusReader(path, include, exclude).stats()]
+    return fingerprint(sorted(entries))
+
+
+def fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
 
 class TrainSystem:
-    def __init__(self, java_path, clone_path, nonclone_path, npy_path='./npy/', json_path='type.json'):
+    def __init__(self, java_path, clone_path, nonclone_path, npy_path='./npy/', json_path='type.json', workers=1,
+                 backend='npy', dtype='float64', incremental=False, feature_format='csv', top_k=None,
+                 weight_path=None, train_options=None, metrics_path=None, checkpoint_path=None,
+                 unit='method', export_format=None, export_options=None, include=None, exclude=None):
         self.java_path = java_path
         self.clone_path = clone_path
         self.nonclone_path = nonclone_path
         self.npy_path = npy_path
         self.json_path = json_path
+        self.workers = workers
+        # 'npy' writes one .npy per Java file, 'sparse' one CSR .npz per Java file,
+        # and 'store' a sharded MatrixStore of the given dtype under npy_path
+        self.backend = backend
+        self.dtype = dtype
+        # 'method' for a directory of single-method files, 'file' to parse whole Java files and build a matrix
+        # per method under the id file#class#method#line, which the clone and nonclone CSVs then refer to
+        self.unit = unit
+        # fnmatch patterns of the files under java_path to convert and to skip, e.g. ['*.java'] and ['test'].
+        # java_path may also be a zip or tar(.gz) archive, which is read without extracting it.
+        self.include = include
+        self.exclude = exclude
+        # Only regenerate matrices of new or changed Java files
+        self.incremental = incremental
+        # 'csv' feature files, or 'binary' float32 feature files that are memory-mapped for training
+        self.feature_format = feature_format
+        # Only train on the top_k features, None for all 288. By default they are ranked by the importances
+        # of a model trained on all features, so all 288 are computed; given a weight_path (e.g. 'weight.txt'),
+        # only the top_k of its ranking are computed, though weight.txt ranks a different feature layout
+        self.top_k = top_k
+        self.weight_path = weight_path
+        self.feature_indices = (select_top_k(read_weight_ranking(weight_path), top_k)
+                                if top_k is not None and weight_path is not None else None)
+        # Training settings of FeatureClassification, e.g. {'cpu_budget': 8, 'nthread': 2, 'tree_method': 'hist'}
+        self.train_options = train_options or {}
+        # Timers, counters and gauges of all stages; written to metrics_path (JSON) and
+        # its .prom sibling (Prometheus text) after a run when metrics_path is given
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        # Records the input fingerprints and completion of every stage, e.g. 'train_system_checkpoint.json'.
+        # Stages whose outputs are fresh are skipped and interrupted stages resume; None reruns everything.
+        self.checkpoint_path = checkpoint_path
+        # 'ubj' or 'json' to also save best_model.pkl in XGBoost's native format after training, which
+        # ClonePredictor loads without sklearn; export_options opt into pruning, which changes the predictions,
+        # e.g. {'prune': True, 'min_hessian': 2}
+        self.export_format = export_format
+        self.export_options = export_options or {}
         self.clone_feature_csv = os.path.splitext(os.path.basename(clone_path))[0]
         self.nonclone_feature_csv = os.path.splitext(os.path.basename(nonclone_path))[0]
 
-    def prepare_matrices(self):
+    def load_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as file:
+                return json.load(file)
+        return {}
+
+    def save_checkpoint(self, checkpoint):
+        with open(self.checkpoint_path + '.tmp', 'w') as file:
+            json.dump(checkpoint, file, indent=2)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def begin_stage(self, name, stage_fingerprint, outputs):
+        """
+            Looks up a stage in the checkpoint.
+
+            Args:
+            name (str): The stage.
+            stage_fingerprint (str): Fingerprint of everything the stage's outputs depend on.
+            outputs (list): Paths that must exist for completed outputs to count as fresh.
+
+            Returns:
+            dict|None: None when the stage completed with the same inputs and its outputs exist, so it can
+                       be skipped. Otherwise its checkpoint entry, marked as started, whose 'resumed' flag
+                       tells whether an interrupted run with the same inputs can be continued.
+        """
+        checkpoint = self.load_checkpoint()
+        entry = checkpoint.get(name, {})
+        same = entry.get('fingerprint') == stage_fingerprint
+        if same and entry.get('complete') and all(os.path.exists(path) for path in outputs):
+            print(f"Skipping {name}: outputs are up to date")
+            return None
+        entry = dict(entry) if same else {'fingerprint': stage_fingerprint}
+        entry.update({'complete': False, 'resumed': same})
+        checkpoint[name] = entry
+        self.save_checkpoint(checkpoint)
+        return entry
+
+    def complete_stage(self, name, entry):
+        checkpoint = self.load_checkpoint()
+        checkpoint[name] = dict(entry, complete=True, resumed=False)
+        self.save_checkpoint(checkpoint)
+
+    def stage_fingerprints(self):
+        """
+            Fingerprints the inputs and parameters of every stage. Each stage includes the fingerprint of
+            the stage it reads from, so that changed Java files also invalidate the features and the model.
+        """
+        matrices = fingerprint(tree_fingerprint(self.java_path, self.include, self.exclude), file_hash(self.json_path),
+                               self.backend, self.dtype, os.path.abspath(self.npy_path), self.unit)
+        distances = {label: fingerprint(matrices, file_hash(path), self.feature_indices, self.feature_format)
+                     for label, path in (('clone', self.clone_path), ('nonclone', self.nonclone_path))}
+        training = fingerprint(distances, self.feature_indices, self.top_k, self.train_options)
+        return {'matrices': matrices, 'distances_clone': distances['clone'],
+                'distances_nonclone': distances['nonclone'], 'training': training}
+
+    def feature_paths(self):
+        suffix = '_4_dis.feat' if self.feature_format == 'binary' else '_4_dis.csv'
+        return self.clone_feature_csv + suffix, self.nonclone_feature_csv + suffix
+
+    def prepare_matrices(self, fingerprints=None):
         print("Generating syntax matrices...")
-        syntax_matrix_generator = JavaSyntaxMatrixGenerator(self.java_path, self.npy_path, self.json_path)
+        entry = None
+        incremental = self.incremental
+        if fingerprints is not None:
+            entry = self.begin_stage('matrices', fingerprints['matrices'], [self.npy_path])
+            if entry is None:
+                return
+            # The incremental manifest is saved as files complete, so an interrupted run continues
+            # with the files that are left, and existing matrices of unchanged files are kept
+            incremental = True
+        syntax_matrix_generator = JavaSyntaxMatrixGenerator(self.java_path, self.npy_path, self.json_path,
+                                                            backend=self.backend, dtype=self.dtype,
+                                                            metrics=self.metrics, unit=self.unit,
+                                                            include=self.include, exclude=self.exclude)
         start_time = time.time()
-        syntax_matrix_generator.allmain()
+        with self.metrics.timer('stage_matrices_seconds'):
+            report = syntax_matrix_generator.allmain(workers=self.workers, incremental=incremental)
+        print("{} of {} Java files converted.".format(report['converted'], report['total']))
+        if self.unit == 'file':
+            print("{} method matrices generated.".format(report['matrices']))
+        if incremental:
+            print("{} unchanged Java files skipped.".format(report['cache_hits']))
         print("Matrix generation completed in {:.2f} seconds.".format(time.time() - start_time))
+        if entry is not None:
+            self.complete_stage('matrices', entry)
 
-    def calculate_distances(self):
+    def calculate_distances(self, fingerprints=None):
         print("Calculating distances...")
         start_time = time.time()
-        distance_calculator = DistanceCalculator(self.clone_path, self.npy_path)
-        distance_calculator.get_distance()
-        distance_calculator = DistanceCalculator(self.nonclone_path, self.npy_path)
-        distance_calculator.get_distance()
+        with self.metrics.timer('stage_distances_seconds'):
+            for name, path, label, output in (('distances_clone', self.clone_path, 1, self.feature_paths()[0]),
+                                              ('distances_nonclone', self.nonclone_path, 0, self.feature_paths()[1])):
+                entry = None
+                if fingerprints is not None:
+                    entry = self.begin_stage(name, fingerprints[name], [output])
+                    if entry is None:
+                        continue
+                distance_calculator = DistanceCalculator(path, self.npy_path, self.backend,
+                                                         feature_indices=self.feature_indices, metrics=self.metrics)
+                # An interrupted run with the same inputs continues after its last completed chunk
+                distance_calculator.get_distance(workers=self.workers, resume=entry is not None and entry['resumed'],
+                                                 output=self.feature_format, label=label)
+                if entry is not None:
+                    self.complete_stage(name, entry)
         print("Distance calculations completed in {:.2f} seconds.".format(time.time() - start_time))
 
-    def train_classifier(self):
+    def train_classifier(self, fingerprints=None):
         print("Training classifier...")
-        classifier = FeatureClassification(self.clone_feature_csv + '_4_dis.csv', self.nonclone_feature_csv + '_4_dis.csv')
-        classifier.run()
+        model_path = 'best_model.pkl'
+        entry = None
+        options = dict(self.train_options)
+        if fingerprints is not None:
+            entry = self.begin_stage('training', fingerprints['training'], [model_path])
+            if entry is None:
+                return
+            # Completed folds are kept until the stage completes; a resumed run reuses them and the
+            # shuffle seed, so that it cuts the same folds
+            options['checkpoint_dir'] = os.path.splitext(model_path)[0] + '.folds'
+            if not entry['resumed'] or 'seed' not in entry:
+                shutil.rmtree(options['checkpoint_dir'], ignore_errors=True)
+                entry['seed'] = random.randrange(2 ** 31)
+                checkpoint = self.load_checkpoint()
+                checkpoint['training'] = entry
+                self.save_checkpoint(checkpoint)
+            options['seed'] = entry['seed']
+        classifier = FeatureClassification(*self.feature_paths(), self.ranked_features(), model_path,
+                                           metrics=self.metrics, **options)
+        with self.metrics.timer('stage_training_seconds'):
+            classifier.run()
+        if entry is not None:
+            self.complete_stage('training', entry)
+            shutil.rmtree(options['checkpoint_dir'], ignore_errors=True)
         print("Classifier training completed.")
 
+    def ranked_features(self, vectors=None, labels=None):
+        """
+            Returns the features to train on: those of the weight_path ranking, the top_k by the importances
+            of a model trained on all features when no weight_path is given, or None for all 288.
+        """
+        if self.top_k is None or self.feature_indices is not None:
+            return self.feature_indices
+        print("Ranking features by the importances of a model trained on all of them...")
+        ranker = FeatureClassification(*self.feature_paths(), metrics=self.metrics, **self.train_options)
+        feature_indices = select_top_k(ranker.importance_ranking(vectors, labels), self.top_k)
+        print("Training on the top {} features: {}".format(self.top_k, feature_indices))
+        return feature_indices
+
+    def export_classifier(self, model_path='best_model.pkl'):
+        if self.export_format is None or not os.path.exists(model_path):
+            return
+        with self.metrics.timer('stage_export_seconds'):
+            report = export_model(model_path, format=self.export_format, **self.export_options)
+        self.metrics.set_gauge('model_export_bytes', report['bytes'])
+        self.metrics.set_gauge('model_export_nodes', report['pruned_nodes'])
+        print("Model exported to {} ({} of {} nodes, {} bytes).".format(report['path'], report['pruned_nodes'],
+                                                                       report['nodes'], report['bytes']))
+
+    def top_k_report(self, ks, ranking=None, sample_pairs=2000):
+        """
+            Reports, for every k, the accuracy of a classifier trained on the top k features and the
+            throughput of computing only those features. Needs the full 288-feature files of a previous run.
+
+            Args:
+            ks (iterable): The feature counts to evaluate.
+            ranking (list, optional): Feature indices from most to least important; by default the
+                                      importances of a model trained on all features.
+            sample_pairs (int): Number of clone pairs the feature throughput is measured on.
+
+            Returns:
+            list: One dict per k, as returned by FeatureClassification.top_k_report, with 'feature_pairs_per_s'.
+        """
+        suffix = '_4_dis.feat' if self.feature_format == 'binary' else '_4_dis.csv'
+        classifier = FeatureClassification(self.clone_feature_csv + suffix, self.nonclone_feature_csv + suffix,
+                                           **self.train_options)
+        results = classifier.top_k_report(ks, ranking)
+
+        sampler = DistanceCalculator(self.clone_path, self.npy_path, self.backend)
+        sampler.open_matrices()
+        pairs = next(sampler.iter_chunks(sample_pairs), [])
+        for result in results:
+            calculator = DistanceCalculator(self.clone_path, self.npy_path, self.backend,
+                                            feature_indices=result['feature_indices'])
+            calculator.open_matrices()
+            calculator.chunk_features(pairs)  # Warm the matrix cache, so only feature computation is timed
+            start = time.perf_counter()
+            _, computed = calculator.chunk_features(pairs)
+            elapsed = time.perf_counter() - start
+            result['feature_pairs_per_s'] = len(computed) / elapsed if elapsed > 0 else float('inf')
+            print("k={}: {:.0f} pairs/s".format(result['k'], result['feature_pairs_per_s']))
+        return results
+
     def run(self):
+        # With a checkpoint, fresh stages are skipped and interrupted ones resume
+        fingerprints = self.stage_fingerprints() if self.checkpoint_path is not None else None
+
         # Step 1: Generate the matrices
-        self.prepare_matrices()
+        self.prepare_matrices(fingerprints)
 
         # Step 2: Calculate distances between matrices
-        self.calculate_distances()
+        self.calculate_distances(fingerprints)
 
         # Step 3: Train the classification model
-        self.train_classifier()
+        self.train_classifier(fingerprints)
+
+        # Step 4: Export the model to XGBoost's native format, if asked for
+        self.export_classifier()
+
+        self.export_metrics()
+
+    def run_streaming(self, persist=False, cache_bytes=512 * 1024 * 1024):
+        """
+            Runs the pipeline as one fused stream instead of three batch stages: matrices are built by
+            the workers while the features of every pair whose two matrices exist are computed in this
+            process and go straight into the training arrays.
+
+            Args:
+            persist (bool): Also write the matrices to npy_path and the features as binary feature files.
+            cache_bytes (int): Memory budget of the matrices waiting for the other member of a pair.
+
+            Returns:
+            list: The mean F1 score, precision and recall of the cross-validation.
+        """
+        if self.unit != 'method':
+            raise ValueError("The streaming pipeline pairs one matrix per Java file, use unit='method'")
+        print("Streaming matrices and distances...")
+        start_time = time.time()
+        pipeline = StreamingPipeline(self.java_path, [(self.clone_path, 1), (self.nonclone_path, 0)], self.npy_path,
+                                     self.json_path, self.workers, self.backend, self.feature_indices, cache_bytes,
+                                     persist=persist, metrics=self.metrics, include=self.include,
+                                     exclude=self.exclude)
+        with self.metrics.timer('stage_streaming_seconds'):
+            vectors, labels, _ = pipeline.run()
+        print("{} pairs streamed in {:.2f} seconds.".format(len(labels), time.time() - start_time))
+
+        print("Training classifier...")
+        feature_indices = self.ranked_features(vectors, labels)
+        if feature_indices is not None and self.feature_indices is None:
+            vectors = np.ascontiguousarray(vectors[:, feature_indices])
+        classifier = FeatureClassification(None, None, feature_indices, metrics=self.metrics,
+                                           **self.train_options)
+        with self.metrics.timer('stage_training_seconds'):
+            target = classifier.XGBOOST(vectors, labels, order=np.random.permutation(len(labels)))
+        print(target)
+        print("Classifier training completed.")
+        self.export_metrics()
+        return target
+
+    def export_metrics(self):
+        """
+            Prints where the time went and writes the metrics to metrics_path, if given.
+        """
+        print(self.metrics.summary())
+        if self.metrics_path is not None:
+            self.metrics.to_json(self.metrics_path)
+            self.metrics.to_prometheus(os.path.splitext(self.metrics_path)[0] + '.prom')
 
 
 if __name__ == "__main__":